@@ -0,0 +1,152 @@
+# backend/app/core/timezones.py
+# NEW FILE
+# Version: 1.0.0
+
+import os
+import logging
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, List, Set
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# Số năm (tính từ năm hiện tại) được tính sẵn bảng chuyển đổi DST
+TZ_TRANSITION_HORIZON_YEARS = int(os.environ.get("TZ_TRANSITION_HORIZON_YEARS", "30"))
+
+
+class ZoneTransitionTable:
+    """
+    Các khoảng thời gian có offset cố định của một timezone trong horizon lập lịch.
+    Chuyển giờ địa phương -> UTC bằng bisect thay vì pytz.localize, với cùng ngữ nghĩa
+    như localize(..., is_dst=None): giờ bị lặp lại -> AmbiguousTimeError,
+    giờ bị bỏ qua -> NonExistentTimeError.
+    """
+    def __init__(self, tz, horizon_start: datetime, horizon_end: datetime):
+        self.tz = tz
+        self.horizon_start = horizon_start
+        self.horizon_end = horizon_end
+        # Các khoảng [local_start, local_end) theo giờ địa phương, sắp xếp tăng dần
+        self._local_starts: List[datetime] = []
+        self._local_ends: List[datetime] = []
+        self._offsets: List[timedelta] = []
+        self._tzinfos: List = []
+
+        utc_transitions = getattr(tz, '_utc_transition_times', None)
+        if not utc_transitions:
+            # Timezone cố định (UTC, Etc/GMT+7, ...): một khoảng duy nhất
+            self._append(datetime.min, datetime.max, tz.utcoffset(None), tz)
+            return
+
+        for index, utc_start in enumerate(utc_transitions):
+            utc_end = utc_transitions[index + 1] if index + 1 < len(utc_transitions) else None
+            if utc_end is not None and utc_end < horizon_start - timedelta(days=1):
+                continue
+            if utc_start > horizon_end + timedelta(days=1):
+                break
+            transition_info = tz._transition_info[index]
+            offset = transition_info[0]
+            self._append(
+                self._shift(utc_start, offset) if index > 0 else datetime.min,
+                self._shift(utc_end, offset) if utc_end is not None else datetime.max,
+                offset,
+                tz._tzinfos[transition_info]
+            )
+
+    @staticmethod
+    def _shift(utc_naive: datetime, offset: timedelta) -> datetime:
+        try:
+            return utc_naive + offset
+        except OverflowError:
+            return datetime.min if offset < timedelta(0) else datetime.max
+
+    def _append(self, local_start: datetime, local_end: datetime, offset: timedelta, tzinfo):
+        self._local_starts.append(local_start)
+        self._local_ends.append(local_end)
+        self._offsets.append(offset)
+        self._tzinfos.append(tzinfo)
+
+    @property
+    def is_fixed(self) -> bool:
+        """True nếu timezone không có chuyển đổi DST nào trong horizon."""
+        return len(self._offsets) == 1
+
+    def _resolve(self, local_naive: datetime) -> int:
+        """Trả về chỉ số khoảng chứa local_naive; -1 nếu nằm ngoài horizon."""
+        if not (self.horizon_start <= local_naive < self.horizon_end):
+            return -1
+        index = bisect_right(self._local_starts, local_naive) - 1
+        candidates = [
+            candidate for candidate in (index - 1, index)
+            if candidate >= 0 and self._local_starts[candidate] <= local_naive < self._local_ends[candidate]
+        ]
+        if not candidates:
+            raise pytz.exceptions.NonExistentTimeError(local_naive)
+        if len(candidates) > 1 and self._offsets[candidates[0]] != self._offsets[candidates[1]]:
+            raise pytz.exceptions.AmbiguousTimeError(local_naive)
+        return candidates[-1]
+
+    def localize(self, local_naive: datetime) -> datetime:
+        index = self._resolve(local_naive)
+        if index < 0:
+            return self.tz.localize(local_naive, is_dst=None)
+        return local_naive.replace(tzinfo=self._tzinfos[index])
+
+    def to_utc(self, local_naive: datetime) -> datetime:
+        index = self._resolve(local_naive)
+        if index < 0:
+            return self.tz.localize(local_naive, is_dst=None).astimezone(pytz.utc)
+        return (local_naive - self._offsets[index]).replace(tzinfo=pytz.utc)
+
+
+class TimezoneRegistry:
+    """Cache dùng chung cho các đối tượng timezone và bảng chuyển đổi DST của chúng."""
+    def __init__(self, horizon_years: int = TZ_TRANSITION_HORIZON_YEARS):
+        self.horizon_years = horizon_years
+        self._zones: Dict[str, pytz.BaseTzInfo] = {}
+        self._unknown_zones: Set[str] = set()
+        self._tables: Dict[str, ZoneTransitionTable] = {}
+
+    def get(self, timezone_str: str):
+        """Như pytz.timezone(), nhưng cache cả tên timezone không hợp lệ."""
+        zone = self._zones.get(timezone_str)
+        if zone is not None:
+            return zone
+        if timezone_str in self._unknown_zones:
+            raise pytz.exceptions.UnknownTimeZoneError(timezone_str)
+        try:
+            zone = pytz.timezone(timezone_str)
+        except pytz.exceptions.UnknownTimeZoneError:
+            self._unknown_zones.add(timezone_str)
+            raise
+        self._zones[timezone_str] = zone
+        return zone
+
+    def table(self, tz) -> ZoneTransitionTable:
+        zone_table = self._tables.get(tz.zone)
+        if zone_table is None:
+            current_year = datetime.now(dt_timezone.utc).year
+            zone_table = ZoneTransitionTable(
+                tz,
+                horizon_start=datetime(current_year - 1, 1, 1),
+                horizon_end=datetime(current_year + self.horizon_years, 1, 1)
+            )
+            self._tables[tz.zone] = zone_table
+            logger.debug(f"Built DST transition table for '{tz.zone}' ({len(zone_table._offsets)} period(s)).")
+        return zone_table
+
+    def is_fixed(self, tz) -> bool:
+        return self.table(tz).is_fixed
+
+    def localize(self, tz, local_naive: datetime) -> datetime:
+        """Tương đương tz.localize(local_naive, is_dst=None)."""
+        return self.table(tz).localize(local_naive)
+
+    def to_utc(self, tz, local_naive: datetime) -> datetime:
+        """Tương đương tz.localize(local_naive, is_dst=None).astimezone(pytz.utc)."""
+        return self.table(tz).to_utc(local_naive)
+
+
+# Instance duy nhất cho toàn bộ process
+timezone_registry = TimezoneRegistry()
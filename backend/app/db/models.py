@@ -1,6 +1,14 @@
 # /backend/app/db/models.py
-# Version: 2.10.0
+# Version: 2.17.0
 # Changelog:
+# - Added DeliveryLedgerStatusEnum.queued (keys written ahead of the send, in the same transaction).
+# - Send retries moved to DeliveryLedger (source, user_id, repetition_at, next_retry_at);
+#   removed MessageReceiver.retry_count and next_retry_at.
+# - Added RateLimitBucket (cluster-wide token buckets of the email transports).
+# - Added DeliveryLedger (idempotency keys of send attempts).
+# - Added SchedulerWorker.lane_metrics (per-lane dispatch metrics reported with each heartbeat).
+# - Added SchedulerWorker (membership/heartbeats of hash-partitioned scheduler workers).
+# - Added MessageReceiver.retry_count and next_retry_at for the send retry queue.
 # - Added EmailCheckinSettings and PinAttempt models for v2.4 features.
 # - Re-formatted for readability.
 
@@ -10,9 +18,9 @@ from datetime import datetime, timezone as dt_timezone
 
 from sqlalchemy import (
     Column, Text, Boolean, DateTime, Integer, ForeignKey,
-    Enum as SQLAlchemyEnum, Time, Date, BigInteger
+    Enum as SQLAlchemyEnum, Time, Date, BigInteger, Float
 )
-from sqlalchemy.dialects.postgresql import UUID, INET
+from sqlalchemy.dialects.postgresql import UUID, INET, JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import text
 
@@ -35,6 +43,7 @@ class RatingPointsEnum(str, enum.Enum): _1='_1'; _2='_2'; _3='_3'; _4='_4'; _5='
 class SCMScheduleTypeEnum(str, enum.Enum): loop='loop'; unloop='unloop'
 class SCMStatusEnum(str, enum.Enum): active='active'; inactive='inactive'; paused='paused'
 class SendingMethodEnum(str, enum.Enum): cronpost_email = 'cronpost_email'; in_app_messaging = 'in_app_messaging'; user_email = 'user_email'
+class DeliveryLedgerStatusEnum(str, enum.Enum): queued='queued'; claimed='claimed'; sent='sent'; failed='failed'
 
 
 # --- Định nghĩa các Model Bảng ---
@@ -347,6 +356,42 @@ class SystemSetting(Base):
     updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(dt_timezone.utc), nullable=False)
 
 
+class SchedulerWorker(Base):
+    __tablename__ = 'scheduler_workers'
+    worker_id = Column(Text, primary_key=True)
+    started_at = Column(DateTime(timezone=True), default=lambda: datetime.now(dt_timezone.utc), nullable=False)
+    heartbeat_at = Column(DateTime(timezone=True), default=lambda: datetime.now(dt_timezone.utc), nullable=False)
+    lane_metrics = Column(JSONB)
+
+
+class DeliveryLedger(Base):
+    __tablename__ = 'delivery_ledger'
+    idempotency_key = Column(Text, primary_key=True)
+    # messages.id, simple_cron_messages.id hoặc users.id với email nhắc WCT (không có FK vì tham chiếu nhiều bảng)
+    message_id = Column(UUID(as_uuid=True), nullable=False)
+    receiver_id = Column(UUID(as_uuid=True))
+    # Chủ của lịch gửi (phân vùng của lần gửi lại) và nguồn của job ('message', 'scm', 'wct_reminder', ...)
+    user_id = Column(UUID(as_uuid=True))
+    source = Column(Text, default='message', nullable=False)
+    # Lần gửi theo lịch của khóa (None với IM); dùng để dựng lại job khi gửi lại
+    repetition_at = Column(DateTime(timezone=True))
+    status = Column(SQLAlchemyEnum(DeliveryLedgerStatusEnum, name='delivery_ledger_status_enum', create_type=False), default=DeliveryLedgerStatusEnum.claimed, nullable=False)
+    attempts = Column(Integer, default=1, nullable=False)
+    claimed_at = Column(DateTime(timezone=True), default=lambda: datetime.now(dt_timezone.utc), nullable=False)
+    completed_at = Column(DateTime(timezone=True))
+    last_error = Column(Text)
+    # Lần gửi lại kế tiếp (khóa failed còn lượt thử, hoặc hết lease của khóa claimed); NULL khi không còn
+    next_retry_at = Column(DateTime(timezone=True))
+
+
+class RateLimitBucket(Base):
+    __tablename__ = 'rate_limit_buckets'
+    # 'smtp:system' hoặc 'smtp:user:<user_id>' (không có FK vì tham chiếu nhiều loại transport)
+    bucket_key = Column(Text, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    refilled_at = Column(DateTime(timezone=True), default=lambda: datetime.now(dt_timezone.utc), nullable=False)
+
+
 class MessageThread(Base):
     __tablename__ = 'message_threads'
     id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
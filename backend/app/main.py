@@ -1,5 +1,5 @@
 # backend/app/main.py
-# version 1.15.2 (Launch background cleanup task)
+# version 1.26.0 (Close user SMTP transports on shutdown)
 
 import asyncio # Thêm import asyncio
 from dotenv import load_dotenv
@@ -18,7 +18,15 @@ from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
 from .routers.auth_router import limiter
 
-from .services.worker_cleanup_service import run_daily_cleanup_scheduler
+from .services.leader_election import run_singleton_jobs
+from .services import worker_cleanup_service # Đăng ký job dọn dẹp hằng ngày (chỉ leader chạy)
+from .services.scheduler_core import run_partitioned_scheduler
+from .services import worker # Đăng ký handler của dispatcher với scheduler
+from .services import state_sweeper # Đăng ký handler chuyển trạng thái CLC -> WCT -> FNS
+from .services.smtp_pool import close_smtp_pools
+from .services.smtp_async import close_async_smtp_pools
+from .services.user_smtp_transport import close_user_smtp_transports
+from .services.email_service import precompile_email_templates
 
 logging.basicConfig(
     level=logging.INFO, 
@@ -41,18 +49,30 @@ from .routers import (
 
 from .db.database import engine 
 
+# Chạy scheduler trong process web; đặt "false" khi dùng các process riêng (python -m app.scheduler_main)
+SCHEDULER_IN_APP = os.environ.get("SCHEDULER_IN_APP", "true").lower() == "true"
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Application starting up...")
     logger.info("Database engine initialized.")
+    precompile_email_templates()
     
     # --- ADDED: Launch the background task ---
-    logger.info("Launching background task for daily cleanup...")
-    asyncio.create_task(run_daily_cleanup_scheduler())
+    logger.info("Launching leader election for singleton background jobs (daily cleanup)...")
+    asyncio.create_task(run_singleton_jobs())
+    if SCHEDULER_IN_APP:
+        logger.info("Launching background scheduler for message dispatch...")
+        asyncio.create_task(run_partitioned_scheduler())
+    else:
+        logger.info("SCHEDULER_IN_APP is disabled; message dispatch runs in separate scheduler workers.")
     
     yield
     
     logger.info("Application shutting down...")
+    close_smtp_pools()
+    await close_async_smtp_pools()
+    await close_user_smtp_transports()
     if engine is not None:
         await engine.dispose()
     logger.info("Application shutdown complete.")
@@ -1,5 +1,5 @@
 # /backend/app/models/message_models.py
-# Version: 2.7.1
+# Version: 2.8.1
 
 from pydantic import BaseModel, Field, constr, validator, EmailStr
 from typing import Optional, List
@@ -115,6 +115,30 @@ class FollowMessageResponse(MessageResponseBase):
     fm_schedule: Optional[FmScheduleResponse] = None
     message_order: int
 
+# --- Schedule Preview Models ---
+
+class SchedulePreviewRequest(BaseModel):
+    clc: Optional[CLCScheduleBase] = Field(None, description="CLC config to preview. Exactly one of 'clc' or 'fm' must be set.")
+    fm: Optional[FmScheduleConfigBase] = Field(None, description="FM config to preview. Exactly one of 'clc' or 'fm' must be set.")
+    count: int = Field(default=10, ge=1, le=1000, description="Number of fire times to return (FM is also capped by repeat_number).")
+    reference_at: Optional[datetime] = Field(None, description="Project from this instant instead of now. Values without a UTC offset are read in the user's timezone.")
+    im_sent_at: Optional[datetime] = Field(None, description="FM only: assumed IM send time (read in the user's timezone when it has no UTC offset). Defaults to the real IM send time, else reference_at.")
+
+    @validator('fm', always=True)
+    def exactly_one_config(cls, v, values):
+        if (v is None) == (values.get('clc') is None):
+            raise ValueError("Exactly one of 'clc' or 'fm' must be provided.")
+        return v
+
+class ScheduleFireTime(BaseModel):
+    at_utc: datetime
+    at_local: datetime
+
+class SchedulePreviewResponse(BaseModel):
+    timezone: str
+    fire_times: List[ScheduleFireTime]
+    assumed_im_sent_at: Optional[datetime] = Field(None, description="Set when the FM preview had to assume an IM send time.")
+
 # --- In-App Messaging Models ---
 
 class InAppMessageCreate(BaseModel):
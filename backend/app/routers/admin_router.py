@@ -1,10 +1,13 @@
 # /backend/app/routers/admin_router.py
-# Version 2.2
+# Version 2.5
+# - Added GET /scheduler/clc-load-profile reporting the expected per-minute CLC prompt load with and without jitter.
+# - Added GET /scheduler/lanes reporting per-lane dispatch lag and queue depth of every live scheduler worker.
+# - Added GET /scheduler/catch-up reporting the overdue backlog drained by the scheduler's catch-up lane.
 # - Fixed NameError by reordering Pydantic models before endpoint definitions.
 
 import logging
 from typing import List, Optional, Literal, Dict
-from datetime import datetime
+from datetime import datetime, timedelta, timezone as dt_timezone
 import uuid
 import secrets
 
@@ -18,11 +21,17 @@ from sqlalchemy import or_, func, update, delete
 from ..db.database import get_db_session
 from ..db.models import (
     SystemSetting, User, UserMembershipTypeEnum, UserAccountStatusEnum, 
-    Message, FmSchedule, SimpleCronMessage, EmailCheckinSettings, PinAttempt
+    Message, FmSchedule, SimpleCronMessage, EmailCheckinSettings, PinAttempt, SchedulerWorker
 )
 from ..dependencies import get_current_admin_user, get_system_settings_dep
 from ..services.email_service import send_email_async
 from ..core.security import verify_user_pin_with_lockout
+from ..services.scheduler_core import (
+    measure_backlog, load_catchup_rate, overdue_cutoff, measure_clc_load_profile,
+    SCHEDULER_CATCHUP_ENABLED, SCHEDULER_OVERDUE_SECONDS
+)
+from ..services.dispatch_lanes import LANE_ORDER
+from ..services.clc_jitter import load_clc_jitter_seconds
 
 logger = logging.getLogger(__name__)
 router = APIRouter(
@@ -64,6 +73,56 @@ class UserActionRequest(BaseModel):
 class MessageResponse(BaseModel):
     message: str
 
+class CatchupBacklogItem(BaseModel):
+    kind: str
+    overdue_count: int
+    oldest_due_at: Optional[datetime] = None
+
+class CatchupStatusResponse(BaseModel):
+    enabled: bool
+    active: bool
+    overdue_after_seconds: int
+    rate_per_minute: int
+    total_overdue: int
+    estimated_seconds_remaining: int
+    backlog: List[CatchupBacklogItem]
+
+class LaneMetrics(BaseModel):
+    lane: str
+    weight: int
+    concurrency: int
+    rate_per_second: float
+    queued: int
+    in_flight: int
+    sent: int
+    failed: int
+    oldest_queued_seconds: float
+    lag_p50_seconds: Optional[float] = None
+    lag_p99_seconds: Optional[float] = None
+    lag_max_seconds: Optional[float] = None
+
+class WorkerLaneMetrics(BaseModel):
+    worker_id: str
+    heartbeat_at: datetime
+    lanes: List[LaneMetrics]
+
+class LaneStatusResponse(BaseModel):
+    workers: List[WorkerLaneMetrics]
+
+class ClcLoadMinute(BaseModel):
+    minute: datetime
+    nominal_count: int
+    jittered_count: int
+
+class ClcLoadProfileResponse(BaseModel):
+    jitter_seconds: int
+    start: datetime
+    end: datetime
+    total_prompts: int
+    nominal_peak_per_minute: int
+    jittered_peak_per_minute: int
+    minutes: List[ClcLoadMinute]
+
 # --- Endpoints ---
 
 @router.post("/verify-pin", summary="Verify admin's PIN for initial access")
@@ -105,6 +164,71 @@ async def update_system_setting(
     return {"message": f"Setting '{setting_key}' updated successfully."}
 
 
+@router.get("/scheduler/catch-up", response_model=CatchupStatusResponse, summary="Get scheduler catch-up progress")
+async def get_catchup_status(db: AsyncSession = Depends(get_db_session)):
+    # Đo trực tiếp trong DB (toàn hệ thống) vì các scheduler worker có thể chạy ở process khác
+    now_utc = datetime.now(dt_timezone.utc)
+    cutoff = overdue_cutoff(now_utc) or now_utc
+    backlog = await measure_backlog(db, cutoff, partitioned=False)
+    rate_per_minute = await load_catchup_rate(db)
+    total_overdue = sum(count for count, _ in backlog.values())
+    return CatchupStatusResponse(
+        enabled=SCHEDULER_CATCHUP_ENABLED,
+        active=SCHEDULER_CATCHUP_ENABLED and total_overdue > 0,
+        overdue_after_seconds=SCHEDULER_OVERDUE_SECONDS,
+        rate_per_minute=rate_per_minute,
+        total_overdue=total_overdue,
+        estimated_seconds_remaining=int(total_overdue * 60 / rate_per_minute),
+        backlog=[
+            CatchupBacklogItem(kind=kind, overdue_count=count, oldest_due_at=oldest_due_at)
+            for kind, (count, oldest_due_at) in backlog.items()
+        ]
+    )
+
+
+@router.get("/scheduler/lanes", response_model=LaneStatusResponse, summary="Get per-lane dispatch metrics of scheduler workers")
+async def get_lane_status(db: AsyncSession = Depends(get_db_session)):
+    # Mỗi worker ghi số liệu các làn của nó kèm heartbeat (các làn nằm trong process của worker)
+    workers = (await db.execute(select(SchedulerWorker).order_by(SchedulerWorker.worker_id))).scalars().all()
+    return LaneStatusResponse(workers=[
+        WorkerLaneMetrics(
+            worker_id=worker.worker_id,
+            heartbeat_at=worker.heartbeat_at,
+            lanes=[
+                LaneMetrics(lane=lane, **(worker.lane_metrics or {})[lane])
+                for lane in LANE_ORDER if lane in (worker.lane_metrics or {})
+            ]
+        )
+        for worker in workers
+    ])
+
+
+@router.get("/scheduler/clc-load-profile", response_model=ClcLoadProfileResponse, summary="Get the expected per-minute CLC prompt load")
+async def get_clc_load_profile(
+    hours: int = Query(24, ge=1, le=168),
+    jitter_seconds: Optional[int] = Query(None, ge=0, le=86400, description="Preview another jitter value; defaults to the clc_prompt_jitter_seconds setting"),
+    db: AsyncSession = Depends(get_db_session)
+):
+    # Chỉ các phút có prompt được trả về (phút trống = 0)
+    now_utc = datetime.now(dt_timezone.utc)
+    if jitter_seconds is None:
+        jitter_seconds = await load_clc_jitter_seconds(db)
+    end_utc = now_utc + timedelta(hours=hours)
+    profile = await measure_clc_load_profile(db, now_utc, end_utc, jitter_seconds)
+    return ClcLoadProfileResponse(
+        jitter_seconds=jitter_seconds,
+        start=now_utc,
+        end=end_utc,
+        total_prompts=sum(nominal for nominal, _ in profile.values()),
+        nominal_peak_per_minute=max((nominal for nominal, _ in profile.values()), default=0),
+        jittered_peak_per_minute=max((jittered for _, jittered in profile.values()), default=0),
+        minutes=[
+            ClcLoadMinute(minute=minute_at, nominal_count=nominal, jittered_count=jittered)
+            for minute_at, (nominal, jittered) in profile.items()
+        ]
+    )
+
+
 @router.get("/users", response_model=UserListResponse, summary="List, search, sort, and paginate users")
 async def get_users_list(
     db: AsyncSession = Depends(get_db_session), 
@@ -1,20 +1,25 @@
 # backend/app/routers/auth_router.py
-# Version: 3.1.0
+# Version: 3.3.0
 # Changelog:
+# - GET /email-check-in only shows a confirmation page (mail link scanners open it too);
+#   the check-in itself is POST /email-check-in.
+# - Added GET /email-check-in: one-click check-in from the checkin_token link in WCT reminder emails.
 # - Added logic to auto-update the contacts table upon new user registration.
 
 import os
+import html
 import logging
 import uuid
 from datetime import datetime, timedelta, timezone as dt_timezone
 from user_agents import parse
 from typing import Optional, Dict, Any
+from urllib.parse import quote
 import secrets
 import string
 import pytz
 
 from fastapi import APIRouter, HTTPException, Depends, status, Request as FastAPIRequest, BackgroundTasks
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse
 from pydantic import BaseModel, EmailStr, Field
 
 import httpx
@@ -32,14 +37,21 @@ from slowapi import Limiter
 from slowapi.util import get_remote_address
 
 from ..db.database import get_db_session
-from ..db.models import User, EmailConfirmation, UserAccountStatusEnum, LoginHistory, Contact # {* MODIFIED *}
+from ..db.models import (
+    User, EmailConfirmation, UserAccountStatusEnum, LoginHistory, Contact, # {* MODIFIED *}
+    EmailCheckinSettings, CheckinLog, CheckinMethodEnum
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy import update # {* MODIFIED *}
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
 from ..services.captcha_service import verify_turnstile_captcha
 from ..services.email_service import send_email_async
+from ..services.schedule_service import calculate_next_clc_prompt_at
+from ..services.schedule_notify import notify_schedule_change
+from ..services.scheduler_core import KIND_CLC, KIND_WCT
 
 logger = logging.getLogger(__name__)
 
@@ -241,6 +253,92 @@ async def confirm_email_endpoint(token: str, db_session: AsyncSession = Depends(
     await db_session.commit()
     return RedirectResponse(url=f"{FRONTEND_BASE_URL}/signin?status=email_confirmed_success&email={user.email}")
 
+EMAIL_CHECKIN_CONFIRM_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <meta name="robots" content="noindex">
+    <title>CronPost check-in</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+        .container {{ width: 90%; max-width: 600px; margin: 40px auto; padding: 20px; border: 1px solid #ddd; border-radius: 5px; }}
+        button {{ padding: 10px 20px; background-color: #0d6efd; color: #ffffff; border: none; border-radius: 5px; font-size: 1em; cursor: pointer; }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h3>CronPost Check-in</h3>
+        <p>Confirm that you are active to check in as <strong>{email}</strong>.</p>
+        <form method="post" action="{action}">
+            <button type="submit">Check In Now</button>
+        </form>
+    </div>
+</body>
+</html>"""
+
+
+async def _email_checkin_target(db_session: AsyncSession, token: str, now_utc: datetime, redirect_status: int):
+    """(settings, None) nếu token check-in còn dùng được, ngược lại (None, redirect tới trang đăng nhập kèm lý do)."""
+    settings_record = (await db_session.execute(
+        select(EmailCheckinSettings)
+        .filter_by(checkin_token=token, use_checkin_token_email=True)
+        .options(selectinload(EmailCheckinSettings.user).selectinload(User.configuration))
+    )).scalars().first()
+    if not settings_record or not settings_record.checkin_token_expires_at or settings_record.checkin_token_expires_at <= now_utc:
+        return None, RedirectResponse(url=f"{FRONTEND_BASE_URL}/signin?status=email_checkin_invalid_or_expired", status_code=redirect_status)
+
+    user = settings_record.user
+    if user.account_status != UserAccountStatusEnum.ANS_WCT:
+        return None, RedirectResponse(url=f"{FRONTEND_BASE_URL}/signin?status=email_checkin_not_in_wct&email={user.email}", status_code=redirect_status)
+    # Link trong email không thay được PIN: user bật PIN cho mọi hành động phải đăng nhập để check-in
+    if user.use_pin_for_all_actions:
+        return None, RedirectResponse(url=f"{FRONTEND_BASE_URL}/signin?status=email_checkin_pin_required&email={user.email}", status_code=redirect_status)
+    return settings_record, None
+
+
+@router.get("/email-check-in",include_in_schema=False)
+async def email_check_in_page(token: str, db_session: AsyncSession = Depends(get_db_session)):
+    """
+    Trang xác nhận cho link check-in trong email nhắc WCT. Không đổi trạng thái: trình quét link của hộp thư
+    cũng mở link này, nên check-in chỉ xảy ra khi user bấm nút (POST /email-check-in).
+    """
+    settings_record, redirect = await _email_checkin_target(db_session, token, datetime.now(dt_timezone.utc), status.HTTP_307_TEMPORARY_REDIRECT)
+    if redirect:
+        return redirect
+    return HTMLResponse(EMAIL_CHECKIN_CONFIRM_PAGE.format(
+        email=html.escape(settings_record.user.email),
+        action=html.escape(f"email-check-in?token={quote(token)}")
+    ))
+
+
+@router.post("/email-check-in",include_in_schema=False)
+async def email_check_in_endpoint(token: str, db_session: AsyncSession = Depends(get_db_session)):
+    """Check-in bằng checkin_token trong email nhắc WCT (wct_reminders). Token dùng một lần và hết hạn cùng cửa sổ WCT."""
+    now_utc = datetime.now(dt_timezone.utc)
+    # 303: trình duyệt chuyển sang GET trang đăng nhập thay vì gửi lại POST
+    settings_record, redirect = await _email_checkin_target(db_session, token, now_utc, status.HTTP_303_SEE_OTHER)
+    if redirect:
+        return redirect
+
+    user = settings_record.user
+    user.last_successful_checkin_at = now_utc
+    user.last_activity_at = now_utc
+    user.account_status = UserAccountStatusEnum.ANS_CLC
+    user.updated_at = now_utc
+    user_config = user.configuration
+    if user_config:
+        user_config.wct_active_ends_at = None
+        user_config.next_clc_prompt_at = await calculate_next_clc_prompt_at(user_config, user.timezone, now_utc, db_session)
+        await notify_schedule_change(db_session, KIND_CLC, user.id, user_config.next_clc_prompt_at, user.id)
+        await notify_schedule_change(db_session, KIND_WCT, user.id, None, user.id)
+    settings_record.checkin_token = None
+    settings_record.checkin_token_expires_at = None
+    db_session.add(CheckinLog(user_id=user.id, method=CheckinMethodEnum.email_link))
+    await db_session.commit()
+    logger.info(f"User {user.email} checked in via email link.")
+    return RedirectResponse(url=f"{FRONTEND_BASE_URL}/signin?status=email_checkin_success&email={user.email}", status_code=status.HTTP_303_SEE_OTHER)
+
 @router.post("/resend-confirmation",status_code=status.HTTP_202_ACCEPTED)
 @limiter.limit(RESEND_CONFIRMATION_RATE_LIMIT)
 async def resend_confirmation_email_endpoint(request_data:ResendConfirmationRequest, request:FastAPIRequest, background_tasks:BackgroundTasks, db_session:AsyncSession=Depends(get_db_session)):
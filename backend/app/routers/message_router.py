@@ -1,6 +1,12 @@
 # backend/app/routers/message_router.py
-# Version: 2.0 (Final Version)
+# Version: 2.5
 # Changelog:
+# - PUT /fms/{fm_id} applies the message/schedule changes and recomputes next_send_at (calculate_next_fm_send_at)
+#   before notifying the scheduler with the new due time.
+# - /schedule-preview reads naive reference_at/im_sent_at in the user's timezone instead of the server's.
+# - FM create/update/delete emit a schedule NOTIFY so the scheduler picks up the change immediately.
+# - Added POST /schedule-preview returning the next N fire times of a CLC or FM config.
+# - /overview now reports real SCM active/inactive counts.
 # - Implemented dual-quota check: checks both active message limit and total stored message limit.
 # - Fully integrated with the new 'repeat_number' logic for FM scheduling.
 # - Refactored to align with the final database schema and business logic.
@@ -10,6 +16,8 @@ import uuid
 from typing import Optional, List, Any
 from datetime import datetime, timezone as dt_timezone, date as py_date, time as py_time
 
+import pytz
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from pydantic import BaseModel
 from sqlalchemy import func, and_, or_, update, delete, select
@@ -18,9 +26,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..db.database import get_db_session
 from ..db.models import (
-    User, Message, FmSchedule, UserConfiguration, SystemSetting, SendingHistory,
+    User, Message, FmSchedule, UserConfiguration, SystemSetting, SendingHistory, SimpleCronMessage,
     MessageOverallStatusEnum, UserAccountStatusEnum, CLCTypeEnum, DayOfWeekEnum,
-    WTCDurationUnitEnum, FMScheduleTriggerTypeEnum, SendingAttemptStatusEnum
+    WTCDurationUnitEnum, FMScheduleTriggerTypeEnum, SendingAttemptStatusEnum, SCMStatusEnum
 )
 from ..models.message_models import (
     InitialMessageCreateUpdateRequest,
@@ -29,10 +37,19 @@ from ..models.message_models import (
     UserConfigurationResponse,
     FollowMessageCreateRequest,
     FollowMessageResponse,
-    FollowMessageUpdateRequest
+    FollowMessageUpdateRequest,
+    SchedulePreviewRequest,
+    SchedulePreviewResponse,
+    ScheduleFireTime
 )
 from ..core.security import get_current_active_user
-from ..services.schedule_service import calculate_next_clc_prompt_at, calculate_next_fm_send_at
+from ..core.timezones import timezone_registry
+from ..services.schedule_service import (
+    calculate_next_clc_prompt_at, calculate_next_fm_send_at,
+    ClcScheduleRow, FmScheduleRow, iter_clc_prompts, iter_fm_sends, take_fire_times
+)
+from ..services.schedule_notify import notify_schedule_change
+from ..services.scheduler_core import KIND_FM
 
 logger = logging.getLogger(__name__)
 router = APIRouter(
@@ -101,12 +118,80 @@ async def get_message_overview(
     total_fm_count_val = (await db.execute(total_fm_stmt)).scalar_one()
     fm_inactive_count_val = total_fm_count_val - fm_active_count_val
 
+    scm_counts_stmt = select(
+        func.count(SimpleCronMessage.id).filter(SimpleCronMessage.status == SCMStatusEnum.active),
+        func.count(SimpleCronMessage.id)
+    ).where(SimpleCronMessage.user_id == current_user.id)
+    scm_active_count_val, total_scm_count_val = (await db.execute(scm_counts_stmt)).one()
+
     return MessageOverviewResponse(
         im_status=im_status_str,
         fm_active_count=fm_active_count_val,
         fm_inactive_count=fm_inactive_count_val,
-        scm_active_count=0, # SCM logic not yet implemented
-        scm_inactive_count=0
+        scm_active_count=scm_active_count_val,
+        scm_inactive_count=total_scm_count_val - scm_active_count_val
+    )
+
+
+def _preview_instant_utc(moment: datetime, user_timezone: str) -> datetime:
+    """Mốc thời gian của yêu cầu preview về UTC; giá trị không kèm múi giờ được hiểu theo múi giờ của user."""
+    if moment.tzinfo is not None:
+        return moment.astimezone(dt_timezone.utc)
+    try:
+        return timezone_registry.to_utc(timezone_registry.get(user_timezone), moment)
+    except pytz.exceptions.UnknownTimeZoneError:
+        return moment.replace(tzinfo=dt_timezone.utc)
+    except (pytz.exceptions.NonExistentTimeError, pytz.exceptions.AmbiguousTimeError):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"{moment.isoformat()} does not exist or is ambiguous in timezone {user_timezone}. Include a UTC offset."
+        )
+
+
+@router.post("/schedule-preview", response_model=SchedulePreviewResponse, summary="Preview the next fire times of a CLC or FM schedule")
+async def preview_schedule(
+    preview_data: SchedulePreviewRequest,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    if preview_data.reference_at is not None:
+        reference_utc = _preview_instant_utc(preview_data.reference_at, current_user.timezone)
+    else:
+        reference_utc = datetime.now(dt_timezone.utc)
+    assumed_im_sent_at = None
+
+    if preview_data.clc:
+        clc = preview_data.clc
+        stream = iter_clc_prompts(ClcScheduleRow(
+            key=current_user.id, timezone=current_user.timezone, clc_type=clc.clc_type,
+            clc_prompt_time=clc.clc_prompt_time, clc_day_number_interval=clc.clc_day_number_interval,
+            clc_day_of_week=clc.clc_day_of_week, clc_date_of_month=clc.clc_date_of_month,
+            clc_date_of_year=clc.clc_date_of_year
+        ), reference_utc)
+    else:
+        fm = preview_data.fm
+        if preview_data.im_sent_at is not None:
+            im_sent_at_utc = _preview_instant_utc(preview_data.im_sent_at, current_user.timezone)
+        else:
+            im_sent_at_utc = await _get_im_sent_at_utc(current_user.id, db)
+        if im_sent_at_utc is None:
+            # IM chưa được gửi: giả định IM gửi tại mốc tham chiếu để vẫn có thể xem trước
+            im_sent_at_utc = assumed_im_sent_at = reference_utc
+        stream = iter_fm_sends(FmScheduleRow(
+            key=current_user.id, timezone=current_user.timezone, trigger_type=fm.trigger_type,
+            sending_time_of_day=fm.sending_time_of_day, days_after_im_value=fm.days_after_im_value,
+            day_of_week_value=fm.day_of_week_value, date_of_month_value=fm.date_of_month_value,
+            date_of_year_value=fm.date_of_year_value, specific_date_value=fm.specific_date_value,
+            im_sent_at_utc=im_sent_at_utc, repeat_number=fm.repeat_number
+        ), reference_utc)
+
+    return SchedulePreviewResponse(
+        timezone=current_user.timezone,
+        fire_times=[
+            ScheduleFireTime(at_utc=at_utc, at_local=at_local)
+            for at_utc, at_local in take_fire_times(stream, preview_data.count, current_user.timezone)
+        ],
+        assumed_im_sent_at=assumed_im_sent_at
     )
 
 
@@ -235,6 +320,8 @@ async def create_follow_message(
     db.add(current_user)
 
     try:
+        if calculated_next_send_at is not None:
+            await notify_schedule_change(db, KIND_FM, new_fm_message.id, calculated_next_send_at, current_user.id)
         await db.commit()
         stmt_get_fm = select(Message).where(Message.id == new_fm_message.id).options(joinedload(Message.fm_schedule))
         refreshed_fm_with_schedule = (await db.execute(stmt_get_fm)).scalars().first()
@@ -278,26 +365,45 @@ async def update_follow_message(fm_id: uuid.UUID, fm_update_data: FollowMessageU
     if not fm_db or fm_db.is_initial_message:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Follow Message not found.")
 
-    update_data_dict = fm_update_data.model_dump(exclude_unset=True)
     now_utc = datetime.now(dt_timezone.utc)
     needs_recalculation = False
 
-    if "message" in update_data_dict:
-        # ... update message content ...
+    if fm_update_data.message is not None:
+        fm_db.message_title = fm_update_data.message.title
+        fm_db.message_content = fm_update_data.message.content
         fm_db.updated_at = now_utc
 
-    if "schedule" in update_data_dict:
-        # ... update schedule, set needs_recalculation = True ...
-        # Ensure you are updating `repeat_number`
+    schedule_in = fm_update_data.schedule
+    if schedule_in is not None and fm_db.fm_schedule:
+        fm_schedule = fm_db.fm_schedule
+        fm_schedule.trigger_type = schedule_in.trigger_type
+        fm_schedule.sending_time_of_day = schedule_in.sending_time_of_day
+        fm_schedule.repeat_number = schedule_in.repeat_number
+        # Chỉ giữ giá trị của trigger đang dùng, như khi tạo FM
+        fm_schedule.days_after_im_value = schedule_in.days_after_im_value if schedule_in.trigger_type == FMScheduleTriggerTypeEnum.days_after_im_sent else None
+        fm_schedule.day_of_week_value = schedule_in.day_of_week_value if schedule_in.trigger_type == FMScheduleTriggerTypeEnum.day_of_week else None
+        fm_schedule.date_of_month_value = schedule_in.date_of_month_value if schedule_in.trigger_type == FMScheduleTriggerTypeEnum.date_of_month else None
+        fm_schedule.date_of_year_value = schedule_in.date_of_year_value if schedule_in.trigger_type == FMScheduleTriggerTypeEnum.date_of_year else None
+        fm_schedule.specific_date_value = schedule_in.specific_date_value if schedule_in.trigger_type == FMScheduleTriggerTypeEnum.specific_date else None
+        fm_schedule.updated_at = now_utc
         needs_recalculation = True
 
-    if needs_recalculation and fm_db.fm_schedule:
-        # ... call calculate_next_fm_send_at and update next_send_at ...
-        pass
-    
+    if needs_recalculation:
+        try:
+            fm_db.fm_schedule.next_send_at = await calculate_next_fm_send_at(
+                fm_schedule=fm_db.fm_schedule,
+                user_timezone_str=current_user.timezone,
+                im_sent_at_utc=await _get_im_sent_at_utc(current_user.id, db),
+                db=db
+            )
+        except ValueError as ve:
+            await db.rollback()
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ve))
+        await notify_schedule_change(db, KIND_FM, fm_db.id, fm_db.fm_schedule.next_send_at, current_user.id)
+
     await db.commit()
-    await db.refresh(fm_db)
-    return fm_db
+    # Đọc lại kèm fm_schedule (quan hệ không được lazy-load trong session async)
+    return (await db.execute(stmt.execution_options(populate_existing=True))).scalars().first()
 
 
 @router.delete("/fms/{fm_id}", status_code=status.HTTP_204_NO_CONTENT, summary="Delete a specific Follow Message")
@@ -308,5 +414,6 @@ async def delete_follow_message(fm_id: uuid.UUID, current_user: User = Depends(g
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Follow Message not found.")
     
     await db.delete(message_to_delete) # Cascade will handle schedule
+    await notify_schedule_change(db, KIND_FM, fm_id, None, current_user.id)
     await db.commit()
     return None
\ No newline at end of file
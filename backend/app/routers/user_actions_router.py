@@ -1,6 +1,7 @@
 # backend/app/routers/user_actions_router.py
-# Version: 2.3.0
+# Version: 2.4.0
 # Changelog:
+# - Check-in and stop-fns emit schedule NOTIFYs (new CLC prompt, cleared WCT) for the scheduler.
 # - Added GET /blocked-users endpoint to list blocked users.
 # - Added helper function and Pydantic model for the block list response.
 
@@ -21,6 +22,8 @@ from ..db.models import User, CheckinLog, SystemSetting, UserAccountStatusEnum,
 from ..core.security import get_current_active_user, verify_user_pin_with_lockout
 from ..dependencies import get_system_settings_dep
 from ..services.schedule_service import calculate_next_clc_prompt_at
+from ..services.schedule_notify import notify_schedule_change
+from ..services.scheduler_core import KIND_CLC, KIND_WCT
 
 logger = logging.getLogger(__name__)
 router = APIRouter(
@@ -88,6 +91,11 @@ def create_contact_response(contact: Contact, is_blocked: bool) -> ContactRespon
 
 # --- Check-in and Stop FNS API Endpoints ---
 
+async def _notify_clc_rescheduled(db: AsyncSession, user_id: uuid.UUID, next_clc_prompt_at: Optional[datetime]):
+    """User quay lại ANS_CLC: báo scheduler về lần prompt mới và hủy mốc hết hạn WCT."""
+    await notify_schedule_change(db, KIND_CLC, user_id, next_clc_prompt_at, user_id)
+    await notify_schedule_change(db, KIND_WCT, user_id, None, user_id)
+
 @router.post("/check-in", response_model=ActionResponse, summary="User check-in action")
 async def user_check_in(
     request_data: CheckInRequest,
@@ -116,6 +124,7 @@ async def user_check_in(
     if user_config:
         user_config.wct_active_ends_at = None
         user_config.next_clc_prompt_at = await calculate_next_clc_prompt_at(user_config, current_user.timezone, now_utc, db)
+        await _notify_clc_rescheduled(db, current_user.id, user_config.next_clc_prompt_at)
 
     db.add(CheckinLog(user_id=current_user.id, method=CheckinMethodEnum.manual_button))
     
@@ -160,6 +169,7 @@ async def user_stop_fns(
     if user_config:
         user_config.wct_active_ends_at = None
         user_config.next_clc_prompt_at = await calculate_next_clc_prompt_at(user_config, current_user.timezone, now_utc, db)
+        await _notify_clc_rescheduled(db, current_user.id, user_config.next_clc_prompt_at)
 
     logger.warning(f"FNS stopped for user {current_user.email}. Pending FNS messages status not yet handled automatically.")
 
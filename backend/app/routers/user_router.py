@@ -1,5 +1,7 @@
 # backend/app/routers/user_router.py
-# Version 3.3
+# Version 3.4
+# - Saving or deleting SMTP settings invalidates the cached user SMTP transport (locally and, via NOTIFY,
+#   in the scheduler worker that owns the user).
 # - Fixed ImportError by importing password helpers from auth_router instead of security.
 
 import logging
@@ -34,6 +36,9 @@ from ..routers.auth_router import verify_password, hash_password
 # ======================
 from ..dependencies import get_system_settings_dep
 from ..services.email_service import send_email_async, test_smtp_connection
+from ..services.schedule_notify import notify_schedule_change
+from ..services.scheduler_core import KIND_SMTP_SETTINGS
+from ..services.user_smtp_transport import invalidate_user_smtp
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -450,7 +455,10 @@ async def update_smtp_settings(
         )
         db.add(db_settings)
 
+    # Worker đang giữ transport (mật khẩu cũ) của user bỏ cache khi transaction được commit
+    await notify_schedule_change(db, KIND_SMTP_SETTINGS, current_user.id, None, current_user.id)
     await db.commit()
+    invalidate_user_smtp(current_user.id)
     return SmtpTestResponse(success=True, message="SMTP settings saved and connection successful!")
 
 @router.delete("/smtp-settings", status_code=status.HTTP_204_NO_CONTENT)
@@ -464,7 +472,9 @@ async def delete_smtp_settings(
     db_settings = result.scalars().first()
     if db_settings:
         await db.delete(db_settings)
+        await notify_schedule_change(db, KIND_SMTP_SETTINGS, current_user.id, None, current_user.id)
         await db.commit()
+        invalidate_user_smtp(current_user.id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @router.get("/checkin-settings", response_model=CheckinSettingsResponse)
@@ -0,0 +1,227 @@
+# backend/app/scheduler_benchmark.py
+# NEW FILE
+# Version: 1.0.0
+# Benchmark thông lượng của scheduler/dispatcher trên dữ liệu tổng hợp.
+# Chạy trên một Postgres local/thử nghiệm (KHÔNG chạy trên production):
+#   python -m app.scheduler_benchmark --users 100000 --fms-per-user 5 --scms-per-user 2 --window-seconds 120
+# Dữ liệu được gắn email "bench-<run_id>-..." và bị xóa khi kết thúc (trừ khi dùng --keep).
+
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone, time as dt_time
+from typing import Dict, List
+
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("scheduler_benchmark")
+
+from sqlalchemy import select, insert, delete, func, event
+
+from .db.database import engine, AsyncSessionLocal
+from .db.models import (
+    User, UserConfiguration, Message, MessageReceiver, FmSchedule, SimpleCronMessage,
+    UserAccountStatusEnum, CLCTypeEnum, DayOfWeekEnum, FMScheduleTriggerTypeEnum,
+    ReceiverChannelEnum, SCMScheduleTypeEnum, SCMStatusEnum, MessageOverallStatusEnum
+)
+from .services.delivery_service import ReceiverJob, set_default_sender
+from .services.scheduler_core import run_scheduler
+from .services import worker # Đăng ký handler của dispatcher với scheduler
+from .services import state_sweeper # Đăng ký handler chuyển trạng thái CLC -> WCT -> FNS
+
+BENCH_TIMEZONES = [
+    'Etc/UTC', 'Asia/Ho_Chi_Minh', 'America/New_York', 'Europe/London',
+    'Australia/Sydney', 'Asia/Kolkata', 'America/Los_Angeles', 'America/Santiago'
+]
+BENCH_FM_TRIGGERS = [
+    FMScheduleTriggerTypeEnum.days_after_im_sent, FMScheduleTriggerTypeEnum.day_of_week,
+    FMScheduleTriggerTypeEnum.date_of_month, FMScheduleTriggerTypeEnum.date_of_year
+]
+INSERT_CHUNK_SIZE = 5000
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def _build_rows(args, run_id: str, first_due_at: datetime) -> Dict[str, list]:
+    """Sinh dữ liệu trong bộ nhớ; next_send_at rải đều trong [first_due_at, first_due_at + window]."""
+    rows = {"users": [], "configs": [], "messages": [], "receivers": [], "fm_schedules": [], "scms": []}
+
+    def _due_at() -> datetime:
+        return first_due_at + timedelta(seconds=random.uniform(0, args.window_seconds))
+
+    for user_index in range(args.users):
+        user_id = uuid.uuid4()
+        rows["users"].append({
+            "id": user_id, "email": f"bench-{run_id}-{user_index}@bench.invalid",
+            "timezone": random.choice(BENCH_TIMEZONES), "account_status": UserAccountStatusEnum.ANS_CLC
+        })
+        clc_type = random.choice([CLCTypeEnum.every_day, CLCTypeEnum.day_of_week, CLCTypeEnum.date_of_month])
+        rows["configs"].append({
+            "user_id": user_id, "clc_type": clc_type, "is_clc_enabled": True,
+            "clc_day_of_week": random.choice(list(DayOfWeekEnum)), "clc_date_of_month": random.randint(1, 31),
+            "clc_prompt_time": dt_time(random.randint(0, 23), random.choice([0, 30])),
+            # Prompt CLC ở xa trong tương lai: benchmark chỉ đo dispatcher FM/SCM
+            "next_clc_prompt_at": first_due_at + timedelta(days=365)
+        })
+        for fm_index in range(args.fms_per_user):
+            message_id = uuid.uuid4()
+            rows["messages"].append({
+                "id": message_id, "user_id": user_id, "message_order": fm_index + 1,
+                "message_title": f"Benchmark FM {fm_index + 1}", "message_content": "<p>benchmark</p>",
+                "is_initial_message": False, "overall_send_status": MessageOverallStatusEnum.pending
+            })
+            for receiver_index in range(random.randint(1, args.max_receivers_per_fm)):
+                rows["receivers"].append({
+                    "message_id": message_id, "receiver_channel": ReceiverChannelEnum.email,
+                    "receiver_address": f"bench-{run_id}-{user_index}-{fm_index}-{receiver_index}@bench.invalid"
+                })
+            trigger_type = random.choice(BENCH_FM_TRIGGERS)
+            rows["fm_schedules"].append({
+                "message_id": message_id, "trigger_type": trigger_type,
+                "days_after_im_value": random.randint(1, 30),
+                "day_of_week_value": random.choice(list(DayOfWeekEnum)),
+                "date_of_month_value": random.randint(1, 31),
+                "date_of_year_value": random.choice(['01/01', '29/02', '15/06', '31/12']),
+                "sending_time_of_day": dt_time(random.randint(0, 23)),
+                "repeat_number": random.randint(1, 3), "next_send_at": _due_at()
+            })
+        for scm_index in range(args.scms_per_user):
+            rows["scms"].append({
+                "id": uuid.uuid4(), "user_id": user_id, "title": f"Benchmark SCM {scm_index + 1}",
+                "content": "<p>benchmark</p>", "receiver_address": f"bench-{run_id}-{user_index}-scm{scm_index}@bench.invalid",
+                "schedule_type": SCMScheduleTypeEnum.loop, "loop_interval_minutes": 1440, "repeat_number": 3,
+                "status": SCMStatusEnum.active, "next_send_at": _due_at()
+            })
+    return rows
+
+
+async def seed(rows: Dict[str, list]):
+    started = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        for model, key in [
+            (User, "users"), (UserConfiguration, "configs"), (Message, "messages"),
+            (MessageReceiver, "receivers"), (FmSchedule, "fm_schedules"), (SimpleCronMessage, "scms")
+        ]:
+            for chunk_start in range(0, len(rows[key]), INSERT_CHUNK_SIZE):
+                await db.execute(insert(model), rows[key][chunk_start:chunk_start + INSERT_CHUNK_SIZE])
+        await db.commit()
+    total_rows = sum(len(value) for value in rows.values())
+    print(f"Seeded {total_rows} rows in {time.perf_counter() - started:.1f}s "
+          f"({len(rows['users'])} users, {len(rows['fm_schedules'])} FMs, {len(rows['receivers'])} receivers, {len(rows['scms'])} SCMs).")
+
+
+async def cleanup(run_id: str):
+    async with AsyncSessionLocal() as db:
+        # ON DELETE CASCADE dọn configurations, messages, receivers, schedules, history và SCM
+        await db.execute(delete(User).where(User.email.like(f"bench-{run_id}-%")))
+        await db.commit()
+    print(f"Removed benchmark data for run {run_id}.")
+
+
+async def run_benchmark(args):
+    if engine is None:
+        raise SystemExit("APP_DB_* environment variables are not set.")
+    engine.echo = False
+    run_id = uuid.uuid4().hex[:8]
+
+    async with AsyncSessionLocal() as db:
+        foreign_users = (await db.execute(
+            select(func.count(User.id)).where(User.email.notlike("bench-%"))
+        )).scalar_one()
+    if foreign_users and not args.force:
+        raise SystemExit(
+            f"Database contains {foreign_users} non-benchmark user(s); their due messages would be sent "
+            "through the stub sender and marked as sent. Use an empty database or pass --force."
+        )
+
+    first_due_at = datetime.now(timezone.utc) + timedelta(seconds=args.lead_seconds)
+    rows = _build_rows(args, run_id, first_due_at)
+    due_by_entity = {fm["message_id"]: fm["next_send_at"] for fm in rows["fm_schedules"]}
+    due_by_entity.update({scm["id"]: scm["next_send_at"] for scm in rows["scms"]})
+    expected_claims = len(due_by_entity)
+    await seed(rows)
+    del rows
+
+    round_trips = 0
+
+    def _count_round_trip(*_):
+        nonlocal round_trips
+        round_trips += 1
+    event.listen(engine.sync_engine, "before_cursor_execute", _count_round_trip)
+
+    lags: List[float] = []
+    claimed = set()
+    sends = 0
+
+    async def stub_sender(job: ReceiverJob):
+        nonlocal sends
+        if args.sender_latency_ms:
+            await asyncio.sleep(args.sender_latency_ms / 1000)
+        sends += 1
+        due_at = due_by_entity.get(job.message_id)
+        if due_at is not None and job.message_id not in claimed:
+            claimed.add(job.message_id)
+            lags.append((datetime.now(timezone.utc) - due_at).total_seconds())
+    set_default_sender(stub_sender)
+
+    print(f"Dispatching {expected_claims} schedule(s) due over {args.window_seconds}s (run {run_id})...")
+    started = time.perf_counter()
+    scheduler_task = asyncio.create_task(run_scheduler())
+    deadline = started + args.lead_seconds + args.window_seconds + args.timeout_seconds
+    while len(claimed) < expected_claims and time.perf_counter() < deadline:
+        await asyncio.sleep(0.2)
+    elapsed = time.perf_counter() - started
+    scheduler_task.cancel()
+    await asyncio.gather(scheduler_task, return_exceptions=True)
+    event.remove(engine.sync_engine, "before_cursor_execute", _count_round_trip)
+
+    # Khoảng thời gian thực sự bận xả lịch (không tính lead time chờ lịch đầu tiên đến hạn)
+    busy_seconds = max(elapsed - args.lead_seconds, 1e-9)
+    lags.sort()
+    print("")
+    print(f"  claims           {len(claimed)}/{expected_claims}")
+    print(f"  sends            {sends}")
+    print(f"  claims/sec       {len(claimed) / busy_seconds:.1f}")
+    print(f"  sends/sec        {sends / busy_seconds:.1f}")
+    print(f"  lag p50          {_percentile(lags, 0.50) * 1000:.0f} ms")
+    print(f"  lag p99          {_percentile(lags, 0.99) * 1000:.0f} ms")
+    print(f"  lag max          {(lags[-1] if lags else 0) * 1000:.0f} ms")
+    print(f"  DB round-trips   {round_trips} ({round_trips / max(sends, 1):.3f} per send)")
+
+    if not args.keep:
+        await cleanup(run_id)
+    await engine.dispose()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Seed synthetic schedules and measure scheduler throughput with a stub sender.")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--fms-per-user", type=int, default=3)
+    parser.add_argument("--max-receivers-per-fm", type=int, default=2)
+    parser.add_argument("--scms-per-user", type=int, default=1)
+    parser.add_argument("--lead-seconds", type=float, default=10, help="Delay before the first schedule comes due (covers scheduler startup).")
+    parser.add_argument("--window-seconds", type=float, default=60, help="Due times are spread uniformly over this window.")
+    parser.add_argument("--timeout-seconds", type=float, default=120, help="Extra time allowed after the window to drain the backlog.")
+    parser.add_argument("--sender-latency-ms", type=float, default=0, help="Simulated per-send latency of the stub sender.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible data.")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded rows after the run.")
+    parser.add_argument("--force", action="store_true", help="Run even if the database contains non-benchmark users.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    random.seed(arguments.seed)
+    asyncio.run(run_benchmark(arguments))
@@ -0,0 +1,60 @@
+# backend/app/scheduler_main.py
+# NEW FILE
+# Version: 1.7.0
+# Changelog:
+# - Starts the delivery prepare process pool (only this process runs it) and shuts it down on exit.
+# - Precompiles the email templates before starting the scheduler.
+# - Closes the per-user SMTP transports on exit.
+# - Also closes the asyncio SMTP transport pools on exit.
+# - Closes pooled SMTP connections on exit.
+# - Shuts down the delivery preparation process pool on exit.
+# Chạy scheduler như một process riêng: python -m app.scheduler_main
+# Có thể chạy nhiều process; mỗi process sở hữu một phân vùng user (xem services/scheduler_partition.py).
+
+import asyncio
+import signal
+from dotenv import load_dotenv
+load_dotenv()
+
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+from .db.database import engine
+from .services.scheduler_core import run_partitioned_scheduler
+from .services import worker # Đăng ký handler của dispatcher với scheduler
+from .services import state_sweeper # Đăng ký handler chuyển trạng thái CLC -> WCT -> FNS
+from .services.smtp_pool import close_smtp_pools
+from .services.smtp_async import close_async_smtp_pools
+from .services.user_smtp_transport import close_user_smtp_transports
+from .services.email_service import precompile_email_templates
+from .services.prepare_pool import start_prepare_pool, shutdown_prepare_pool
+
+
+async def main():
+    precompile_email_templates()
+    await start_prepare_pool()
+    scheduler_task = asyncio.create_task(run_partitioned_scheduler())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # Hủy task để heartbeat kịp rời nhóm trước khi process thoát
+        loop.add_signal_handler(sig, scheduler_task.cancel)
+    try:
+        await scheduler_task
+    except asyncio.CancelledError:
+        logger.info("Scheduler worker is shutting down...")
+    finally:
+        shutdown_prepare_pool()
+        close_smtp_pools()
+        await close_async_smtp_pools()
+        await close_user_smtp_transports()
+        if engine is not None:
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
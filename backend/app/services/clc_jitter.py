@@ -0,0 +1,75 @@
+# backend/app/services/clc_jitter.py
+# NEW FILE
+# Version: 1.0.0
+
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, literal_column, Interval
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db.models import SystemSetting
+from .scheduler_partition import user_hash
+
+logger = logging.getLogger(__name__)
+
+# Giờ prompt CLC mặc định (09:00) dồn hàng loạt user vào cùng một phút. Scheduler có thể dời prompt
+# của mỗi user trong khoảng [-jitter, +jitter] giây quanh giờ danh nghĩa; độ lệch cố định theo user
+# (tính từ cùng hash với phân vùng worker) nên không đổi giữa các lần chạy và các worker.
+# next_clc_prompt_at trong DB (và hiển thị cho user) vẫn là giờ danh nghĩa.
+CLC_JITTER_SETTING = "clc_prompt_jitter_seconds"
+CLC_JITTER_DEFAULT = 0
+
+_SECOND = literal_column("interval '1 second'", Interval)
+
+# Giá trị đang áp dụng trong process, làm mới ở mỗi lần refill của scheduler
+_jitter_seconds: int = CLC_JITTER_DEFAULT
+
+
+def current_jitter_seconds() -> int:
+    return _jitter_seconds
+
+
+async def load_clc_jitter_seconds(db: AsyncSession) -> int:
+    """Độ lệch tối đa (giây) của prompt CLC so với giờ danh nghĩa (system setting clc_prompt_jitter_seconds, 0 = tắt)."""
+    stmt = select(SystemSetting.setting_value).where(SystemSetting.setting_key == CLC_JITTER_SETTING)
+    value = (await db.execute(stmt)).scalar_one_or_none()
+    try:
+        return max(0, int(value)) if value is not None else CLC_JITTER_DEFAULT
+    except ValueError:
+        logger.warning(f"CLC_JITTER: Invalid value '{value}' for system setting '{CLC_JITTER_SETTING}'. Using default {CLC_JITTER_DEFAULT}.")
+        return CLC_JITTER_DEFAULT
+
+
+async def refresh_clc_jitter(db: AsyncSession) -> int:
+    global _jitter_seconds
+    jitter_seconds = await load_clc_jitter_seconds(db)
+    if jitter_seconds != _jitter_seconds:
+        logger.info(f"CLC_JITTER: Spreading CLC prompts within +/-{jitter_seconds}s of their nominal time.")
+    _jitter_seconds = jitter_seconds
+    return jitter_seconds
+
+
+def jitter_offset_seconds(user_hash_value: int, jitter_seconds: Optional[int] = None) -> int:
+    """Độ lệch của user (từ abs(hashtext(user_id)) đã tính sẵn), trong [-jitter, +jitter]."""
+    jitter_seconds = _jitter_seconds if jitter_seconds is None else jitter_seconds
+    if not jitter_seconds:
+        return 0
+    return user_hash_value % (2 * jitter_seconds + 1) - jitter_seconds
+
+
+def jittered_from_hash(prompt_at: Optional[datetime], user_hash_value: int) -> Optional[datetime]:
+    """Thời điểm gửi thực tế của một prompt danh nghĩa (vd: từ payload NOTIFY có sẵn user_hash)."""
+    if prompt_at is None:
+        return None
+    return prompt_at + timedelta(seconds=jitter_offset_seconds(user_hash_value))
+
+
+def jittered_prompt_at(prompt_column, user_id_column, jitter_seconds: Optional[int] = None):
+    """Biểu thức SQL của thời điểm gửi thực tế, khớp với jitter_offset_seconds()."""
+    jitter_seconds = _jitter_seconds if jitter_seconds is None else jitter_seconds
+    if not jitter_seconds:
+        return prompt_column
+    offset = user_hash(user_id_column) % (2 * jitter_seconds + 1) - jitter_seconds
+    return prompt_column + _SECOND * offset
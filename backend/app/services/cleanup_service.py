@@ -1,16 +1,22 @@
 # /backend/app/services/cleanup_service.py
+# Version 1.2.1 - cleanup_delivery_ledger() keeps keys that still have a pending retry.
+# Version 1.2.0 - Added cleanup_delivery_ledger() (prunes old idempotency keys).
 # Version 1.1.0 - Added check to not delete unread messages.
 
+import os
 import logging
 from sqlalchemy import select, delete, or_, and_
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta, timezone
 
 from ..db.database import AsyncSessionLocal
-from ..db.models import InAppMessage, User, SystemSetting
+from ..db.models import InAppMessage, User, SystemSetting, DeliveryLedger
 
 logger = logging.getLogger(__name__)
 
+# Khóa idempotency chỉ cần tới khi batch của nó đã commit; giữ lâu hơn nhiều để tra cứu khi cần
+DELIVERY_LEDGER_RETENTION_DAYS = int(os.environ.get("DELIVERY_LEDGER_RETENTION_DAYS", "30"))
+
 async def cleanup_old_in_app_messages():
     """
     Finds and deletes In-App messages that are both read and past their retention period,
@@ -86,4 +92,17 @@ async def cleanup_old_in_app_messages():
 
         except Exception as e:
             await db.rollback()
-            logger.error(f"CLEANUP JOB: An error occurred during In-App message cleanup: {e}", exc_info=True)
\ No newline at end of file
+            logger.error(f"CLEANUP JOB: An error occurred during In-App message cleanup: {e}", exc_info=True)
+
+
+async def cleanup_delivery_ledger():
+    """Deletes delivery ledger entries claimed more than DELIVERY_LEDGER_RETENTION_DAYS ago (except pending retries)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=DELIVERY_LEDGER_RETENTION_DAYS)
+    async with AsyncSessionLocal() as db:
+        try:
+            result = await db.execute(delete(DeliveryLedger).where(DeliveryLedger.claimed_at < cutoff, DeliveryLedger.next_retry_at.is_(None)))
+            await db.commit()
+            logger.info(f"CLEANUP JOB: Deleted {result.rowcount} delivery ledger entries older than {DELIVERY_LEDGER_RETENTION_DAYS} days.")
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"CLEANUP JOB: An error occurred during delivery ledger cleanup: {e}", exc_info=True)
@@ -0,0 +1,695 @@
+# backend/app/services/delivery_service.py
+# Version: 1.16.0
+# Changelog:
+# - Added settle_initial_messages(): resolves IMs left in 'processing' from their ledger keys once none
+#   is still queued, claimed or waiting for a retry (sent if any receiver got it, else failed).
+# - execute_jobs() prepares large bodies in the process pool again (prepare_pool). The pool is started
+#   only by the scheduler worker and its processes import mime_parts alone; without a pool, bodies are
+#   built on first use as before.
+# - Only scheduled dispatch (send_email_job) takes tokens from the transport rate limit; transactional
+#   mail sent through email_service.send_email_async is exempt.
+# - Deferred sends (SendRateLimited) no longer count as attempts: the ledger claim is given back and
+#   record_delivery_results() writes no SendingHistory row nor send_attempts for them. The key is
+#   retried at deferred_until through the ledger like any other retry.
+# - Added queue_delivery_keys(): writes 'queued' ledger keys in the caller's transaction (outbox), so
+#   sends triggered by a state change (CLC prompts) are picked up by the retry dispatcher if the process
+#   dies after the commit. Added SOURCE_CLC_PROMPT.
+# - Retries are keyed by idempotency key in the delivery ledger (next_retry_at, attempts) instead of by
+#   message receiver, so every repetition keeps its own pending retry and SCM/WCT reminder jobs
+#   (no receiver row) are retried too. execute_jobs() plans the retry of each failed key from the
+#   RetryPolicy passed by the caller (DeliveryResult.retry_at); claim_due_retries() rebuilds due jobs
+#   through the retry builder registered for their source (register_retry_builder).
+#   Removed plan_retries()/push_retries() and ReceiverJob.retry_count.
+# - Keys that are already sent or still claimed elsewhere come back as no-op results (DeliveryResult.noop):
+#   they write no SendingHistory row and touch neither retries nor send_attempts.
+# - user_email jobs carry the owner (ReceiverJob.sender_user_id) and are sent through the user's own
+#   SMTP transport (user_smtp_transport) when configured, else through the system SMTP.
+# - Sends that hit the transport rate limit (SendRateLimited) are deferred: the receiver is rescheduled
+#   after the bucket refills without counting as a failed attempt (DeliveryResult.deferred_until).
+# - execute_jobs() prepares large bodies of a batch in the process pool (prepare_pool) before sending.
+# - Message/SCM bodies are rendered once per content (render_cache) and shared by every receiver,
+#   repetition and retry; ReceiverJob.body_key names the cached body.
+# - Sends are deduplicated through the delivery ledger: execute_jobs() claims each job's idempotency key
+#   (message, receiver, repetition) with one batched INSERT ... ON CONFLICT before sending and records
+#   the outcomes with one batched UPDATE afterwards. Removed deliver(); SCM runs use execute_jobs().
+# - Every send holds a slot of its priority lane (dispatch_lanes): ReceiverJob carries the lane
+#   and the scheduled due time used for per-lane lag.
+# - The default sender is swappable (set_default_sender) so benchmarks can drive the real dispatch
+#   path with a stub sender.
+# - Retry claims are restricted to users in this worker's hash partition.
+# - Failed receivers are retried individually with exponential backoff and jitter
+#   (send_retry_* system settings); retries are fed into the scheduler timeline.
+
+import os
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select, insert, update, values, column, cast, case, exists, func, or_, DateTime, Integer, Text
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db.database import AsyncSessionLocal
+from ..db.models import (
+    Message, MessageReceiver, SendingHistory, SystemSetting, SimpleCronMessage, DeliveryLedger,
+    MessageOverallStatusEnum, IndividualSendStatusEnum, SendingAttemptStatusEnum,
+    ReceiverChannelEnum, SendingMethodEnum, DeliveryLedgerStatusEnum
+)
+from .email_service import send_html_email_async, send_user_html_email_async, build_html_part
+from .render_cache import render_cache
+from .prepare_pool import prepare_bodies
+from .send_rate_limiter import SendRateLimited
+from .dispatch_lanes import lane_slot, LANE_FNS, LANE_FM, LANE_SCM
+from .scheduler_core import scheduler_timeline, KIND_RETRY
+from .scheduler_partition import owned_by_this_worker
+
+logger = logging.getLogger(__name__)
+
+# Số người nhận được gửi song song trong một batch
+DELIVERY_CONCURRENCY = int(os.environ.get("DELIVERY_CONCURRENCY", "20"))
+# Khóa idempotency đang ở trạng thái claimed lâu hơn mức này coi như của một worker đã chết
+DELIVERY_LEDGER_LEASE_SECONDS = int(os.environ.get("DELIVERY_LEDGER_LEASE_SECONDS", "300"))
+
+# Nguồn của job (delivery_ledger.source): quyết định cách dựng lại job khi gửi lại
+SOURCE_MESSAGE = 'message'
+SOURCE_SCM = 'scm'
+SOURCE_WCT_REMINDER = 'wct_reminder'
+SOURCE_CLC_PROMPT = 'clc_prompt'
+
+# Khóa chưa được gửi lần nào (queued) hoặc lần gửi trước lỗi (failed): được claim lại
+_SENDABLE_STATUSES = (DeliveryLedgerStatusEnum.queued, DeliveryLedgerStatusEnum.failed)
+
+
+class ReceiverJob(NamedTuple):
+    message_id: object
+    receiver_id: object
+    channel: ReceiverChannelEnum
+    address: str
+    subject: str
+    html_content: str
+    sending_method: SendingMethodEnum
+    # Làn ưu tiên (dispatch_lanes) và thời điểm đến hạn (để đo độ trễ của làn; next_retry_at với lần gửi lại)
+    lane: str = LANE_FM
+    due_at: Optional[datetime] = None
+    # Khóa body trong render_cache (None: body riêng cho từng job, không cache)
+    body_key: Optional[Tuple] = None
+    # Chủ của lịch gửi: phân vùng của lần gửi lại, và SMTP riêng khi gửi bằng user_email
+    user_id: Optional[object] = None
+    source: str = SOURCE_MESSAGE
+    # Lần gửi theo lịch mà job thuộc về (next_send_at của FM/SCM, thời điểm nhắc của WCT; None với IM).
+    # Lần gửi lại giữ nguyên giá trị này nên dùng lại khóa idempotency của lần gửi gốc.
+    repetition_at: Optional[datetime] = None
+
+    @property
+    def sender_user_id(self) -> Optional[object]:
+        """Chủ tin nhắn khi gửi bằng user_email (qua SMTP riêng của user nếu đã cấu hình)."""
+        return self.user_id if self.sending_method == SendingMethodEnum.user_email else None
+
+    @property
+    def idempotency_key(self) -> str:
+        """
+        (message, receiver, lần gửi). Lần gửi được định danh bằng repetition_at, vốn chỉ đổi khi kết quả
+        đã được commit, nên một batch bị claim lại sau crash sinh ra đúng các khóa cũ và mọi lần gửi lại
+        của cùng một lần lặp dùng chung một khóa. IM chỉ gửi một lần ('initial').
+        """
+        repetition = self.repetition_at.astimezone(timezone.utc).isoformat() if self.repetition_at else 'initial'
+        return f"{self.message_id}:{self.receiver_id or '-'}:{repetition}"
+
+
+class DeliveryResult(NamedTuple):
+    job: ReceiverJob
+    attempted_at: datetime
+    error: Optional[str] = None
+    # Chưa gửi vì transport hết token (rate limit): gửi lại lúc này, không tính là một lần thất bại
+    deferred_until: Optional[datetime] = None
+    # Không gửi vì khóa đã gửi xong (error=None) hoặc đang được gửi ở nơi khác (error là lý do):
+    # không ghi lịch sử, không đụng tới retry hay send_attempts
+    noop: bool = False
+    # Thời điểm delivery ledger sẽ gửi lại khóa này (None: đã gửi, hoặc lỗi cuối cùng)
+    retry_at: Optional[datetime] = None
+
+    @property
+    def ok(self) -> bool:
+        """Đã gửi thành công trong lần chạy này."""
+        return self.error is None and not self.noop
+
+    @property
+    def delivered(self) -> bool:
+        """Đã gửi thành công, trong lần chạy này hoặc trước đó."""
+        return self.error is None
+
+    @property
+    def failed(self) -> bool:
+        """Lần gửi thật sự thất bại (không tính no-op và lần gửi bị hoãn vì rate limit)."""
+        return self.error is not None and not self.noop and self.deferred_until is None
+
+
+class RetryPolicy(NamedTuple):
+    max_attempts: int
+    base_delay_seconds: int
+    max_delay_seconds: int
+
+    def next_retry_at(self, failed_attempts: int, failed_at: datetime) -> Optional[datetime]:
+        """
+        Thời điểm gửi lại sau failed_attempts lần thất bại liên tiếp, hoặc None nếu đã hết lượt.
+        Backoff mũ có trần, cộng "equal jitter" (nửa cố định, nửa ngẫu nhiên) để các người nhận
+        của cùng một lần gửi lỗi không dồn lại vào cùng một thời điểm.
+        """
+        if failed_attempts >= self.max_attempts:
+            return None
+        delay = min(self.max_delay_seconds, self.base_delay_seconds * (2 ** (failed_attempts - 1)))
+        return failed_at + timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+# Không gửi lại: mọi lỗi đều là lỗi cuối cùng
+NO_RETRY = RetryPolicy(max_attempts=1, base_delay_seconds=0, max_delay_seconds=0)
+
+RETRY_SETTING_DEFAULTS = {
+    "send_retry_max_attempts": 5,
+    "send_retry_base_delay_seconds": 60,
+    "send_retry_max_delay_seconds": 3600,
+}
+
+
+async def load_retry_policy(db: AsyncSession) -> RetryPolicy:
+    """Đọc chính sách gửi lại từ system_settings (một truy vấn)."""
+    stmt = select(SystemSetting.setting_key, SystemSetting.setting_value).where(
+        SystemSetting.setting_key.in_(list(RETRY_SETTING_DEFAULTS))
+    )
+    settings = dict(RETRY_SETTING_DEFAULTS)
+    for key, value in (await db.execute(stmt)).all():
+        try:
+            settings[key] = int(value)
+        except (TypeError, ValueError):
+            logger.warning(f"DELIVERY: Invalid value '{value}' for system setting '{key}'. Using default {settings[key]}.")
+    return RetryPolicy(
+        max_attempts=max(1, settings["send_retry_max_attempts"]),
+        base_delay_seconds=max(1, settings["send_retry_base_delay_seconds"]),
+        max_delay_seconds=max(1, settings["send_retry_max_delay_seconds"])
+    )
+
+
+Sender = Callable[[ReceiverJob], Awaitable[None]]
+
+
+async def send_email_job(job: ReceiverJob):
+    """
+    Sender mặc định: gửi qua SMTP riêng của user (user_email) hoặc SMTP hệ thống, có giới hạn tốc độ của
+    transport (SendRateLimited). Lỗi được ném ra để ghi nhận thất bại.
+    """
+    body_part = render_cache.get_or_build(job.body_key, job.html_content, build_html_part) if job.body_key else None
+    if job.sender_user_id is not None and await send_user_html_email_async(
+        job.sender_user_id, subject=job.subject, email_to=job.address, html_content=job.html_content, body_part=body_part,
+        rate_limited=True
+    ):
+        return
+    await send_html_email_async(
+        subject=job.subject, email_to=job.address, html_content=job.html_content, body_part=body_part, rate_limited=True
+    )
+
+
+_default_sender: Sender = send_email_job
+
+
+def set_default_sender(sender: Sender):
+    """Thay sender dùng khi caller không truyền sender (vd: stub không gửi thật trong benchmark)."""
+    global _default_sender
+    _default_sender = sender
+
+
+def receiver_job(
+    message: Message,
+    receiver: MessageReceiver,
+    due_at: Optional[datetime] = None,
+    repetition_at: Optional[datetime] = None
+) -> ReceiverJob:
+    """Job của một người nhận; repetition_at mặc định là due_at (lần gửi theo lịch)."""
+    return ReceiverJob(
+        message_id=message.id,
+        receiver_id=receiver.id,
+        channel=receiver.receiver_channel,
+        address=receiver.receiver_address,
+        subject=message.message_title or "CronPost message",
+        html_content=message.message_content,
+        sending_method=message.sending_method,
+        # IM chỉ được gửi khi user vào FNS; các lần gửi lại của IM giữ nguyên làn FNS
+        lane=LANE_FNS if message.is_initial_message else LANE_FM,
+        due_at=due_at,
+        body_key=('message', message.id),
+        user_id=message.user_id,
+        source=SOURCE_MESSAGE,
+        repetition_at=repetition_at or due_at
+    )
+
+
+def scm_job(scm: SimpleCronMessage, due_at: Optional[datetime] = None, repetition_at: Optional[datetime] = None) -> ReceiverJob:
+    """SCM chỉ có một địa chỉ nhận và không có dòng message_receivers (receiver_id=None)."""
+    return ReceiverJob(
+        message_id=scm.id,
+        receiver_id=None,
+        channel=ReceiverChannelEnum.email,
+        address=scm.receiver_address,
+        subject=scm.title or "CronPost message",
+        html_content=scm.content,
+        sending_method=scm.sending_method,
+        lane=LANE_SCM,
+        due_at=due_at or scm.next_send_at,
+        body_key=('scm', scm.id),
+        user_id=scm.user_id,
+        source=SOURCE_SCM,
+        repetition_at=repetition_at or scm.next_send_at
+    )
+
+
+def expand_receiver_jobs(messages: Iterable[Message], due_at_by_message: Optional[Dict[object, datetime]] = None) -> List[ReceiverJob]:
+    """Mở rộng mỗi tin nhắn thành một job cho từng người nhận (yêu cầu receivers đã được load)."""
+    due_at_by_message = due_at_by_message or {}
+    jobs = []
+    for message in messages:
+        for receiver in message.receivers:
+            if receiver.receiver_channel != ReceiverChannelEnum.email:
+                logger.warning(f"DELIVERY: Channel {receiver.receiver_channel} not supported yet for message_id {message.id}. Skipping receiver.")
+                continue
+            jobs.append(receiver_job(message, receiver, due_at=due_at_by_message.get(message.id)))
+    return jobs
+
+
+def _lease_expired():
+    return func.now() - timedelta(seconds=DELIVERY_LEDGER_LEASE_SECONDS)
+
+
+async def claim_delivery_keys(jobs: List[ReceiverJob]) -> Tuple[Dict[str, int], Dict[str, DeliveryResult]]:
+    """
+    Claim khóa idempotency của các job bằng một INSERT ... ON CONFLICT, commit ngay trong session riêng
+    (trước khi gửi, độc lập với transaction đang khóa lịch của caller).
+    Khóa mới, khóa queued/failed hoặc khóa claimed đã hết lease được claim lại; job của chúng được gửi.
+    Khóa vừa claim có next_retry_at = hết lease: nếu worker chết giữa chừng, lần gửi lại sẽ nhận khóa.
+    Trả về (key đã claim -> số lần claim tính cả lần này, key -> kết quả no-op cho các job không được gửi).
+    """
+    lease_until = func.now() + timedelta(seconds=DELIVERY_LEDGER_LEASE_SECONDS)
+    stmt = (
+        pg_insert(DeliveryLedger)
+        .values([
+            {
+                "idempotency_key": job.idempotency_key, "message_id": job.message_id, "receiver_id": job.receiver_id,
+                "user_id": job.user_id, "source": job.source, "repetition_at": job.repetition_at,
+                "next_retry_at": lease_until
+            }
+            for job in jobs
+        ])
+        .on_conflict_do_update(
+            index_elements=[DeliveryLedger.idempotency_key],
+            set_={
+                "status": DeliveryLedgerStatusEnum.claimed,
+                "attempts": DeliveryLedger.attempts + 1,
+                "claimed_at": func.now(),
+                "completed_at": None,
+                "last_error": None,
+                "next_retry_at": lease_until
+            },
+            where=DeliveryLedger.status.in_(_SENDABLE_STATUSES)
+            | ((DeliveryLedger.status == DeliveryLedgerStatusEnum.claimed) & (DeliveryLedger.claimed_at < _lease_expired()))
+        )
+        .returning(DeliveryLedger.idempotency_key, DeliveryLedger.attempts)
+    )
+    async with AsyncSessionLocal() as ledger_db:
+        claimed: Dict[str, int] = dict((await ledger_db.execute(stmt)).all())
+        skipped = {job.idempotency_key: job for job in jobs if job.idempotency_key not in claimed}
+        # Mặc định: đang được gửi ở nơi khác; worker đó sẽ ghi kết quả (hoặc lease hết hạn và khóa được claim lại)
+        settled: Dict[str, DeliveryResult] = {
+            key: DeliveryResult(job, datetime.now(timezone.utc), "Delivery already in progress elsewhere.", noop=True)
+            for key, job in skipped.items()
+        }
+        if skipped:
+            # Hiếm: chỉ xảy ra khi một batch bị claim lại sau crash
+            already_sent = await ledger_db.execute(
+                select(DeliveryLedger.idempotency_key, DeliveryLedger.completed_at)
+                .where(
+                    DeliveryLedger.idempotency_key.in_(list(skipped)),
+                    DeliveryLedger.status == DeliveryLedgerStatusEnum.sent
+                )
+            )
+            for key, completed_at in already_sent.all():
+                settled[key] = DeliveryResult(skipped[key], completed_at, noop=True)
+            logger.warning(f"DELIVERY: {len(skipped)} job(s) already in the delivery ledger; not sending them again.")
+        await ledger_db.commit()
+    return claimed, settled
+
+
+async def queue_delivery_keys(db: AsyncSession, jobs: List[ReceiverJob], send_after: datetime):
+    """
+    Ghi trước khóa của các job (queued) trong transaction của caller, cùng với thay đổi trạng thái sinh ra
+    chúng. Caller gửi bằng execute_jobs() ngay sau commit; nếu process chết trước đó, dispatcher gửi lại
+    nhận khóa lúc send_after. Khóa đã có được giữ nguyên. Không commit.
+    """
+    if not jobs:
+        return
+    await db.execute(
+        pg_insert(DeliveryLedger)
+        .values([
+            {
+                "idempotency_key": job.idempotency_key, "message_id": job.message_id, "receiver_id": job.receiver_id,
+                "user_id": job.user_id, "source": job.source, "repetition_at": job.repetition_at,
+                "status": DeliveryLedgerStatusEnum.queued, "attempts": 0, "next_retry_at": send_after
+            }
+            for job in jobs
+        ])
+        .on_conflict_do_nothing(index_elements=[DeliveryLedger.idempotency_key])
+    )
+
+
+async def complete_delivery_keys(results: List[DeliveryResult]):
+    """
+    Ghi kết quả (và lần gửi lại nếu có) của các khóa đã claim bằng một UPDATE ... FROM (VALUES ...), commit ngay.
+    Lần gửi bị hoãn (deferred_until) trả lại lượt claim: không tính là một lần thử.
+    """
+    ledger_values = values(
+        column("idempotency_key", Text), column("ledger_status", Text),
+        column("completed_at", DateTime(timezone=True)), column("last_error", Text),
+        column("next_retry_at", DateTime(timezone=True)), column("uncounted", Integer),
+        name="ledger_results"
+    ).data([
+        (
+            result.job.idempotency_key,
+            (DeliveryLedgerStatusEnum.sent if result.ok else DeliveryLedgerStatusEnum.failed).value,
+            result.attempted_at,
+            result.error,
+            result.retry_at,
+            1 if result.deferred_until is not None else 0
+        )
+        for result in results
+    ])
+    async with AsyncSessionLocal() as ledger_db:
+        await ledger_db.execute(
+            update(DeliveryLedger)
+            .where(DeliveryLedger.idempotency_key == ledger_values.c.idempotency_key)
+            .values(
+                status=cast(ledger_values.c.ledger_status, DeliveryLedger.status.type),
+                completed_at=ledger_values.c.completed_at,
+                last_error=ledger_values.c.last_error,
+                next_retry_at=ledger_values.c.next_retry_at,
+                attempts=DeliveryLedger.attempts - ledger_values.c.uncounted
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await ledger_db.commit()
+
+
+def _plan_retry(result: DeliveryResult, attempts: int, policy: RetryPolicy) -> DeliveryResult:
+    """Gắn thời điểm gửi lại cho một lần gửi lỗi còn lượt thử (attempts: số lần claim của khóa)."""
+    if result.ok:
+        return result
+    if result.deferred_until is not None:
+        return result._replace(retry_at=result.deferred_until)
+    return result._replace(retry_at=policy.next_retry_at(attempts, result.attempted_at))
+
+
+async def execute_jobs(
+    jobs: List[ReceiverJob],
+    sender: Optional[Sender] = None,
+    concurrency: int = DELIVERY_CONCURRENCY,
+    retry_policy: RetryPolicy = NO_RETRY
+) -> List[DeliveryResult]:
+    """
+    Gửi các job với số lượng song song giới hạn (trong batch và theo làn của từng job), mỗi job tối đa
+    một lần nhờ delivery ledger. Kết quả giữ thứ tự của jobs; job đã gửi xong trước đó (vd: trước khi
+    worker crash) hoặc đang được gửi ở nơi khác trả về kết quả no-op mà không gửi lại.
+    Job lỗi còn lượt thử theo retry_policy được hẹn gửi lại trong ledger (DeliveryResult.retry_at)
+    và đưa vào timeline; caller không phải tự lên lịch.
+    Lỗi gửi không bao giờ được ném ra; chỉ lỗi khi claim ledger (trước khi gửi bất cứ thứ gì) được ném ra.
+    """
+    if not jobs:
+        return []
+    claimed, settled = await claim_delivery_keys(jobs)
+    to_send = [job for job in jobs if job.idempotency_key in claimed]
+    # Body lớn được mã hóa MIME trong process pool (nếu đã khởi động); lúc gửi chỉ còn I/O
+    await prepare_bodies((job.body_key, job.html_content) for job in to_send if job.body_key)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _run(job: ReceiverJob) -> DeliveryResult:
+        async with semaphore:
+            attempted_at = None
+            try:
+                async with lane_slot(job.lane, job.due_at):
+                    # Thời điểm gửi thật, sau khi đã chờ slot của làn
+                    attempted_at = datetime.now(timezone.utc)
+                    await (sender or _default_sender)(job)
+                return DeliveryResult(job, attempted_at)
+            except SendRateLimited as e:
+                logger.warning(f"DELIVERY: Deferring message_id {job.message_id} to {job.address}: {e}")
+                deferred_at = attempted_at or datetime.now(timezone.utc)
+                return DeliveryResult(job, deferred_at, str(e), deferred_until=deferred_at + timedelta(seconds=e.retry_after))
+            except Exception as e:
+                logger.error(f"DELIVERY: Failed to send message_id {job.message_id} to {job.address}. Error: {e}")
+                return DeliveryResult(job, attempted_at or datetime.now(timezone.utc), str(e) or type(e).__name__)
+
+    sent_results = [
+        _plan_retry(result, claimed[result.job.idempotency_key], retry_policy)
+        for result in await asyncio.gather(*(_run(job) for job in to_send))
+    ]
+    if sent_results:
+        try:
+            await complete_delivery_keys(sent_results)
+        except Exception as e:
+            # Khóa vẫn ở trạng thái claimed: được gửi lại sau khi lease hết hạn (next_retry_at của lần claim)
+            logger.error(f"DELIVERY: Failed to record {len(sent_results)} outcome(s) in the delivery ledger: {e}", exc_info=True)
+            sent_results = [result._replace(retry_at=None) for result in sent_results]
+        for result in sent_results:
+            if result.retry_at is not None:
+                scheduler_timeline.upsert(KIND_RETRY, result.job.idempotency_key, result.retry_at)
+    settled.update((result.job.idempotency_key, result) for result in sent_results)
+    return [settled[job.idempotency_key] for job in jobs]
+
+
+def failed_message_ids(results: Iterable[DeliveryResult]) -> set:
+    """Các tin nhắn mà mọi người nhận đều gửi thất bại và không còn lần gửi lại nào (no-op không phải thất bại)."""
+    delivered_or_retrying, attempted = set(), set()
+    for result in results:
+        attempted.add(result.job.message_id)
+        if result.noop or result.ok or result.retry_at is not None:
+            delivered_or_retrying.add(result.job.message_id)
+    return attempted - delivered_or_retrying
+
+
+async def record_delivery_results(
+    db: AsyncSession,
+    results: List[DeliveryResult],
+    message_statuses: Dict[object, MessageOverallStatusEnum]
+):
+    """
+    Ghi kết quả của một batch bằng ba câu lệnh, không phụ thuộc kích thước batch:
+    một INSERT nhiều dòng vào sending_history, một UPDATE ... FROM (VALUES ...) cho
+    message_receivers và một cho messages.overall_send_status.
+    Người nhận đang chờ gửi lại (retry_at) giữ trạng thái pending; kết quả no-op và lần gửi bị hoãn
+    (chưa thực sự thử gửi, vẫn pending) bị bỏ qua.
+    Không commit; transaction thuộc về caller.
+    """
+    results = [result for result in results if not result.noop and result.deferred_until is None]
+
+    def _attempt_status(result: DeliveryResult) -> SendingAttemptStatusEnum:
+        if result.ok:
+            return SendingAttemptStatusEnum.success
+        return SendingAttemptStatusEnum.retrying if result.retry_at is not None else SendingAttemptStatusEnum.failed
+
+    def _receiver_status(result: DeliveryResult) -> IndividualSendStatusEnum:
+        if result.ok:
+            return IndividualSendStatusEnum.sent
+        return IndividualSendStatusEnum.pending if result.retry_at is not None else IndividualSendStatusEnum.failed
+
+    if results:
+        await db.execute(insert(SendingHistory), [
+            {
+                "message_id": result.job.message_id,
+                "receiver_id": result.job.receiver_id,
+                "sending_method_snapshot": result.job.sending_method,
+                "sent_at": result.attempted_at,
+                "status": _attempt_status(result),
+                "status_details": result.error,
+                "receiver_address_snapshot": result.job.address,
+            }
+            for result in results
+        ])
+
+        receiver_values = values(
+            column("receiver_id", UUID(as_uuid=True)), column("send_status", Text),
+            column("attempted_at", DateTime(timezone=True)), column("failure_reason", Text),
+            name="receiver_results"
+        ).data([
+            (result.job.receiver_id, _receiver_status(result).value, result.attempted_at, result.error)
+            for result in results
+        ])
+        await db.execute(
+            update(MessageReceiver)
+            .where(MessageReceiver.id == receiver_values.c.receiver_id)
+            .values(
+                individual_send_status=cast(receiver_values.c.send_status, MessageReceiver.individual_send_status.type),
+                send_attempts=MessageReceiver.send_attempts + 1,
+                last_attempt_at=receiver_values.c.attempted_at,
+                failure_reason=receiver_values.c.failure_reason
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    if message_statuses:
+        message_values = values(
+            column("message_id", UUID(as_uuid=True)), column("overall_status", Text),
+            name="message_results"
+        ).data([(message_id, status.value) for message_id, status in message_statuses.items()])
+        await db.execute(
+            update(Message)
+            .where(Message.id == message_values.c.message_id)
+            .values(overall_send_status=cast(message_values.c.overall_status, Message.overall_send_status.type))
+            .execution_options(synchronize_session=False)
+        )
+
+
+# Dựng lại job cho các khóa đến hạn gửi lại của một nguồn: (db, các dòng ledger) -> job còn cần gửi.
+# Dòng không có job tương ứng (tin nhắn đã hủy/xóa, cửa sổ WCT đã đóng...) bị bỏ, không gửi lại nữa.
+RetryBuilder = Callable[[AsyncSession, List[DeliveryLedger]], Awaitable[List[ReceiverJob]]]
+_retry_builders: Dict[str, RetryBuilder] = {}
+
+
+def register_retry_builder(source: str, builder: RetryBuilder):
+    _retry_builders[source] = builder
+
+
+async def claim_due_retries(db: AsyncSession, now_utc: datetime, batch_size: int) -> Tuple[int, List[ReceiverJob]]:
+    """
+    Nhận tối đa batch_size khóa đã đến hạn gửi lại (cả khóa claimed của worker đã chết) bằng cách dời
+    next_retry_at của chúng tới hết lease, rồi dựng lại job qua retry builder của từng nguồn.
+    Commit trước khi trả về (không giữ khóa dòng trong lúc gửi). Trả về (số khóa đã nhận, job cần gửi).
+    """
+    due = (
+        select(DeliveryLedger.idempotency_key, DeliveryLedger.next_retry_at)
+        .where(
+            DeliveryLedger.next_retry_at <= now_utc,
+            or_(
+                DeliveryLedger.status.in_(_SENDABLE_STATUSES),
+                (DeliveryLedger.status == DeliveryLedgerStatusEnum.claimed) & (DeliveryLedger.claimed_at < _lease_expired())
+            ),
+            owned_by_this_worker(DeliveryLedger.user_id)
+        )
+        .order_by(DeliveryLedger.next_retry_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .cte("due_retries")
+    )
+    stmt = (
+        update(DeliveryLedger)
+        .where(DeliveryLedger.idempotency_key == due.c.idempotency_key)
+        .values(next_retry_at=now_utc + timedelta(seconds=DELIVERY_LEDGER_LEASE_SECONDS))
+        .returning(
+            DeliveryLedger.idempotency_key, DeliveryLedger.source, DeliveryLedger.message_id, DeliveryLedger.receiver_id,
+            DeliveryLedger.user_id, DeliveryLedger.repetition_at, due.c.next_retry_at
+        )
+        .execution_options(synchronize_session=False)
+    )
+    entries = (await db.execute(stmt)).all()
+    by_source: Dict[str, List] = {}
+    for entry in entries:
+        by_source.setdefault(entry.source, []).append(entry)
+
+    jobs: List[ReceiverJob] = []
+    for source, source_entries in by_source.items():
+        builder = _retry_builders.get(source)
+        if builder is None:
+            logger.error(f"DELIVERY: No retry builder registered for source '{source}'; dropping {len(source_entries)} retry(ies).")
+            continue
+        jobs.extend(await builder(db, source_entries))
+
+    # Khóa không dựng lại được job thì không gửi lại nữa (giữ trạng thái failed để tra cứu)
+    claimed_keys = {entry.idempotency_key for entry in entries}
+    dropped = claimed_keys - {job.idempotency_key for job in jobs}
+    if dropped:
+        await db.execute(
+            update(DeliveryLedger)
+            .where(DeliveryLedger.idempotency_key.in_(list(dropped)))
+            .values(next_retry_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        logger.info(f"DELIVERY: Dropped {len(dropped)} retry(ies) that are no longer deliverable.")
+    await db.commit()
+    return len(entries), [job for job in jobs if job.idempotency_key in claimed_keys]
+
+
+async def _message_retry_jobs(db: AsyncSession, entries: List) -> List[ReceiverJob]:
+    """Người nhận của tin nhắn chưa bị hủy."""
+    stmt = (
+        select(MessageReceiver, Message)
+        .join(Message, Message.id == MessageReceiver.message_id)
+        .where(
+            MessageReceiver.id.in_([entry.receiver_id for entry in entries]),
+            Message.overall_send_status != MessageOverallStatusEnum.cancelled
+        )
+    )
+    receivers = {receiver.id: (message, receiver) for receiver, message in (await db.execute(stmt)).all()}
+    return [
+        receiver_job(*receivers[entry.receiver_id], due_at=entry.next_retry_at, repetition_at=entry.repetition_at)
+        for entry in entries if entry.receiver_id in receivers
+    ]
+
+
+async def _scm_retry_jobs(db: AsyncSession, entries: List) -> List[ReceiverJob]:
+    """SCM còn tồn tại (lần lặp cuối vẫn được gửi lại dù SCM đã chuyển sang inactive)."""
+    stmt = select(SimpleCronMessage).where(
+        SimpleCronMessage.id.in_([entry.message_id for entry in entries]),
+        SimpleCronMessage.sending_method != SendingMethodEnum.in_app_messaging
+    )
+    scms = {scm.id: scm for scm in (await db.execute(stmt)).scalars().all()}
+    return [
+        scm_job(scms[entry.message_id], due_at=entry.next_retry_at, repetition_at=entry.repetition_at)
+        for entry in entries if entry.message_id in scms
+    ]
+
+
+async def mark_exhausted_messages_failed(db: AsyncSession, message_ids: Iterable):
+    """Tin nhắn không còn người nhận nào đã gửi được hoặc đang chờ gửi lại -> failed."""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    still_deliverable = exists().where(
+        MessageReceiver.message_id == Message.id,
+        MessageReceiver.receiver_channel == ReceiverChannelEnum.email,
+        MessageReceiver.individual_send_status != IndividualSendStatusEnum.failed
+    )
+    await db.execute(
+        update(Message)
+        .where(Message.id.in_(message_ids), ~still_deliverable)
+        .values(overall_send_status=MessageOverallStatusEnum.failed)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def settle_initial_messages(db: AsyncSession, message_ids: Iterable):
+    """
+    IM đang 'processing' mà mọi khóa trong ledger đã xong (không còn khóa queued/claimed hay chờ gửi lại,
+    tức next_retry_at IS NULL) -> sent nếu có người nhận đã nhận được, ngược lại failed
+    (kể cả IM không có người nhận email nào). IM còn khóa chưa xong giữ nguyên 'processing'. Không commit.
+    """
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    unsettled = exists().where(DeliveryLedger.message_id == Message.id, DeliveryLedger.next_retry_at.is_not(None))
+    delivered = exists().where(
+        DeliveryLedger.message_id == Message.id, DeliveryLedger.status == DeliveryLedgerStatusEnum.sent
+    )
+    await db.execute(
+        update(Message)
+        .where(
+            Message.id.in_(message_ids),
+            Message.is_initial_message.is_(True),
+            Message.overall_send_status == MessageOverallStatusEnum.processing,
+            ~unsettled
+        )
+        .values(overall_send_status=cast(
+            case((delivered, MessageOverallStatusEnum.sent.value), else_=MessageOverallStatusEnum.failed.value),
+            Message.overall_send_status.type
+        ))
+        .execution_options(synchronize_session=False)
+    )
+
+
+register_retry_builder(SOURCE_MESSAGE, _message_retry_jobs)
+register_retry_builder(SOURCE_SCM, _scm_retry_jobs)
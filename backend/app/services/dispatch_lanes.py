@@ -0,0 +1,208 @@
+# backend/app/services/dispatch_lanes.py
+# NEW FILE
+# Version: 1.0.0
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Deque, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Các làn gửi, theo thứ tự ưu tiên giảm dần
+LANE_FNS = 'fns'                    # IM/FM phát hành khi user vào FNS (và các lần gửi lại của chúng)
+LANE_WCT_REMINDER = 'wct_reminder'  # Email nhắc check-in trong cửa sổ WCT
+LANE_FM = 'fm'                      # FM lặp lại theo lịch
+LANE_SCM = 'scm'                    # Simple Cron Message
+LANE_ORDER = [LANE_FNS, LANE_WCT_REMINDER, LANE_FM, LANE_SCM]
+
+# Tổng số lần gửi đang chạy của process, chia sẻ giữa các làn
+DISPATCH_LANE_TOTAL_CONCURRENCY = int(os.environ.get("DISPATCH_LANE_TOTAL_CONCURRENCY", "40"))
+# Số mẫu độ trễ gần nhất giữ lại cho mỗi làn
+DISPATCH_LANE_LAG_SAMPLES = 1024
+
+
+class LaneConfig(NamedTuple):
+    # Tỷ trọng khi các làn tranh nhau slot trống
+    weight: int
+    # Số lần gửi đang chạy tối đa của làn (giữ chỗ cho các làn khác)
+    concurrency: int
+    # Số lần gửi tối đa mỗi giây, 0 = không giới hạn
+    rate_per_second: float
+
+
+def _lane_config(lane: str, weight: int, concurrency: int, rate_per_second: float = 0) -> LaneConfig:
+    """Mặc định có thể ghi đè bằng DISPATCH_LANE_<LANE>_WEIGHT / _CONCURRENCY / _RATE_PER_SECOND."""
+    prefix = f"DISPATCH_LANE_{lane.upper()}_"
+    return LaneConfig(
+        weight=max(1, int(os.environ.get(prefix + "WEIGHT", weight))),
+        concurrency=max(1, int(os.environ.get(prefix + "CONCURRENCY", concurrency))),
+        rate_per_second=max(0.0, float(os.environ.get(prefix + "RATE_PER_SECOND", rate_per_second)))
+    )
+
+
+# SCM bị giới hạn dưới tổng concurrency nên một đợt SCM dồn dập luôn chừa slot cho FNS/WCT
+LANE_CONFIGS: Dict[str, LaneConfig] = {
+    LANE_FNS: _lane_config(LANE_FNS, weight=8, concurrency=DISPATCH_LANE_TOTAL_CONCURRENCY),
+    LANE_WCT_REMINDER: _lane_config(LANE_WCT_REMINDER, weight=4, concurrency=DISPATCH_LANE_TOTAL_CONCURRENCY),
+    LANE_FM: _lane_config(LANE_FM, weight=2, concurrency=max(1, DISPATCH_LANE_TOTAL_CONCURRENCY * 3 // 4)),
+    LANE_SCM: _lane_config(LANE_SCM, weight=1, concurrency=max(1, DISPATCH_LANE_TOTAL_CONCURRENCY // 4)),
+}
+
+
+class _Lane:
+    def __init__(self, name: str, config: LaneConfig):
+        self.name = name
+        self.config = config
+        # (future, thời điểm xếp hàng, thời điểm đến hạn)
+        self.waiters: Deque[Tuple[asyncio.Future, datetime, Optional[datetime]]] = deque()
+        self.in_flight = 0
+        # Virtual finish time của lần gửi gần nhất (start-time fair queueing)
+        self.virtual_time = 0.0
+        self.tokens = max(1.0, config.rate_per_second)
+        self.refilled_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.lags: Deque[float] = deque(maxlen=DISPATCH_LANE_LAG_SAMPLES)
+
+    def _refill(self, now: float):
+        if self.config.rate_per_second:
+            capacity = max(1.0, self.config.rate_per_second)
+            self.tokens = min(capacity, self.tokens + (now - self.refilled_at) * self.config.rate_per_second)
+        self.refilled_at = now
+
+    def seconds_until_token(self, now: float) -> float:
+        """0 nếu làn được gửi ngay, ngược lại là thời gian chờ token kế tiếp."""
+        if not self.config.rate_per_second:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.config.rate_per_second
+
+    def take_token(self):
+        if self.config.rate_per_second:
+            self.tokens -= 1
+
+
+class LaneScheduler:
+    """
+    Chia DISPATCH_LANE_TOTAL_CONCURRENCY slot gửi giữa các làn ưu tiên.
+    Khi có slot trống, làn được chọn là làn có virtual time nhỏ nhất trong số các làn
+    còn việc, chưa chạm concurrency của làn và còn token: mỗi lần gửi đẩy virtual time của làn
+    thêm 1/weight, nên khi tranh nhau các làn nhận slot theo tỷ lệ weight (FNS 8 : WCT 4 : FM 2 : SCM 1),
+    còn khi chỉ một làn có việc thì làn đó dùng được toàn bộ concurrency của nó.
+    """
+    def __init__(self, configs: Dict[str, LaneConfig], total_concurrency: int):
+        self._lanes = {name: _Lane(name, config) for name, config in configs.items()}
+        self.total_concurrency = total_concurrency
+        self._in_flight = 0
+        self._virtual_time = 0.0
+        self._rate_timer: Optional[asyncio.TimerHandle] = None
+
+    def _lane(self, name: str) -> _Lane:
+        lane = self._lanes.get(name)
+        if lane is None:
+            raise ValueError(f"Unknown dispatch lane '{name}'.")
+        return lane
+
+    def _grant(self):
+        """Trao slot trống cho các waiter theo weighted fair queueing."""
+        while self._in_flight < self.total_concurrency:
+            now = time.monotonic()
+            candidates = []
+            rate_wait: Optional[float] = None
+            for lane in self._lanes.values():
+                while lane.waiters and lane.waiters[0][0].done():
+                    lane.waiters.popleft() # Waiter đã bị hủy
+                if not lane.waiters or lane.in_flight >= lane.config.concurrency:
+                    continue
+                wait_seconds = lane.seconds_until_token(now)
+                if wait_seconds:
+                    rate_wait = wait_seconds if rate_wait is None else min(rate_wait, wait_seconds)
+                    continue
+                candidates.append(lane)
+            if not candidates:
+                if rate_wait is not None and self._rate_timer is None:
+                    self._rate_timer = asyncio.get_running_loop().call_later(rate_wait, self._on_rate_timer)
+                return
+
+            # Làn vừa rảnh không được dùng virtual time cũ để "đòi lại" phần đã bỏ lỡ
+            lane = min(candidates, key=lambda candidate: (max(candidate.virtual_time, self._virtual_time), -candidate.config.weight))
+            start = max(lane.virtual_time, self._virtual_time)
+            self._virtual_time = start
+            lane.virtual_time = start + 1 / lane.config.weight
+
+            future, queued_at, due_at = lane.waiters.popleft()
+            lane.take_token()
+            lane.in_flight += 1
+            self._in_flight += 1
+            lane.lags.append((datetime.now(timezone.utc) - (due_at or queued_at)).total_seconds())
+            future.set_result(None)
+
+    def _on_rate_timer(self):
+        self._rate_timer = None
+        self._grant()
+
+    def _release(self, lane: _Lane):
+        lane.in_flight -= 1
+        self._in_flight -= 1
+        self._grant()
+
+    @asynccontextmanager
+    async def slot(self, lane_name: str, due_at: Optional[datetime] = None):
+        """
+        Giữ một slot gửi của làn trong suốt khối lệnh. due_at (nếu có) là thời điểm đến hạn
+        theo lịch, dùng để đo độ trễ; mặc định đo từ lúc xếp hàng.
+        """
+        lane = self._lane(lane_name)
+        future = asyncio.get_running_loop().create_future()
+        lane.waiters.append((future, datetime.now(timezone.utc), due_at))
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot đã được trao đúng lúc bị hủy: trả lại cho waiter khác
+                self._release(lane)
+            raise
+        try:
+            yield
+            lane.sent += 1
+        except Exception:
+            lane.failed += 1
+            raise
+        finally:
+            self._release(lane)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Số liệu theo làn (độ trễ tính bằng giây) để ghi kèm heartbeat và hiển thị cho admin."""
+        now_utc = datetime.now(timezone.utc)
+        metrics = {}
+        for name, lane in self._lanes.items():
+            lags = sorted(lane.lags)
+            queued = [queued_at for future, queued_at, _ in lane.waiters if not future.done()]
+            metrics[name] = {
+                "weight": lane.config.weight,
+                "concurrency": lane.config.concurrency,
+                "rate_per_second": lane.config.rate_per_second,
+                "queued": len(queued),
+                "in_flight": lane.in_flight,
+                "sent": lane.sent,
+                "failed": lane.failed,
+                "oldest_queued_seconds": (now_utc - min(queued)).total_seconds() if queued else 0.0,
+                "lag_p50_seconds": lags[len(lags) // 2] if lags else None,
+                "lag_p99_seconds": lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else None,
+                "lag_max_seconds": lags[-1] if lags else None,
+            }
+        return metrics
+
+
+# Instance duy nhất cho toàn bộ process
+lane_scheduler = LaneScheduler(LANE_CONFIGS, DISPATCH_LANE_TOTAL_CONCURRENCY)
+
+
+def lane_slot(lane: str, due_at: Optional[datetime] = None):
+    return lane_scheduler.slot(lane, due_at)
@@ -1,16 +1,35 @@
 # backend/app/services/email_service.py
-# Version: 3.1 (Add User SMTP connection testing)
+# Version: 3.10
+# Changelog:
+# - build_html_part moved to mime_parts (importable by prepare_pool's processes without the app).
+# - Only scheduled dispatch takes send-rate tokens (rate_limited=True); transactional mail such as signup,
+#   PIN and password reset is never limited.
+# - Email templates are precompiled at startup into a registry with an on-disk bytecode cache; auto-reload is opt-in.
+# - Added send_user_html_email_async: sends through the user's own SMTP transport when configured.
+# - Async sends take a token from the transport's cluster-wide rate limit bucket first.
+# - Async sends use aiosmtplib on the event loop; smtplib in the threadpool is the fallback.
+# - System emails are sent over pooled, authenticated SMTP connections.
+# - send_html_email_async accepts a prebuilt, shareable MIME body part.
+# - Add send_html_email_async for the message dispatcher.
 
 import os
 import logging
 import smtplib
 import socket
+import tempfile
 
-from typing import Dict, Any
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from fastapi.concurrency import run_in_threadpool
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, Template
+
+from .mime_parts import build_html_part
+from .smtp_pool import get_smtp_pool
+from .smtp_async import get_async_smtp_pool, SMTP_ASYNC_ENABLED
+from .send_rate_limiter import acquire_send_token, SYSTEM_SMTP_BUCKET, user_smtp_bucket
+from .user_smtp_transport import get_user_smtp_transport
 
 logger = logging.getLogger(__name__)
 
@@ -21,37 +40,91 @@ MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
 MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
 MAIL_FROM = os.environ.get("MAIL_FROM")
 TEMPLATE_FOLDER = os.environ.get("TEMPLATE_FOLDER", "app/templates/email")
+# Chỉ bật khi phát triển: kiểm tra (stat) file template ở mỗi lần lấy và nạp lại nếu đã sửa
+EMAIL_TEMPLATES_AUTO_RELOAD = os.environ.get("EMAIL_TEMPLATES_AUTO_RELOAD", "false").lower() == "true"
+# Thư mục lưu bytecode đã biên dịch của template (lần khởi động sau không phải parse lại), rỗng = tắt
+EMAIL_TEMPLATE_BYTECODE_DIR = os.environ.get("EMAIL_TEMPLATE_BYTECODE_DIR", os.path.join(tempfile.gettempdir(), "cronpost-email-templates"))
+
+
+def _bytecode_cache() -> Optional[FileSystemBytecodeCache]:
+    if not EMAIL_TEMPLATE_BYTECODE_DIR:
+        return None
+    try:
+        os.makedirs(EMAIL_TEMPLATE_BYTECODE_DIR, exist_ok=True)
+        return FileSystemBytecodeCache(EMAIL_TEMPLATE_BYTECODE_DIR)
+    except OSError as e:
+        logger.warning(f"Email template bytecode cache disabled ({EMAIL_TEMPLATE_BYTECODE_DIR}): {e}")
+        return None
+
 
 # Thiết lập môi trường Jinja2
 try:
-    env = Environment(loader=FileSystemLoader(TEMPLATE_FOLDER))
+    env = Environment(
+        loader=FileSystemLoader(TEMPLATE_FOLDER),
+        auto_reload=EMAIL_TEMPLATES_AUTO_RELOAD,
+        bytecode_cache=_bytecode_cache(),
+        # Không giới hạn: mọi template email luôn nằm trong cache của environment
+        cache_size=-1
+    )
 except Exception as e:
     logger.error(f"Failed to initialize Jinja2 environment: {e}")
     env = None
 
-def send_email_sync(subject: str, email_to: str, html_content: str):
+# Tên template -> Template đã biên dịch; được thay cả khối bởi precompile_email_templates() và không sửa sau đó
+_templates: Mapping[str, Template] = MappingProxyType({})
+
+
+def precompile_email_templates() -> int:
     """
-    Hàm đồng bộ để gửi email, sẽ được chạy trong một thread riêng.
+    Biên dịch trước mọi template email (gọi khi khởi động). Bytecode được đọc/ghi qua bytecode cache
+    nên các lần khởi động sau bỏ qua bước parse. Trả về số template đã nạp.
     """
-    if not all([MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD, MAIL_FROM]):
+    global _templates
+    if not env:
+        return 0
+    templates = {}
+    for name in env.list_templates(extensions=["html"]):
+        try:
+            templates[name] = env.get_template(name)
+        except Exception as e:
+            logger.error(f"Failed to compile email template '{name}': {e}", exc_info=True)
+    _templates = MappingProxyType(templates)
+    logger.info(f"Precompiled {len(templates)} email template(s) from {TEMPLATE_FOLDER}.")
+    return len(templates)
+
+
+def get_email_template(template_name: str) -> Template:
+    """Template đã biên dịch sẵn; EMAIL_TEMPLATES_AUTO_RELOAD=true thì qua environment để nhận bản đã sửa."""
+    template = None if EMAIL_TEMPLATES_AUTO_RELOAD else _templates.get(template_name)
+    return template if template is not None else env.get_template(template_name)
+
+
+def _build_message(
+    subject: str, email_to: str, html_content: str, body_part: Optional[MIMEText], mail_from: Optional[str] = None
+) -> MIMEMultipart:
+    """mail_from=None: gửi từ SMTP hệ thống (MAIL_FROM), yêu cầu cấu hình mail server đầy đủ."""
+    if mail_from is None and not all([MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD, MAIL_FROM]):
         logger.error("Mail server settings are incomplete. Email not sent.")
-        return
+        # Ném lỗi để worker không ghi nhận nhầm là đã gửi thành công
+        raise RuntimeError("Mail server settings are incomplete.")
 
     msg = MIMEMultipart()
-    msg['From'] = MAIL_FROM
+    msg['From'] = mail_from or MAIL_FROM
     msg['To'] = email_to
     msg['Subject'] = subject
-    msg.attach(MIMEText(html_content, 'html'))
+    msg.attach(body_part if body_part is not None else build_html_part(html_content))
+    return msg
 
+def send_email_sync(subject: str, email_to: str, html_content: str, body_part: Optional[MIMEText] = None):
+    """
+    Hàm đồng bộ để gửi email, sẽ được chạy trong một thread riêng.
+    body_part (nếu có) là body đã dựng sẵn bằng build_html_part và được dùng thay cho html_content.
+    """
+    msg = _build_message(subject, email_to, html_content, body_part)
     try:
-        logger.info(f"Connecting to SMTP server {MAIL_SERVER}:{MAIL_PORT}...")
-        with smtplib.SMTP_SSL(MAIL_SERVER, MAIL_PORT, timeout=30) as server:
-            # server.set_debuglevel(1) # Bỏ comment nếu cần debug chi tiết
-            logger.info("Logging in...")
-            server.login(MAIL_USERNAME, MAIL_PASSWORD)
-            logger.info("Sending email...")
-            server.send_message(msg)
-            logger.info(f"Email successfully sent to {email_to}")
+        # Dùng lại phiên SMTP đã TLS + login từ pool thay vì bắt tay lại cho mỗi email
+        get_smtp_pool(MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD).send_message(msg)
+        logger.info(f"Email successfully sent to {email_to}")
     except Exception as e:
         logger.error(f"Failed to send email using smtplib to {email_to}. Error: {e}", exc_info=True)
         raise e
@@ -63,7 +136,7 @@ async def send_email_async(
     template_name: str
 ):
     """
-    Hàm bất đồng bộ, render template và gọi hàm gửi email đồng bộ trong threadpool.
+    Hàm bất đồng bộ, render template rồi gửi bằng send_html_email_async.
     """
     if not env:
         logger.error(f"Jinja2 environment not available. Cannot send email to {email_to}")
@@ -71,12 +144,58 @@ async def send_email_async(
         
     logger.info(f"Preparing to send email to {email_to} with subject '{subject}'")
     try:
-        template = env.get_template(template_name)
-        html_content = template.render(**body)
-        await run_in_threadpool(send_email_sync, subject=subject, email_to=email_to, html_content=html_content)
+        html_content = get_email_template(template_name).render(**body)
+        await send_html_email_async(subject=subject, email_to=email_to, html_content=html_content)
     except Exception as e:
         logger.error(f"Error in async email preparation for {email_to}. Error: {e}", exc_info=True)
 
+async def send_html_email_async(
+    subject: str, email_to: str, html_content: str, body_part: Optional[MIMEText] = None, rate_limited: bool = False
+):
+    """
+    Gửi một email có nội dung HTML đã được chuẩn bị sẵn (không qua template).
+    Khác với send_email_async, lỗi được ném ra để worker ghi nhận thất bại.
+    Mặc định gửi bằng aiosmtplib ngay trên event loop (không giữ thread trong lúc chờ mạng);
+    SMTP_TRANSPORT=threadpool hoặc thiếu aiosmtplib thì dùng send_email_sync trong threadpool.
+    rate_limited=True (gửi theo lịch): trước khi gửi, chờ token của SMTP hệ thống (email_sending_rate_per_hours);
+    chờ quá lâu thì ném SendRateLimited. Email giao dịch (send_email_async) không bị giới hạn.
+    """
+    if rate_limited:
+        await acquire_send_token(SYSTEM_SMTP_BUCKET)
+    if not SMTP_ASYNC_ENABLED:
+        await run_in_threadpool(send_email_sync, subject=subject, email_to=email_to, html_content=html_content, body_part=body_part)
+        return
+    msg = _build_message(subject, email_to, html_content, body_part)
+    try:
+        pool = await get_async_smtp_pool(MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD)
+        await pool.send_message(msg)
+        logger.info(f"Email successfully sent to {email_to}")
+    except Exception as e:
+        logger.error(f"Failed to send email using aiosmtplib to {email_to}. Error: {e}", exc_info=True)
+        raise
+
+async def send_user_html_email_async(
+    user_id, subject: str, email_to: str, html_content: str, body_part: Optional[MIMEText] = None, rate_limited: bool = False
+) -> bool:
+    """
+    Như send_html_email_async nhưng gửi qua SMTP riêng của user (UserSmtpSettings đang bật), dùng lại
+    phiên đã đăng nhập và mật khẩu đã giải mã từ cache. Trả về False (chưa gửi) nếu user không có
+    SMTP riêng đang bật, để caller gửi qua SMTP hệ thống. rate_limited=True thì chờ token của bucket riêng của user.
+    """
+    transport = await get_user_smtp_transport(user_id)
+    if transport is None:
+        return False
+    if rate_limited:
+        await acquire_send_token(user_smtp_bucket(user_id))
+    msg = _build_message(subject, email_to, html_content, body_part, mail_from=transport.sender_email)
+    try:
+        await transport.send_message(msg)
+        logger.info(f"Email successfully sent to {email_to} via the SMTP server of user {user_id}")
+    except Exception as e:
+        logger.error(f"Failed to send email via the SMTP server of user {user_id} to {email_to}. Error: {e}", exc_info=True)
+        raise
+    return True
+
 # TESTING USER SMTP CONNECTION
 
 def _test_smtp_connection_sync(server: str, port: int, username: str, password: str) -> (bool, str):
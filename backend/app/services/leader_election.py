@@ -0,0 +1,96 @@
+# backend/app/services/leader_election.py
+# NEW FILE
+# Version: 1.0.0
+
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict
+
+from sqlalchemy import select, func, literal
+
+from ..db.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Khóa advisory dùng dạng hai khóa (namespace, hashtext(job_name)) để không đụng khóa của ứng dụng khác
+LEADER_LOCK_NAMESPACE = 0x43524F4E # 'CRON'
+# Chu kỳ kiểm tra kết nối giữ khóa (gia hạn lease) và thời gian chờ tối đa cho mỗi lần kiểm tra
+LEADER_LEASE_RENEW_SECONDS = int(os.environ.get("LEADER_LEASE_RENEW_SECONDS", "10"))
+LEADER_LEASE_TIMEOUT_SECONDS = int(os.environ.get("LEADER_LEASE_TIMEOUT_SECONDS", "5"))
+# Chu kỳ các instance không phải leader thử giành khóa
+LEADER_RETRY_SECONDS = int(os.environ.get("LEADER_RETRY_SECONDS", "15"))
+
+SingletonJob = Callable[[], Awaitable[None]]
+
+_singleton_jobs: Dict[str, SingletonJob] = {}
+
+
+def register_singleton_job(name: str, job: SingletonJob):
+    """Đăng ký job chỉ được chạy ở đúng một instance (instance đang giữ khóa của job)."""
+    _singleton_jobs[name] = job
+
+
+def _lock_args(name: str):
+    return literal(LEADER_LOCK_NAMESPACE), func.hashtext(name)
+
+
+async def _lead(conn, name: str, job: SingletonJob):
+    """
+    Chạy job khi đang giữ khóa. Khóa advisory gắn với session Postgres nên lease được
+    "gia hạn" bằng cách kiểm tra định kỳ rằng kết nối vẫn sống: nếu kết nối chết,
+    Postgres tự nhả khóa cho instance khác và job ở đây bị hủy ngay.
+    """
+    job_task = asyncio.create_task(job())
+    try:
+        while True:
+            await asyncio.wait({job_task}, timeout=LEADER_LEASE_RENEW_SECONDS)
+            if job_task.done():
+                job_task.result()
+                logger.warning(f"LEADER: Singleton job '{name}' returned; releasing leadership.")
+                return
+            await asyncio.wait_for(conn.execute(select(literal(1))), timeout=LEADER_LEASE_TIMEOUT_SECONDS)
+    finally:
+        if not job_task.done():
+            job_task.cancel()
+            await asyncio.gather(job_task, return_exceptions=True)
+
+
+async def run_as_leader(name: str, job: SingletonJob):
+    """
+    Vòng lặp bầu leader cho một job: thử pg_try_advisory_lock trên một kết nối riêng,
+    giành được thì chạy job, không thì chờ LEADER_RETRY_SECONDS rồi thử lại (failover).
+    """
+    if engine is None:
+        logger.error(f"LEADER: Database engine is not available. Singleton job '{name}' will not run.")
+        return
+
+    while True:
+        try:
+            async with engine.connect() as pooled_conn:
+                # AUTOCOMMIT: giữ khóa cấp session mà không giữ transaction mở suốt thời gian làm leader
+                conn = await pooled_conn.execution_options(isolation_level="AUTOCOMMIT")
+                acquired = (await conn.execute(select(func.pg_try_advisory_lock(*_lock_args(name))))).scalar()
+                if acquired:
+                    logger.info(f"LEADER: This instance is now leader for '{name}'.")
+                    try:
+                        await _lead(conn, name, job)
+                    finally:
+                        # Nhả khóa trước khi trả kết nối về pool, nếu không khóa sẽ đi theo kết nối
+                        try:
+                            await asyncio.shield(conn.execute(select(func.pg_advisory_unlock(*_lock_args(name)))))
+                        except Exception as e:
+                            logger.warning(f"LEADER: Could not release lock for '{name}', invalidating connection: {e}")
+                            await conn.invalidate()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"LEADER: Lost or could not acquire leadership for '{name}': {e}", exc_info=True)
+        await asyncio.sleep(LEADER_RETRY_SECONDS)
+
+
+async def run_singleton_jobs():
+    """Chạy bầu leader cho mọi job đã đăng ký; mỗi job có khóa riêng nên có thể có leader khác nhau."""
+    if not _singleton_jobs:
+        return
+    await asyncio.gather(*(run_as_leader(name, job) for name, job in _singleton_jobs.items()))
@@ -0,0 +1,28 @@
+# backend/app/services/mime_parts.py
+# NEW FILE
+# Version: 1.0.0
+# Dựng phần MIME của body email. Module này không import gì khác của app, nên việc unpickle các hàm
+# chạy trong process con của prepare_pool không kéo theo DB, SMTP hay scheduler.
+
+import signal
+from email.mime.text import MIMEText
+from typing import List
+
+
+def build_html_part(html_content: str) -> MIMEText:
+    """Phần body HTML đã mã hóa MIME; có thể dùng chung cho nhiều email (render_cache)."""
+    return MIMEText(html_content, 'html')
+
+
+def build_html_parts(sources: List[str]) -> List[MIMEText]:
+    """Chạy trong process con của prepare_pool: dựng phần MIME cho cả chunk (kết quả được pickle về process chính)."""
+    return [build_html_part(source) for source in sources]
+
+
+def init_prepare_worker():
+    """Initializer của process con: bỏ qua SIGINT, để process chính tự dừng pool khi tắt."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def ping() -> bool:
+    return True
@@ -0,0 +1,98 @@
+# backend/app/services/prepare_pool.py
+# NEW FILE
+# Version: 1.0.0
+# Process pool chuẩn bị body email lớn (mã hóa MIME) ngoài event loop. Chỉ scheduler worker
+# (python -m app.scheduler_main) khởi động pool; process không khởi động pool (API) dựng body ngay
+# khi gửi như bình thường (render_cache).
+
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+from .mime_parts import build_html_parts, init_prepare_worker, ping
+from .render_cache import render_cache
+
+logger = logging.getLogger(__name__)
+
+# Số process chuẩn bị body email, 0 = tắt (chuẩn bị trong process)
+DELIVERY_PREPARE_PROCESSES = int(os.environ.get("DELIVERY_PREPARE_PROCESSES", "2"))
+# Body ngắn hơn ngưỡng này được chuẩn bị ngay trong process: chi phí IPC lớn hơn phần tiết kiệm được
+DELIVERY_PREPARE_MIN_CHARS = int(os.environ.get("DELIVERY_PREPARE_MIN_CHARS", "8192"))
+# Số body gửi sang process con trong một lần (giảm số lượt IPC)
+DELIVERY_PREPARE_CHUNK_SIZE = int(os.environ.get("DELIVERY_PREPARE_CHUNK_SIZE", "16"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+async def start_prepare_pool(processes: int = DELIVERY_PREPARE_PROCESSES):
+    """
+    Khởi động pool (spawn: process con không thừa hưởng event loop, kết nối DB hay socket SMTP) và chờ
+    mọi process con sẵn sàng, để chi phí khởi động không rơi vào lượt gửi đầu tiên.
+    Chỉ gọi từ process chính, sau khi đã import xong (không gọi lúc import module): process con spawn nạp lại
+    module chính dưới tên __mp_main__, nên việc khởi động pool phải nằm sau if __name__ == "__main__".
+    """
+    global _pool
+    if _pool is not None or processes <= 0:
+        return
+    pool = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_prepare_worker
+    )
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(loop.run_in_executor(pool, ping) for _ in range(processes)))
+    except Exception as e:
+        logger.error(f"PREPARE_POOL: Could not start the process pool; bodies are prepared in-process: {e}", exc_info=True)
+        pool.shutdown(wait=False, cancel_futures=True)
+        return
+    _pool = pool
+    logger.info(f"PREPARE_POOL: Started {processes} process(es) for delivery preparation.")
+
+
+def shutdown_prepare_pool():
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def prepare_bodies(bodies: Iterable[Tuple[Hashable, str]]):
+    """
+    Chuẩn bị trước các body (key, source) lớn chưa có trong render_cache bằng process pool, theo từng chunk,
+    rồi đưa vào cache để lúc gửi chỉ còn I/O. Body nhỏ, hoặc khi pool chưa được khởi động/bị hỏng,
+    được để lại cho render_cache dựng lúc gửi.
+    """
+    pool = _pool
+    if pool is None:
+        return
+    pending: Dict[Hashable, str] = {}
+    for key, source in bodies:
+        if key not in pending and len(source) >= DELIVERY_PREPARE_MIN_CHARS and not render_cache.contains(key, source):
+            pending[key] = source
+    if not pending:
+        return
+
+    keys = list(pending)
+    chunks = [keys[start:start + DELIVERY_PREPARE_CHUNK_SIZE] for start in range(0, len(keys), DELIVERY_PREPARE_CHUNK_SIZE)]
+    loop = asyncio.get_running_loop()
+    try:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, build_html_parts, [pending[key] for key in chunk]) for chunk in chunks
+        ))
+    except BrokenProcessPool as e:
+        logger.error(f"PREPARE_POOL: Process pool is broken; this batch is prepared in-process and the pool is restarted: {e}")
+        shutdown_prepare_pool()
+        # Chỉ process đã khởi động pool mới tới được đây, nên khởi động lại vẫn ở đúng process đó
+        asyncio.get_running_loop().create_task(start_prepare_pool())
+        return
+    except Exception as e:
+        logger.error(f"PREPARE_POOL: Failed to prepare {len(keys)} body(ies) in the process pool: {e}", exc_info=True)
+        return
+    for chunk, parts in zip(chunks, results):
+        for key, part in zip(chunk, parts):
+            render_cache.store(key, pending[key], part)
@@ -0,0 +1,95 @@
+# backend/app/services/render_cache.py
+# NEW FILE
+# Version: 1.1.0
+# Changelog:
+# - Split get_or_build() into contains()/lookup()/store() so bodies can be prepared ahead (prepare_pool).
+
+import os
+import logging
+from collections import OrderedDict
+from email.mime.text import MIMEText
+from typing import Callable, Dict, Hashable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Tổng dung lượng (nội dung gốc + phần MIME đã mã hóa) tối đa của cache trong mỗi process
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Body lớn hơn tỷ lệ này của cache không được giữ lại (tránh đẩy hết các entry khác ra ngoài)
+RENDER_CACHE_MAX_ENTRY_FRACTION = 8
+
+
+class _Entry(NamedTuple):
+    source: str
+    part: MIMEText
+    size: int
+
+
+class RenderCache:
+    """
+    LRU các body email đã render và mã hóa MIME, khóa theo nguồn (vd: message id).
+    Mỗi entry giữ nội dung gốc; nội dung khác đi (tin nhắn đã được sửa) thì entry được dựng lại,
+    nên mọi người nhận và mọi lần lặp của cùng một nội dung chỉ render một lần.
+    Phần MIME trả về được dùng chung và không được sửa (chỉ attach vào message ngoài).
+    Chỉ dùng từ event loop (không có khóa).
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def contains(self, key: Hashable, source: str) -> bool:
+        entry = self._entries.get(key)
+        # So sánh identity trước: các job của cùng một batch dùng chung chuỗi nội dung
+        return entry is not None and (entry.source is source or entry.source == source)
+
+    def lookup(self, key: Hashable, source: str) -> Optional[MIMEText]:
+        if not self.contains(key, source):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key].part
+
+    def get_or_build(self, key: Hashable, source: str, build: Callable[[str], MIMEText]) -> MIMEText:
+        part = self.lookup(key, source)
+        if part is None:
+            part = build(source)
+            self.store(key, source, part)
+        return part
+
+    def store(self, key: Hashable, source: str, part: MIMEText):
+        self._discard(key)
+        size = len(source) + len(part.get_payload())
+        if size <= self.max_bytes // RENDER_CACHE_MAX_ENTRY_FRACTION:
+            self._entries[key] = _Entry(source, part, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+
+    def _discard(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Instance duy nhất cho toàn bộ process
+render_cache = RenderCache(RENDER_CACHE_MAX_BYTES)
@@ -0,0 +1,99 @@
+# backend/app/services/schedule_notify.py
+# NEW FILE
+# Version: 1.1.0
+# Changelog:
+# - on_change also receives the user hash (lets the scheduler apply per-user CLC prompt jitter).
+
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy import select, func, cast, BigInteger, Text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db.database import engine
+from .scheduler_partition import current_partition
+
+logger = logging.getLogger(__name__)
+
+# Kênh NOTIFY dùng chung giữa các writer (router) và scheduler
+SCHEDULE_CHANNEL = "cronpost_schedule"
+SCHEDULER_LISTEN_ENABLED = os.environ.get("SCHEDULER_LISTEN_ENABLED", "true").lower() == "true"
+# Chu kỳ kiểm tra kết nối LISTEN còn sống
+SCHEDULER_LISTEN_HEALTHCHECK_SECONDS = int(os.environ.get("SCHEDULER_LISTEN_HEALTHCHECK_SECONDS", "30"))
+
+
+async def notify_schedule_change(db: AsyncSession, kind: str, entity_id, due_at: Optional[datetime], user_id):
+    """
+    Báo cho scheduler biết thời điểm đến hạn mới của (kind, entity_id); due_at=None nghĩa là đã hủy.
+    pg_notify chạy trong transaction của caller nên chỉ được gửi đi khi caller commit.
+    Hash của user được tính trong Postgres (giống PartitionAssignment.owns) để mỗi worker
+    chỉ nhận các thay đổi thuộc phân vùng của nó.
+    """
+    # str(uuid) trùng với uuid::text nên hash khớp với owns() của phân vùng
+    user_hash = func.abs(cast(func.hashtext(str(user_id)), BigInteger))
+    payload = func.json_build_object(
+        'kind', kind,
+        'id', str(entity_id),
+        'due', due_at.isoformat() if due_at is not None else None,
+        'user_hash', user_hash
+    )
+    await db.execute(select(func.pg_notify(SCHEDULE_CHANNEL, cast(payload, Text))))
+
+
+def _handle_notification(payload: str, on_change: Callable[[str, str, Optional[datetime], int], None]):
+    try:
+        change = json.loads(payload)
+        due_at = datetime.fromisoformat(change['due']) if change.get('due') else None
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"SCHEDULE_NOTIFY: Ignoring malformed payload '{payload}': {e}")
+        return
+    user_hash = change.get('user_hash') or 0
+    if current_partition.owns_hash(user_hash):
+        on_change(change['kind'], change['id'], due_at, user_hash)
+
+
+async def run_schedule_listener(
+    on_change: Callable[[str, str, Optional[datetime], int], None],
+    on_reconnect: Callable[[], None]
+):
+    """
+    Giữ một kết nối LISTEN riêng và gọi on_change(kind, entity_id, due_at, user_hash) cho mỗi thay đổi.
+    Thông báo gửi trong lúc mất kết nối sẽ bị mất, nên sau mỗi lần kết nối lại gọi on_reconnect
+    (vd: yêu cầu nạp lại toàn bộ timeline).
+    """
+    if not SCHEDULER_LISTEN_ENABLED:
+        return
+    if engine is None:
+        logger.error("SCHEDULE_NOTIFY: Database engine is not available. Scheduler will rely on periodic resyncs.")
+        return
+
+    def _on_notify(connection, pid, channel, payload):
+        _handle_notification(payload, on_change)
+
+    connected_before = False
+    while True:
+        try:
+            async with engine.connect() as conn:
+                # Dùng trực tiếp kết nối asyncpg: không mở transaction nên thông báo được giao ngay
+                listener_conn = (await conn.get_raw_connection()).driver_connection
+                await listener_conn.add_listener(SCHEDULE_CHANNEL, _on_notify)
+                logger.info(f"SCHEDULE_NOTIFY: Listening on channel '{SCHEDULE_CHANNEL}'.")
+                if connected_before:
+                    on_reconnect()
+                connected_before = True
+                try:
+                    while True:
+                        await asyncio.sleep(SCHEDULER_LISTEN_HEALTHCHECK_SECONDS)
+                        await asyncio.wait_for(listener_conn.execute("SELECT 1"), timeout=SCHEDULER_LISTEN_HEALTHCHECK_SECONDS)
+                finally:
+                    if not listener_conn.is_closed():
+                        await asyncio.shield(listener_conn.remove_listener(SCHEDULE_CHANNEL, _on_notify))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"SCHEDULE_NOTIFY: Listener connection lost: {e}", exc_info=True)
+        await asyncio.sleep(SCHEDULER_LISTEN_HEALTHCHECK_SECONDS)
@@ -1,17 +1,28 @@
 # backend/app/services/schedule_service.py
-# Version: 1.4
+# Version: 1.8
 # Changelog:
+# - Added lazy fire-time streams (iter_clc_prompts, iter_fm_sends) for schedule previews;
+#   FM repetitions share _next_fm_repeat_date with calculate_next_fm_repeat_at.
+# - Timezone lookups and local->UTC conversions go through core.timezones.timezone_registry
+#   (cached tz objects, precomputed DST transition tables).
+# - Added batch entry points (calculate_next_clc_prompts_batch, calculate_next_fm_sends_batch)
+#   working on plain tuples, grouped by timezone and trigger type.
+# - Date walking loops replaced by shared O(1) helpers used by both the per-row and batch paths.
+# - calculate_next_fm_send_at no longer reads non-existent FmSchedule attributes (is_active, repeat_count).
+# - Added calculate_next_fm_repeat_at for FM repetitions driven by the message dispatcher.
 # - Refined CLCTypeEnum.specific_days logic for interval calculation.
 # - Corrected CLCTypeEnum.date_of_year to skip invalid dates (e.g., 29/02 non-leap).
 # - Added calculate_next_fm_send_at function for Follow Message scheduling.
 
 import logging
-from typing import Optional
+from itertools import islice
+from typing import Optional, Any, Dict, Iterable, Iterator, List, NamedTuple, Tuple
 from datetime import datetime, timedelta, time, date, timezone as dt_timezone
 import calendar
 import pytz
 
 from sqlalchemy.ext.asyncio import AsyncSession
+from ..core.timezones import timezone_registry
 from ..db.models import (
     UserConfiguration, 
     CLCTypeEnum, 
@@ -31,6 +42,41 @@ DAY_OF_WEEK_MAP = {
 def get_last_day_of_month(year: int, month: int) -> int:
     return calendar.monthrange(year, month)[1]
 
+# Số năm tối đa để tìm một ngày dd/MM hợp lệ (29/02 có thể cách nhau tới 8 năm)
+MAX_DATE_OF_YEAR_SCAN_YEARS = 9
+
+def next_weekday_on_or_after(start: date, target_weekday: int) -> date:
+    return start + timedelta(days=(target_weekday - start.weekday()) % 7)
+
+def next_date_of_month_on_or_after(start: date, target_day: int) -> date:
+    """Ngày target_day (kẹp về ngày cuối tháng) gần nhất kể từ start."""
+    year, month = start.year, start.month
+    candidate = date(year, month, min(target_day, get_last_day_of_month(year, month)))
+    if candidate < start:
+        month += 1
+        if month > 12: month = 1; year += 1
+        candidate = date(year, month, min(target_day, get_last_day_of_month(year, month)))
+    return candidate
+
+def next_date_of_year_on_or_after(start: date, target_day: int, target_month: int) -> Optional[date]:
+    """Ngày dd/MM hợp lệ gần nhất kể từ start, bỏ qua các năm không có ngày đó (vd: 29/02)."""
+    for year in range(start.year, start.year + MAX_DATE_OF_YEAR_SCAN_YEARS):
+        try:
+            candidate = date(year, target_month, target_day)
+        except ValueError:
+            continue
+        if candidate >= start:
+            return candidate
+    return None
+
+def parse_day_month(value: str) -> Tuple[int, int]:
+    """Tách chuỗi 'dd/MM' thành (day, month); ném ValueError nếu không hợp lệ."""
+    day_str, month_str = value.split('/')
+    target_day, target_month = int(day_str), int(month_str)
+    if not (1 <= target_month <= 12 and 1 <= target_day <= 31):
+        raise ValueError("Month or day out of valid range.")
+    return target_day, target_month
+
 async def calculate_next_clc_prompt_at( # Giữ nguyên logic hiện tại của hàm này
     user_config: UserConfiguration,
     user_timezone_str: str,
@@ -48,7 +94,7 @@ async def calculate_next_clc_prompt_at( # Giữ nguyên logic hiện tại của
         return None 
 
     try:
-        user_tz = pytz.timezone(user_timezone_str)
+        user_tz = timezone_registry.get(user_timezone_str)
     except pytz.exceptions.UnknownTimeZoneError:
         logger.warning(f"Unknown timezone '{user_timezone_str}' for user {user_config.user_id}. Defaulting to UTC.")
         user_tz = pytz.utc
@@ -64,7 +110,7 @@ async def calculate_next_clc_prompt_at( # Giữ nguyên logic hiện tại của
     prompt_on_ref_day_user_tz_naive = datetime.combine(current_day_of_reference_user_tz, prompt_time_local)
     
     try:
-        prompt_on_ref_day_user_tz_aware = user_tz.localize(prompt_on_ref_day_user_tz_naive, is_dst=None)
+        prompt_on_ref_day_user_tz_aware = timezone_registry.localize(user_tz, prompt_on_ref_day_user_tz_naive)
     except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e_tz:
         logger.warning(f"Timezone localization error for reference day prompt time for user {user_config.user_id}: {e_tz}.")
         effective_start_date_for_cycle = current_day_of_reference_user_tz + timedelta(days=1)
@@ -88,60 +134,24 @@ async def calculate_next_clc_prompt_at( # Giữ nguyên logic hiện tại của
     elif user_config.clc_type == CLCTypeEnum.day_of_week:
         if user_config.clc_day_of_week and user_config.clc_day_of_week.value in DAY_OF_WEEK_MAP:
             target_weekday = DAY_OF_WEEK_MAP[user_config.clc_day_of_week.value]
-            temp_date = effective_start_date_for_cycle
-            while temp_date.weekday() != target_weekday:
-                temp_date += timedelta(days=1)
-            next_prompt_date_user_tz = temp_date
+            next_prompt_date_user_tz = next_weekday_on_or_after(effective_start_date_for_cycle, target_weekday)
         else:
             logger.error(f"Invalid clc_day_of_week for user {user_config.user_id}")
             return None
     elif user_config.clc_type == CLCTypeEnum.date_of_month:
         target_day_of_month = user_config.clc_date_of_month
         if target_day_of_month and 1 <= target_day_of_month <= 31:
-            year = effective_start_date_for_cycle.year
-            month = effective_start_date_for_cycle.month
-            found_next_date = False
-            for _ in range(13): 
-                last_day_this_month = get_last_day_of_month(year, month)
-                actual_target_day_this_month = min(target_day_of_month, last_day_this_month)
-                try:
-                    prospective_date = date(year, month, actual_target_day_this_month)
-                    if prospective_date >= effective_start_date_for_cycle:
-                        next_prompt_date_user_tz = prospective_date
-                        found_next_date = True
-                        break 
-                except ValueError: pass 
-                month += 1
-                if month > 12: month = 1; year += 1
-                effective_start_date_for_cycle = date(year, month, 1) 
-            if not found_next_date:
-                logger.error(f"Could not find next valid date_of_month for day {target_day_of_month} for user {user_config.user_id} within 13 months.")
-                return None
+            next_prompt_date_user_tz = next_date_of_month_on_or_after(effective_start_date_for_cycle, target_day_of_month)
         else:
             logger.error(f"Invalid clc_date_of_month ({target_day_of_month}) for user {user_config.user_id}")
             return None
     elif user_config.clc_type == CLCTypeEnum.date_of_year:
         if user_config.clc_date_of_year: 
             try:
-                day_str, month_str = user_config.clc_date_of_year.split('/')
-                target_day = int(day_str); target_month = int(month_str)
-                if not (1 <= target_month <= 12 and 1 <= target_day <= 31): raise ValueError("Month or day out of valid range.")
-                year_to_check = effective_start_date_for_cycle.year
-                found_next_date = False
-                for i in range(3): 
-                    current_year_candidate = year_to_check + i
-                    try:
-                        prospective_date = date(current_year_candidate, target_month, target_day)
-                        if prospective_date >= effective_start_date_for_cycle:
-                            next_prompt_date_user_tz = prospective_date
-                            found_next_date = True
-                            break 
-                    except ValueError: 
-                        logger.debug(f"Skipping {target_day}/{target_month}/{current_year_candidate} for user {user_config.user_id} as it's an invalid date.")
-                        effective_start_date_for_cycle = date(current_year_candidate + 1, 1, 1)
-                        continue 
-                if not found_next_date:
-                    logger.error(f"Could not find next valid date_of_year for {user_config.clc_date_of_year} for user {user_config.user_id} within 3 years.")
+                target_day, target_month = parse_day_month(user_config.clc_date_of_year)
+                next_prompt_date_user_tz = next_date_of_year_on_or_after(effective_start_date_for_cycle, target_day, target_month)
+                if not next_prompt_date_user_tz:
+                    logger.error(f"Could not find next valid date_of_year for {user_config.clc_date_of_year} for user {user_config.user_id} within {MAX_DATE_OF_YEAR_SCAN_YEARS} years.")
                     return None
             except ValueError as e_val: 
                 logger.error(f"Invalid format or value in clc_date_of_year ('{user_config.clc_date_of_year}') for user {user_config.user_id}: {e_val}")
@@ -159,7 +169,7 @@ async def calculate_next_clc_prompt_at( # Giữ nguyên logic hiện tại của
     if next_prompt_date_user_tz:
         next_prompt_datetime_user_tz_naive = datetime.combine(next_prompt_date_user_tz, prompt_time_local)
         try:
-            next_prompt_datetime_user_tz_aware = user_tz.localize(next_prompt_datetime_user_tz_naive, is_dst=None)
+            next_prompt_datetime_user_tz_aware = timezone_registry.localize(user_tz, next_prompt_datetime_user_tz_naive)
         except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e_tz:
             logger.error(f"Calculated next prompt time {next_prompt_datetime_user_tz_naive.strftime('%Y-%m-%d %H:%M:%S')} is invalid/ambiguous in timezone {user_timezone_str} for user {user_config.user_id}: {e_tz}. Returning None.")
             raise ValueError(f"The calculated next schedule time ({next_prompt_datetime_user_tz_naive.strftime('%H:%M')} on {next_prompt_date_user_tz.strftime('%Y-%m-%d')}) is invalid or ambiguous in your timezone ({user_timezone_str}). This can happen during Daylight Saving Time changes. Please adjust your prompt time or date.")
@@ -184,12 +194,12 @@ async def calculate_next_fm_send_at(
     """
     logger.info(f"Calculating next FM send for message_id: {fm_schedule.message_id}, trigger: {fm_schedule.trigger_type}, user_tz: {user_timezone_str}")
 
-    if not fm_schedule.is_active:
-        logger.info(f"FM {fm_schedule.message_id} is not active. No next send time.")
+    if not fm_schedule.repeat_number or fm_schedule.repeat_number <= 0:
+        logger.info(f"FM {fm_schedule.message_id} is not active (repeat_number={fm_schedule.repeat_number}). No next send time.")
         return None
 
     try:
-        user_tz = pytz.timezone(user_timezone_str)
+        user_tz = timezone_registry.get(user_timezone_str)
     except pytz.exceptions.UnknownTimeZoneError:
         logger.warning(f"Unknown timezone '{user_timezone_str}' for FM {fm_schedule.message_id}. Defaulting to UTC.")
         user_tz = pytz.utc
@@ -228,7 +238,7 @@ async def calculate_next_fm_send_at(
         fm_send_on_im_day_user_tz_naive = datetime.combine(current_day_of_im_sent_user_tz, fm_send_time_local)
         
         try:
-            fm_send_on_im_day_user_tz_aware = user_tz.localize(fm_send_on_im_day_user_tz_naive, is_dst=None)
+            fm_send_on_im_day_user_tz_aware = timezone_registry.localize(user_tz, fm_send_on_im_day_user_tz_naive)
         except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError):
             # If send time on IM day is invalid (DST), assume we start from next day relative to IM day
             base_date_for_calc = current_day_of_im_sent_user_tz + timedelta(days=1)
@@ -242,7 +252,7 @@ async def calculate_next_fm_send_at(
         # Nếu thời gian gửi của hôm nay đã qua, bắt đầu từ ngày mai
         today_fm_send_naive = datetime.combine(base_date_for_calc, fm_send_time_local)
         try:
-            today_fm_send_aware = user_tz.localize(today_fm_send_naive, is_dst=None)
+            today_fm_send_aware = timezone_registry.localize(user_tz, today_fm_send_naive)
         except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError):
             base_date_for_calc += timedelta(days=1) # Nếu giờ gửi hôm nay lỗi DST, tính từ mai
         else:
@@ -261,52 +271,22 @@ async def calculate_next_fm_send_at(
     elif fm_schedule.trigger_type == FMScheduleTriggerTypeEnum.day_of_week: # Luôn là "tuần sau IM" hoặc "tuần này nếu còn kịp"
         if fm_schedule.day_of_week_value and fm_schedule.day_of_week_value.value in DAY_OF_WEEK_MAP:
             target_weekday = DAY_OF_WEEK_MAP[fm_schedule.day_of_week_value.value]
-            temp_date = base_date_for_calc # Bắt đầu từ base_date_for_calc
-            while temp_date.weekday() != target_weekday:
-                temp_date += timedelta(days=1)
-            next_fm_send_date_user_tz = temp_date
+            next_fm_send_date_user_tz = next_weekday_on_or_after(base_date_for_calc, target_weekday)
         else: return None
 
     elif fm_schedule.trigger_type == FMScheduleTriggerTypeEnum.date_of_month: # "tháng sau IM" hoặc "tháng này nếu còn kịp"
         target_day = fm_schedule.date_of_month_value
         if target_day and 1 <= target_day <= 31:
-            year = base_date_for_calc.year
-            month = base_date_for_calc.month
-            found = False
-            for _ in range(13): # Kiểm tra tháng hiện tại và 12 tháng tiếp theo
-                last_day_current_month = get_last_day_of_month(year, month)
-                actual_target_day = min(target_day, last_day_current_month)
-                prospective_date = date(year, month, actual_target_day)
-                if prospective_date >= base_date_for_calc:
-                    next_fm_send_date_user_tz = prospective_date
-                    found = True; break
-                month += 1
-                if month > 12: month = 1; year += 1
-                base_date_for_calc = date(year, month, 1) # Reset base date cho vòng lặp sau
-            if not found: return None
+            next_fm_send_date_user_tz = next_date_of_month_on_or_after(base_date_for_calc, target_day)
         else: return None
 
     elif fm_schedule.trigger_type == FMScheduleTriggerTypeEnum.date_of_year: # "năm sau IM" hoặc "năm nay nếu còn kịp"
         if fm_schedule.date_of_year_value:
             try:
-                day_str, month_str = fm_schedule.date_of_year_value.split('/')
-                target_d, target_m = int(day_str), int(month_str)
-                if not (1 <= target_m <= 12 and 1 <= target_d <= 31): raise ValueError("Invalid dd/MM")
-                
-                year_to_check = base_date_for_calc.year
-                found = False
-                for i in range(fm_schedule.repeat_count + 2): # Check đủ số năm cho repeat + 1 năm dự phòng
-                    current_year_candidate = year_to_check + i
-                    try:
-                        prospective_date = date(current_year_candidate, target_m, target_d)
-                        if prospective_date >= base_date_for_calc:
-                            next_fm_send_date_user_tz = prospective_date
-                            found = True; break
-                    except ValueError: # Ngày không hợp lệ (vd: 29/02)
-                        base_date_for_calc = date(current_year_candidate + 1, 1, 1) # Bỏ qua năm này
-                        continue
-                if not found: return None
+                target_d, target_m = parse_day_month(fm_schedule.date_of_year_value)
             except ValueError: return None # Lỗi parse dd/MM
+            next_fm_send_date_user_tz = next_date_of_year_on_or_after(base_date_for_calc, target_d, target_m)
+            if not next_fm_send_date_user_tz: return None
         else: return None
 
     elif fm_schedule.trigger_type == FMScheduleTriggerTypeEnum.specific_date:
@@ -317,7 +297,7 @@ async def calculate_next_fm_send_at(
                 # Tạo datetime UTC cho FM từ specific_date_value và sending_time_of_day
                 fm_specific_send_naive = datetime.combine(fm_schedule.specific_date_value, fm_send_time_local)
                 try:
-                    fm_specific_send_user_tz = user_tz.localize(fm_specific_send_naive, is_dst=None)
+                    fm_specific_send_user_tz = timezone_registry.localize(user_tz, fm_specific_send_naive)
                 except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e_tz:
                      logger.error(f"FM {fm_schedule.message_id} specific_date {fm_schedule.specific_date_value} at {fm_send_time_local} is invalid in timezone {user_timezone_str}: {e_tz}")
                      raise ValueError(f"The FM's specific send time is invalid or ambiguous in your timezone: {e_tz}")
@@ -339,7 +319,7 @@ async def calculate_next_fm_send_at(
     # Kết hợp ngày đã tính với thời gian gửi
     final_fm_send_datetime_naive = datetime.combine(next_fm_send_date_user_tz, fm_send_time_local)
     try:
-        final_fm_send_datetime_aware = user_tz.localize(final_fm_send_datetime_naive, is_dst=None)
+        final_fm_send_datetime_aware = timezone_registry.localize(user_tz, final_fm_send_datetime_naive)
     except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e_tz:
         logger.error(f"Final calculated FM send time {final_fm_send_datetime_naive.strftime('%Y-%m-%d %H:%M:%S')} is invalid/ambiguous in timezone {user_timezone_str} for FM {fm_schedule.message_id}: {e_tz}.")
         # Xử lý lỗi này: có thể thử ngày hôm sau với cùng quy tắc, hoặc báo lỗi.
@@ -357,15 +337,372 @@ async def calculate_next_fm_send_at(
         # Ví dụ: nếu FM "hàng ngày" và base_date_for_calc là hôm nay nhưng thời gian đã qua, nó nên là ngày mai.
         # Logic base_date_for_calc ở trên đã cố gắng xử lý việc này. Nếu vẫn vào đây, cần xem xét lại.
         # Tạm thời, coi đây là một trường hợp không thể lên lịch ngay.
-        if fm_schedule.repeat_count > fm_schedule.current_repetition : # Nếu còn lượt lặp
-             logger.info(f"Attempting to find next occurrence for past-scheduled repeating FM {fm_schedule.message_id}")
-             # Đây là nơi logic tính toán cho lần lặp tiếp theo sẽ được áp dụng.
-             # Ví dụ, nếu trigger là 'day_of_week', base_date_for_calc có thể là final_fm_send_date_user_tz + timedelta(days=1)
-             # và chạy lại logic tìm kiếm.
-             # Tạm thời return None để đơn giản hóa, logic lặp lại sẽ xử lý sau.
-             return None
+        # Các lần lặp lại được worker tính bằng calculate_next_fm_repeat_at.
         return None
 
 
     logger.info(f"Calculated next FM send for {fm_schedule.message_id}: {final_fm_send_utc} (UTC), from user-local: {final_fm_send_datetime_aware}")
-    return final_fm_send_utc
\ No newline at end of file
+    return final_fm_send_utc
+
+
+def calculate_next_fm_repeat_at(
+    fm_schedule: FmSchedule,
+    user_timezone_str: str,
+    last_send_at_utc: datetime
+) -> Optional[datetime]:
+    """
+    Calculates the send time of the next repetition of a Follow Message (FM),
+    strictly after the slot that was just sent (last_send_at_utc).
+    Returns datetime in UTC, or None if the trigger type does not repeat.
+    """
+    try:
+        user_tz = timezone_registry.get(user_timezone_str)
+    except pytz.exceptions.UnknownTimeZoneError:
+        logger.warning(f"Unknown timezone '{user_timezone_str}' for FM {fm_schedule.message_id}. Defaulting to UTC.")
+        user_tz = pytz.utc
+
+    fm_send_time_local: time = fm_schedule.sending_time_of_day or time(9, 0, 0)
+    last_send_date_user_tz = last_send_at_utc.astimezone(user_tz).date()
+    trigger_type = _enum_value(fm_schedule.trigger_type)
+    if trigger_type == FMScheduleTriggerTypeEnum.specific_date.value:
+        # specific_date chỉ gửi một lần
+        return None
+    try:
+        next_date_user_tz = _next_fm_repeat_date(trigger_type, fm_schedule, last_send_date_user_tz)
+    except _InvalidSchedule as e:
+        logger.error(f"Invalid repetition config for FM {fm_schedule.message_id}: {e}")
+        return None
+
+    if not next_date_user_tz:
+        logger.warning(f"Could not determine next repetition date for FM {fm_schedule.message_id} (trigger: {fm_schedule.trigger_type}).")
+        return None
+
+    return _repeat_to_utc(user_tz, next_date_user_tz, fm_send_time_local, fm_schedule.message_id)
+
+
+def _repeat_to_utc(user_tz, target_date: date, local_time: time, message_id: Any = None) -> datetime:
+    next_send_naive = datetime.combine(target_date, local_time)
+    try:
+        next_send_aware = timezone_registry.localize(user_tz, next_send_naive)
+    except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e_tz:
+        # Worker không thể hỏi lại người dùng, nên chọn giờ chuẩn (is_dst=False) thay vì báo lỗi
+        logger.warning(f"Repetition time {next_send_naive} for FM {message_id} is invalid/ambiguous in {user_tz.zone}: {e_tz}. Using standard time.")
+        next_send_aware = user_tz.normalize(user_tz.localize(next_send_naive, is_dst=False))
+    return next_send_aware.astimezone(pytz.utc)
+
+
+# --- BATCH API ---
+# Dùng khi cần tính lại lịch cho rất nhiều cấu hình cùng lúc (vd: sau khi đổi system settings).
+# Đầu vào là tuple thuần (không phải ORM row); kết quả được tính một lần cho mỗi tổ hợp
+# (timezone, loại trigger, tham số, giờ gửi) và dùng lại cho mọi dòng giống nhau.
+
+class ClcScheduleRow(NamedTuple):
+    key: Any
+    timezone: str
+    clc_type: str
+    clc_prompt_time: Optional[time]
+    clc_day_number_interval: Optional[int] = None
+    clc_day_of_week: Optional[str] = None
+    clc_date_of_month: Optional[int] = None
+    clc_date_of_year: Optional[str] = None
+    is_clc_enabled: bool = True
+
+class FmScheduleRow(NamedTuple):
+    key: Any
+    timezone: str
+    trigger_type: str
+    sending_time_of_day: Optional[time]
+    days_after_im_value: Optional[int] = None
+    day_of_week_value: Optional[str] = None
+    date_of_month_value: Optional[int] = None
+    date_of_year_value: Optional[str] = None
+    specific_date_value: Optional[date] = None
+    im_sent_at_utc: Optional[datetime] = None
+    repeat_number: int = 1
+
+FM_TRIGGERS_DEPENDENT_ON_IM = {
+    FMScheduleTriggerTypeEnum.days_after_im_sent.value,
+    FMScheduleTriggerTypeEnum.day_of_week.value,
+    FMScheduleTriggerTypeEnum.date_of_month.value,
+    FMScheduleTriggerTypeEnum.date_of_year.value,
+}
+
+class _InvalidSchedule(Exception):
+    """Cấu hình không cho ra thời điểm hợp lệ (tham số sai hoặc lỗi DST)."""
+
+
+def _enum_value(value: Any) -> Any:
+    return getattr(value, 'value', value)
+
+def _resolve_timezone(timezone_str: str):
+    try:
+        return timezone_registry.get(timezone_str)
+    except pytz.exceptions.UnknownTimeZoneError:
+        logger.warning(f"Unknown timezone '{timezone_str}' in batch calculation. Defaulting to UTC.")
+        return pytz.utc
+
+def _group_by(rows: Iterable[Tuple], row_type, attribute: str) -> Dict[Any, List[Any]]:
+    groups: Dict[Any, List[Any]] = {}
+    for raw_row in rows:
+        row = raw_row if isinstance(raw_row, row_type) else row_type(*raw_row)
+        groups.setdefault(_enum_value(getattr(row, attribute)), []).append(row)
+    return groups
+
+def _start_date_after(user_tz, reference_user_tz: datetime, local_time: time) -> date:
+    """Ngày tham chiếu, hoặc ngày hôm sau nếu giờ local_time của ngày đó đã qua (hoặc không hợp lệ do DST)."""
+    reference_date = reference_user_tz.date()
+    try:
+        local_time_aware = timezone_registry.localize(user_tz, datetime.combine(reference_date, local_time))
+    except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError):
+        return reference_date + timedelta(days=1)
+    return reference_date + timedelta(days=1) if reference_user_tz >= local_time_aware else reference_date
+
+def _localize_to_utc(user_tz, target_date: date, local_time: time, cache: Dict[Tuple[date, time], datetime]) -> datetime:
+    cache_key = (target_date, local_time)
+    if cache_key not in cache:
+        try:
+            cache[cache_key] = timezone_registry.to_utc(user_tz, datetime.combine(target_date, local_time))
+        except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e_tz:
+            raise _InvalidSchedule(str(e_tz))
+    return cache[cache_key]
+
+def _next_clc_date(clc_type: str, row: ClcScheduleRow, start_date: date) -> date:
+    if clc_type == CLCTypeEnum.every_day.value:
+        return start_date
+    if clc_type == CLCTypeEnum.specific_days.value:
+        if row.clc_day_number_interval and row.clc_day_number_interval >= 2:
+            return start_date + timedelta(days=row.clc_day_number_interval)
+    elif clc_type == CLCTypeEnum.day_of_week.value:
+        target_weekday = DAY_OF_WEEK_MAP.get(_enum_value(row.clc_day_of_week))
+        if target_weekday is not None:
+            return next_weekday_on_or_after(start_date, target_weekday)
+    elif clc_type == CLCTypeEnum.date_of_month.value:
+        if row.clc_date_of_month and 1 <= row.clc_date_of_month <= 31:
+            return next_date_of_month_on_or_after(start_date, row.clc_date_of_month)
+    elif clc_type == CLCTypeEnum.date_of_year.value:
+        try:
+            target_day, target_month = parse_day_month(row.clc_date_of_year or '')
+        except ValueError:
+            raise _InvalidSchedule(f"invalid clc_date_of_year '{row.clc_date_of_year}'")
+        next_date = next_date_of_year_on_or_after(start_date, target_day, target_month)
+        if next_date:
+            return next_date
+    raise _InvalidSchedule(f"invalid parameters for clc_type '{clc_type}'")
+
+def calculate_next_clc_prompts_batch(
+    rows: Iterable[Tuple],
+    reference_datetime_utc: datetime
+) -> Dict[Any, Optional[datetime]]:
+    """
+    Batch version of calculate_next_clc_prompt_at.
+    `rows` are ClcScheduleRow (or plain tuples in the same field order).
+    Returns {key: next prompt time in UTC, or None when disabled/unloop/invalid}.
+    Unlike the per-row function, a DST-invalid prompt time yields None instead of raising.
+    """
+    results: Dict[Any, Optional[datetime]] = {}
+    invalid_count = 0
+
+    for timezone_str, tz_rows in _group_by(rows, ClcScheduleRow, 'timezone').items():
+        user_tz = _resolve_timezone(timezone_str)
+        reference_user_tz = reference_datetime_utc.astimezone(user_tz)
+        start_dates: Dict[time, date] = {}
+        localized: Dict[Tuple[date, time], datetime] = {}
+        computed: Dict[Tuple, Optional[datetime]] = {}
+
+        for clc_type, type_rows in _group_by(tz_rows, ClcScheduleRow, 'clc_type').items():
+            for row in type_rows:
+                if not row.is_clc_enabled or clc_type == CLCTypeEnum.specific_date_in_year.value:
+                    results[row.key] = None
+                    continue
+                prompt_time = row.clc_prompt_time or time(9, 0, 0)
+                params = (row.clc_day_number_interval, _enum_value(row.clc_day_of_week), row.clc_date_of_month, row.clc_date_of_year)
+                cache_key = (clc_type, params, prompt_time)
+                if cache_key not in computed:
+                    if prompt_time not in start_dates:
+                        start_dates[prompt_time] = _start_date_after(user_tz, reference_user_tz, prompt_time)
+                    try:
+                        next_date = _next_clc_date(clc_type, row, start_dates[prompt_time])
+                        computed[cache_key] = _localize_to_utc(user_tz, next_date, prompt_time, localized)
+                    except _InvalidSchedule:
+                        computed[cache_key] = None
+                if computed[cache_key] is None:
+                    invalid_count += 1
+                results[row.key] = computed[cache_key]
+
+    logger.info(f"Batch CLC calculation: {len(results)} row(s), {invalid_count} without a valid next prompt.")
+    return results
+
+def _next_fm_date(trigger_type: str, row: FmScheduleRow, base_date: date, im_sent_date: Optional[date]) -> date:
+    if trigger_type == FMScheduleTriggerTypeEnum.days_after_im_sent.value:
+        if row.days_after_im_value is not None:
+            return im_sent_date + timedelta(days=row.days_after_im_value)
+    elif trigger_type == FMScheduleTriggerTypeEnum.day_of_week.value:
+        target_weekday = DAY_OF_WEEK_MAP.get(_enum_value(row.day_of_week_value))
+        if target_weekday is not None:
+            return next_weekday_on_or_after(base_date, target_weekday)
+    elif trigger_type == FMScheduleTriggerTypeEnum.date_of_month.value:
+        if row.date_of_month_value and 1 <= row.date_of_month_value <= 31:
+            return next_date_of_month_on_or_after(base_date, row.date_of_month_value)
+    elif trigger_type == FMScheduleTriggerTypeEnum.date_of_year.value:
+        try:
+            target_day, target_month = parse_day_month(row.date_of_year_value or '')
+        except ValueError:
+            raise _InvalidSchedule(f"invalid date_of_year_value '{row.date_of_year_value}'")
+        next_date = next_date_of_year_on_or_after(base_date, target_day, target_month)
+        if next_date:
+            return next_date
+    elif trigger_type == FMScheduleTriggerTypeEnum.specific_date.value:
+        if row.specific_date_value:
+            return row.specific_date_value
+    raise _InvalidSchedule(f"invalid parameters for trigger_type '{trigger_type}'")
+
+def _next_fm_repeat_date(trigger_type: str, schedule: Any, last_send_date: date) -> Optional[date]:
+    """Ngày của lần lặp kế tiếp sau last_send_date (schedule là FmSchedule hoặc FmScheduleRow)."""
+    if trigger_type == FMScheduleTriggerTypeEnum.days_after_im_sent.value:
+        # Lặp lại mỗi X ngày kể từ lần gửi trước
+        return last_send_date + timedelta(days=schedule.days_after_im_value) if schedule.days_after_im_value else None
+    if trigger_type == FMScheduleTriggerTypeEnum.day_of_week.value:
+        return last_send_date + timedelta(days=7)
+    if trigger_type == FMScheduleTriggerTypeEnum.date_of_month.value:
+        target_day = schedule.date_of_month_value
+        if not (target_day and 1 <= target_day <= 31):
+            return None
+        year, month = last_send_date.year, last_send_date.month + 1
+        if month > 12: month = 1; year += 1
+        return next_date_of_month_on_or_after(date(year, month, 1), target_day)
+    if trigger_type == FMScheduleTriggerTypeEnum.date_of_year.value:
+        try:
+            target_d, target_m = parse_day_month(schedule.date_of_year_value or '')
+        except ValueError:
+            raise _InvalidSchedule(f"invalid date_of_year_value '{schedule.date_of_year_value}'")
+        return next_date_of_year_on_or_after(last_send_date + timedelta(days=1), target_d, target_m)
+    return None
+
+def calculate_next_fm_sends_batch(
+    rows: Iterable[Tuple],
+    reference_datetime_utc: Optional[datetime] = None
+) -> Dict[Any, Optional[datetime]]:
+    """
+    Batch version of calculate_next_fm_send_at.
+    `rows` are FmScheduleRow (or plain tuples in the same field order).
+    reference_datetime_utc plays the role of "now" (defaults to the current time).
+    Returns {key: next send time in UTC, or None when not schedulable yet/invalid}.
+    """
+    now_utc = reference_datetime_utc or datetime.now(dt_timezone.utc)
+    results: Dict[Any, Optional[datetime]] = {}
+    unscheduled_count = 0
+
+    for timezone_str, tz_rows in _group_by(rows, FmScheduleRow, 'timezone').items():
+        user_tz = _resolve_timezone(timezone_str)
+        now_user_tz = now_utc.astimezone(user_tz)
+        today_start_dates: Dict[time, date] = {}
+        localized: Dict[Tuple[date, time], datetime] = {}
+        computed: Dict[Tuple, Optional[datetime]] = {}
+
+        for trigger_type, type_rows in _group_by(tz_rows, FmScheduleRow, 'trigger_type').items():
+            dependent_on_im = trigger_type in FM_TRIGGERS_DEPENDENT_ON_IM
+            for row in type_rows:
+                results[row.key] = None
+                if not row.repeat_number or row.repeat_number <= 0:
+                    unscheduled_count += 1
+                    continue
+                send_time = row.sending_time_of_day or time(9, 0, 0)
+
+                im_sent_date: Optional[date] = None
+                if dependent_on_im:
+                    if not row.im_sent_at_utc:
+                        unscheduled_count += 1
+                        continue
+                    im_sent_user_tz = row.im_sent_at_utc.astimezone(user_tz)
+                    im_sent_date = im_sent_user_tz.date()
+                    base_date = _start_date_after(user_tz, im_sent_user_tz, send_time)
+                else:
+                    if send_time not in today_start_dates:
+                        today_start_dates[send_time] = _start_date_after(user_tz, now_user_tz, send_time)
+                    base_date = today_start_dates[send_time]
+
+                params = (row.days_after_im_value, _enum_value(row.day_of_week_value), row.date_of_month_value, row.date_of_year_value, row.specific_date_value)
+                cache_key = (trigger_type, params, send_time, base_date, im_sent_date)
+                if cache_key not in computed:
+                    try:
+                        next_date = _next_fm_date(trigger_type, row, base_date, im_sent_date)
+                        computed[cache_key] = _localize_to_utc(user_tz, next_date, send_time, localized)
+                    except _InvalidSchedule:
+                        computed[cache_key] = None
+                next_send_utc = computed[cache_key]
+
+                if next_send_utc is not None:
+                    if trigger_type == FMScheduleTriggerTypeEnum.specific_date.value:
+                        # Chỉ gửi nếu thời điểm này sau thời điểm IM đã được gửi
+                        if row.im_sent_at_utc and next_send_utc <= row.im_sent_at_utc:
+                            next_send_utc = None
+                    elif next_send_utc <= now_utc:
+                        next_send_utc = None
+
+                if next_send_utc is None:
+                    unscheduled_count += 1
+                results[row.key] = next_send_utc
+
+    logger.info(f"Batch FM calculation: {len(results)} row(s), {unscheduled_count} without a next send time.")
+    return results
+
+
+# --- PREVIEW STREAMS ---
+# Sinh lần lượt các thời điểm kích hoạt (UTC) mà không gọi lại calculate_next_* cho mỗi phần tử:
+# mỗi bước chỉ dịch ngày từ phần tử trước nên lấy N phần tử tốn O(N).
+
+def iter_clc_prompts(row: ClcScheduleRow, reference_datetime_utc: datetime) -> Iterator[datetime]:
+    """
+    Các lần prompt CLC kế tiếp sau reference_datetime_utc, giả định user check-in đúng
+    giờ prompt mỗi lần (giống gọi calculate_next_clc_prompt_at với mốc là lần prompt trước).
+    Ngày có giờ prompt không hợp lệ do DST bị bỏ qua thay vì báo lỗi.
+    """
+    clc_type = _enum_value(row.clc_type)
+    if not row.is_clc_enabled or clc_type == CLCTypeEnum.specific_date_in_year.value:
+        return
+    user_tz = _resolve_timezone(row.timezone)
+    prompt_time = row.clc_prompt_time or time(9, 0, 0)
+    start_date = _start_date_after(user_tz, reference_datetime_utc.astimezone(user_tz), prompt_time)
+    while True:
+        try:
+            prompt_date = _next_clc_date(clc_type, row, start_date)
+        except _InvalidSchedule:
+            return
+        try:
+            yield timezone_registry.to_utc(user_tz, datetime.combine(prompt_date, prompt_time))
+        except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError):
+            logger.debug(f"Skipping DST-invalid CLC prompt on {prompt_date} at {prompt_time} in {row.timezone}.")
+        start_date = prompt_date + timedelta(days=1)
+
+def iter_fm_sends(row: FmScheduleRow, reference_datetime_utc: Optional[datetime] = None) -> Iterator[datetime]:
+    """
+    Tối đa repeat_number lần gửi của một FM: lần đầu theo calculate_next_fm_send_at,
+    các lần sau theo calculate_next_fm_repeat_at. Không có phần tử nào nếu FM chưa thể lên lịch
+    (vd: phụ thuộc IM nhưng im_sent_at_utc là None).
+    """
+    first_send_utc = calculate_next_fm_sends_batch([row], reference_datetime_utc).get(row.key)
+    if first_send_utc is None:
+        return
+    yield first_send_utc
+
+    trigger_type = _enum_value(row.trigger_type)
+    if trigger_type == FMScheduleTriggerTypeEnum.specific_date.value:
+        return
+    user_tz = _resolve_timezone(row.timezone)
+    send_time = row.sending_time_of_day or time(9, 0, 0)
+    send_date = first_send_utc.astimezone(user_tz).date()
+    for _ in range(row.repeat_number - 1):
+        try:
+            send_date = _next_fm_repeat_date(trigger_type, row, send_date)
+        except _InvalidSchedule:
+            return
+        if send_date is None:
+            return
+        send_utc = _repeat_to_utc(user_tz, send_date, send_time, row.key)
+        yield send_utc
+        send_date = send_utc.astimezone(user_tz).date()
+
+def take_fire_times(stream: Iterator[datetime], count: int, timezone_str: str) -> List[Tuple[datetime, datetime]]:
+    """Lấy tối đa count phần tử đầu của stream, kèm giờ địa phương: [(at_utc, at_local), ...]."""
+    user_tz = _resolve_timezone(timezone_str)
+    return [(fire_at_utc, fire_at_utc.astimezone(user_tz)) for fire_at_utc in islice(stream, count)]
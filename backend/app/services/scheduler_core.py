@@ -0,0 +1,492 @@
+# backend/app/services/scheduler_core.py
+# Version: 1.10.0
+# Changelog:
+# - KIND_RETRY entries are delivery ledger keys (delivery_ledger.next_retry_at, idempotency_key),
+#   partitioned by the ledger's user_id.
+# - Added register_change_listener() for NOTIFY kinds that are not schedules (e.g. KIND_SMTP_SETTINGS
+#   invalidates cached user SMTP transports); they never enter the timeline.
+# - CLC entries are due at their jittered prompt time (clc_jitter; also applied to NOTIFY changes);
+#   added measure_clc_load_profile() for the expected per-minute prompt load.
+# - Added KIND_WCT_REMINDER and register_window_loader() for kinds whose timeline entries are computed
+#   (e.g. per-minute reminder buckets) rather than read from a single due-time column.
+# - Due handlers run as independent tasks (one per handler, re-run when new entries arrive while busy),
+#   so a long SCM/FM drain no longer holds back WCT expiries or other kinds.
+# - The timeline is patched from Postgres NOTIFY (schedule_notify); the safety-net resync
+#   defaults to 15 minutes when LISTEN is enabled.
+# - Catch-up mode: schedules overdue by more than SCHEDULER_OVERDUE_SECONDS are drained oldest-first
+#   by run_catchup() at the catchup_rate_per_minute setting, while the timeline keeps on-time work flowing.
+# - Window refills only load schedules of users in this worker's hash partition;
+#   added run_partitioned_scheduler() and request_full_resync() for rebalancing.
+# - Added KIND_RETRY (receiver send retries, keyed by message_receivers.id).
+# - Added KIND_WCT (end of check-in windows); CLC entries are only loaded for users in ANS_CLC.
+
+import os
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select, func, true
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db.database import AsyncSessionLocal
+from ..db.models import (
+    User, Message, FmSchedule, SimpleCronMessage, UserConfiguration, SystemSetting, DeliveryLedger,
+    SCMStatusEnum, UserAccountStatusEnum
+)
+from .scheduler_partition import current_partition, owned_by_this_worker, heartbeat, run_partition_heartbeat
+from .schedule_notify import run_schedule_listener, SCHEDULER_LISTEN_ENABLED
+from .clc_jitter import refresh_clc_jitter, jittered_prompt_at, jittered_from_hash
+
+logger = logging.getLogger(__name__)
+
+# Khoảng thời gian phía trước được nạp vào heap
+SCHEDULER_WINDOW_SECONDS = int(os.environ.get("SCHEDULER_WINDOW_SECONDS", "600"))
+# Số dòng tối đa nạp cho mỗi loại lịch trong một lần refill
+SCHEDULER_WINDOW_LIMIT = int(os.environ.get("SCHEDULER_WINDOW_LIMIT", "5000"))
+# Chu kỳ nạp lại toàn bộ cửa sổ (lưới an toàn cho các thay đổi lịch trình).
+# Khi có LISTEN/NOTIFY, thay đổi được đẩy tới ngay nên lưới an toàn có thể thưa hơn nhiều.
+SCHEDULER_RESYNC_SECONDS = int(os.environ.get("SCHEDULER_RESYNC_SECONDS", "900" if SCHEDULER_LISTEN_ENABLED else "60"))
+# Lịch trễ hơn ngưỡng này là "quá hạn" (vd: sau downtime) và được xả qua luồng catch-up có giới hạn tốc độ
+SCHEDULER_CATCHUP_ENABLED = os.environ.get("SCHEDULER_CATCHUP_ENABLED", "true").lower() == "true"
+SCHEDULER_OVERDUE_SECONDS = int(os.environ.get("SCHEDULER_OVERDUE_SECONDS", "900"))
+# Chu kỳ kiểm tra backlog khi không có gì để catch-up
+SCHEDULER_CATCHUP_POLL_SECONDS = int(os.environ.get("SCHEDULER_CATCHUP_POLL_SECONDS", "60"))
+
+CATCHUP_RATE_SETTING = "catchup_rate_per_minute"
+CATCHUP_RATE_DEFAULT = 60
+
+# Các loại lịch trình được theo dõi
+KIND_FM = 'fm'
+KIND_SCM = 'scm'
+KIND_CLC = 'clc'
+KIND_WCT = 'wct'
+KIND_RETRY = 'retry'
+KIND_WCT_REMINDER = 'wct_reminder'
+# Không phải lịch trình: thông báo UserSmtpSettings của user đã đổi/bị xóa (id = user_id)
+KIND_SMTP_SETTINGS = 'smtp_settings'
+
+DueHandler = Callable[[List[str]], Awaitable[None]]
+# Change listener: (entity_id) -> None, gọi ngay trong callback NOTIFY (không được chặn)
+ChangeListener = Callable[[str], None]
+# Window loader: (db, lower_bound, window_end) -> [(entity_id, due_at)] cho các entry trong cửa sổ
+WindowLoader = Callable[[AsyncSession, Optional[datetime], datetime], Awaitable[List[Tuple[str, datetime]]]]
+
+
+class DueWindow(NamedTuple):
+    """Khoảng thời điểm đến hạn (after, until] mà một lượt claim được phép lấy."""
+    after: Optional[datetime]
+    until: datetime
+
+    def contains(self, due_column):
+        condition = due_column <= self.until
+        if self.after is not None:
+            condition = condition & (due_column > self.after)
+        return condition
+
+
+def overdue_cutoff(now_utc: datetime) -> Optional[datetime]:
+    """Lịch đến hạn trước (hoặc đúng) mốc này thuộc luồng catch-up; None nếu tắt catch-up."""
+    if not SCHEDULER_CATCHUP_ENABLED:
+        return None
+    return now_utc - timedelta(seconds=SCHEDULER_OVERDUE_SECONDS)
+
+
+def fresh_window(now_utc: datetime) -> DueWindow:
+    """Luồng đúng giờ của các handler: chỉ lịch vừa đến hạn (mọi lịch đến hạn nếu tắt catch-up)."""
+    return DueWindow(overdue_cutoff(now_utc), now_utc)
+
+
+# Catch-up handler: (batch_size, window) -> số dòng đã xử lý
+CatchupHandler = Callable[[int, DueWindow], Awaitable[int]]
+
+
+class ScheduleTimeline:
+    """
+    Min-heap các thời điểm đến hạn gần nhất, khóa theo (kind, entity_id).
+    Heap chỉ là gợi ý để thức dậy đúng lúc: handler vẫn claim dữ liệu từ DB,
+    nên một entry cũ (stale) chỉ gây ra một lần thức dậy vô hại.
+    """
+    def __init__(self):
+        self._heap: List[Tuple[datetime, str, str]] = []
+        # Thời điểm đến hạn hiện hành của mỗi entry; entry trong heap khác giá trị này là stale
+        self._due: Dict[Tuple[str, str], datetime] = {}
+        self.window_end: Optional[datetime] = None
+        self.resync_requested = False
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def wakeup(self) -> asyncio.Event:
+        # Tạo Event trong event loop đang chạy (tránh gắn nhầm loop trên Python 3.9)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def upsert(self, kind: str, entity_id, due_at: Optional[datetime]):
+        """Thêm hoặc cập nhật thời điểm đến hạn; None nghĩa là xóa entry."""
+        key = (kind, str(entity_id))
+        if due_at is None or (self.window_end is not None and due_at > self.window_end):
+            # Ngoài cửa sổ: sẽ được nạp lại khi cửa sổ trượt tới
+            self._due.pop(key, None)
+            return
+        if self._due.get(key) == due_at:
+            return
+        head = self.peek()
+        self._due[key] = due_at
+        heapq.heappush(self._heap, (due_at, kind, key[1]))
+        if head is None or due_at < head:
+            self.wakeup.set()
+
+    def remove(self, kind: str, entity_id):
+        self._due.pop((kind, str(entity_id)), None)
+
+    def clear(self):
+        self._heap.clear()
+        self._due.clear()
+        self.window_end = None
+
+    def peek(self) -> Optional[datetime]:
+        """Trả về thời điểm đến hạn sớm nhất, bỏ qua các entry stale."""
+        while self._heap:
+            due_at, kind, entity_id = self._heap[0]
+            if self._due.get((kind, entity_id)) == due_at:
+                return due_at
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now_utc: datetime) -> Dict[str, List[str]]:
+        """Lấy ra tất cả entry đã đến hạn, nhóm theo kind."""
+        due_by_kind: Dict[str, List[str]] = {}
+        while True:
+            head = self.peek()
+            if head is None or head > now_utc:
+                break
+            _, kind, entity_id = heapq.heappop(self._heap)
+            del self._due[(kind, entity_id)]
+            due_by_kind.setdefault(kind, []).append(entity_id)
+        return due_by_kind
+
+    async def wait(self, timeout: float):
+        """Ngủ tới khi hết timeout hoặc có entry mới sớm hơn head."""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.wakeup.clear()
+
+
+# Instance duy nhất cho toàn bộ process
+scheduler_timeline = ScheduleTimeline()
+_handlers: Dict[str, DueHandler] = {}
+_catchup_handlers: Dict[str, CatchupHandler] = {}
+_window_loaders: Dict[str, WindowLoader] = {}
+_change_listeners: Dict[str, ChangeListener] = {}
+# Task đang chạy của mỗi handler và các id đến hạn đang chờ lượt chạy kế tiếp của handler đó
+_running_handlers: Dict[DueHandler, asyncio.Task] = {}
+_pending_handler_ids: Dict[DueHandler, List[str]] = {}
+
+
+def register_handler(kind: str, handler: DueHandler):
+    """Đăng ký coroutine xử lý khi có lịch trình thuộc `kind` đến hạn."""
+    _handlers[kind] = handler
+
+
+def register_catchup_handler(kind: str, handler: CatchupHandler):
+    """Đăng ký coroutine xả lịch quá hạn của `kind`; các kind này không còn được nạp quá hạn vào heap."""
+    _catchup_handlers[kind] = handler
+
+
+def register_window_loader(kind: str, loader: WindowLoader):
+    """Đăng ký hàm nạp các entry của `kind` cho mỗi lần refill (ngoài các bảng trong _window_sources)."""
+    _window_loaders[kind] = loader
+
+
+def register_change_listener(kind: str, listener: ChangeListener):
+    """Đăng ký callback cho thông báo NOTIFY của `kind` không phải lịch trình (không được đưa vào timeline)."""
+    _change_listeners[kind] = listener
+
+
+def _users_in_status(account_status: UserAccountStatusEnum):
+    return UserConfiguration.user_id.in_(select(User.id).where(User.account_status == account_status))
+
+
+def _owned_messages(message_id_column):
+    """Điều kiện phân vùng cho các bảng chỉ liên kết với user qua messages."""
+    if not current_partition.is_partitioned:
+        return true()
+    return message_id_column.in_(select(Message.id).where(owned_by_this_worker(Message.user_id)))
+
+
+def _clc_prompt_condition():
+    return UserConfiguration.is_clc_enabled.is_(True) & _users_in_status(UserAccountStatusEnum.ANS_CLC)
+
+
+def _window_sources(partitioned: bool = True):
+    """
+    (kind, cột id, cột thời điểm, điều kiện) cho mỗi bảng lịch trình, giới hạn trong phân vùng
+    của worker (partitioned=False: toàn hệ thống, dùng cho thống kê).
+    """
+    owned_users = owned_by_this_worker if partitioned else (lambda user_id_column: true())
+    owned_messages = _owned_messages if partitioned else (lambda message_id_column: true())
+    return [
+        (KIND_FM, FmSchedule.message_id, FmSchedule.next_send_at,
+         (FmSchedule.repeat_number > 0) & owned_messages(FmSchedule.message_id)),
+        (KIND_SCM, SimpleCronMessage.id, SimpleCronMessage.next_send_at,
+         (SimpleCronMessage.status == SCMStatusEnum.active) & owned_users(SimpleCronMessage.user_id)),
+        (KIND_CLC, UserConfiguration.user_id, jittered_prompt_at(UserConfiguration.next_clc_prompt_at, UserConfiguration.user_id),
+         _clc_prompt_condition() & owned_users(UserConfiguration.user_id)),
+        (KIND_WCT, UserConfiguration.user_id, UserConfiguration.wct_active_ends_at,
+         _users_in_status(UserAccountStatusEnum.ANS_WCT) & owned_users(UserConfiguration.user_id)),
+        (KIND_RETRY, DeliveryLedger.idempotency_key, DeliveryLedger.next_retry_at,
+         owned_users(DeliveryLedger.user_id)),
+    ]
+
+
+async def refill_timeline(db: AsyncSession, timeline: ScheduleTimeline, now_utc: datetime, full: bool = False) -> int:
+    """
+    Nạp các thời điểm đến hạn trong cửa sổ [window_end cũ, now + SCHEDULER_WINDOW_SECONDS].
+    full=True nạp lại từ đầu (bao gồm cả các lịch đã quá hạn).
+    """
+    lower_bound = None if full or timeline.window_end is None else timeline.window_end
+    await refresh_clc_jitter(db)
+    new_window_end = now_utc + timedelta(seconds=SCHEDULER_WINDOW_SECONDS)
+    cutoff = overdue_cutoff(now_utc)
+    loaded_rows: List[Tuple[str, str, datetime]] = []
+
+    for kind, id_column, due_column, condition in _window_sources():
+        stmt = select(id_column, due_column).where(condition, due_column.is_not(None), due_column <= new_window_end)
+        if lower_bound is not None:
+            stmt = stmt.where(due_column >= lower_bound)
+        if cutoff is not None and kind in _catchup_handlers:
+            # Lịch quá hạn thuộc về run_catchup(), không nạp vào heap
+            stmt = stmt.where(due_column > cutoff)
+        stmt = stmt.order_by(due_column).limit(SCHEDULER_WINDOW_LIMIT)
+        rows = (await db.execute(stmt)).all()
+        if len(rows) == SCHEDULER_WINDOW_LIMIT:
+            # Quá nhiều dòng: thu hẹp cửa sổ tới dòng cuối cùng đã nạp, phần còn lại nạp ở lần sau
+            new_window_end = min(new_window_end, rows[-1][1])
+        loaded_rows.extend((kind, str(entity_id), due_at) for entity_id, due_at in rows)
+    for kind, loader in _window_loaders.items():
+        rows = await loader(db, lower_bound, new_window_end)
+        loaded_rows.extend((kind, str(entity_id), due_at) for entity_id, due_at in rows)
+
+    if full:
+        timeline.clear()
+    timeline.window_end = new_window_end
+    for kind, entity_id, due_at in loaded_rows:
+        timeline.upsert(kind, entity_id, due_at)
+    return len(loaded_rows)
+
+
+def _on_schedule_change(kind: str, entity_id: str, due_at: Optional[datetime], user_hash: int):
+    """Thay đổi từ NOTIFY mang giờ danh nghĩa; prompt CLC được dời theo độ lệch của user như khi refill."""
+    if kind in _change_listeners:
+        _change_listeners[kind](entity_id)
+        return
+    if kind == KIND_CLC:
+        due_at = jittered_from_hash(due_at, user_hash)
+    scheduler_timeline.upsert(kind, entity_id, due_at)
+
+
+def _start_handler(handler: DueHandler):
+    task = asyncio.create_task(handler(_pending_handler_ids.pop(handler)))
+    _running_handlers[handler] = task
+    task.add_done_callback(lambda finished: _on_handler_done(handler, finished))
+
+
+def _on_handler_done(handler: DueHandler, task: asyncio.Task):
+    _running_handlers.pop(handler, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"SCHEDULER: A due handler failed: {task.exception()}", exc_info=task.exception())
+    if handler in _pending_handler_ids and not task.cancelled():
+        # Có entry đến hạn trong lúc handler đang bận: chạy thêm một lượt
+        _start_handler(handler)
+
+
+def _start_due_handlers(due_by_kind: Dict[str, List[str]]):
+    """
+    Giao các entry đến hạn cho handler mà không chờ handler chạy xong: mỗi handler chạy trong task riêng,
+    nên một handler đang xả backlog lớn (vd: SCM) không chặn các kind khác. Handler đang bận sẽ được
+    chạy thêm một lượt khi xong (các handler vốn claim mọi thứ đã đến hạn, không chỉ các id được giao).
+    """
+    # Một handler có thể phục vụ nhiều kind (vd: sweeper cho CLC và WCT); chỉ gọi nó một lần
+    for kind, entity_ids in due_by_kind.items():
+        handler = _handlers.get(kind)
+        if handler is None:
+            logger.debug(f"SCHEDULER: No handler registered for '{kind}'. Dropping {len(entity_ids)} due entries.")
+            continue
+        _pending_handler_ids.setdefault(handler, []).extend(entity_ids)
+    for handler in list(_pending_handler_ids):
+        if handler not in _running_handlers:
+            _start_handler(handler)
+
+
+async def _cancel_running_handlers():
+    _pending_handler_ids.clear()
+    tasks = list(_running_handlers.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_scheduler():
+    """
+    Vòng lặp chính: ngủ đúng tới thời điểm của head trong heap, gọi handler
+    tương ứng, và trượt cửa sổ nạp dữ liệu khi cần.
+    """
+    timeline = scheduler_timeline
+    logger.info(f"Scheduler has started (window={SCHEDULER_WINDOW_SECONDS}s, resync={SCHEDULER_RESYNC_SECONDS}s).")
+    try:
+        await _scheduler_loop(timeline)
+    finally:
+        await asyncio.shield(_cancel_running_handlers())
+
+
+async def _scheduler_loop(timeline: ScheduleTimeline):
+    next_resync_at: Optional[datetime] = None
+    while True:
+        now_utc = datetime.now(timezone.utc)
+        try:
+            full = next_resync_at is None or now_utc >= next_resync_at or timeline.resync_requested
+            timeline.resync_requested = False
+            needs_refill = timeline.window_end is None or (timeline.window_end - now_utc).total_seconds() < SCHEDULER_WINDOW_SECONDS / 2
+            if full or needs_refill:
+                async with AsyncSessionLocal() as db:
+                    loaded = await refill_timeline(db, timeline, now_utc, full=full)
+                logger.debug(f"SCHEDULER: Loaded {loaded} entries (full={full}). Window ends at {timeline.window_end}.")
+                if full:
+                    next_resync_at = now_utc + timedelta(seconds=SCHEDULER_RESYNC_SECONDS)
+        except Exception as e:
+            logger.error(f"SCHEDULER: Failed to refill the timeline: {e}", exc_info=True)
+            next_resync_at = now_utc + timedelta(seconds=SCHEDULER_RESYNC_SECONDS)
+
+        due_by_kind = timeline.pop_due(now_utc)
+        if due_by_kind:
+            _start_due_handlers(due_by_kind)
+
+        # Ngủ tới head, nhưng không quá lần refill/resync kế tiếp
+        now_utc = datetime.now(timezone.utc)
+        wake_candidates = [next_resync_at]
+        if timeline.window_end is not None:
+            wake_candidates.append(timeline.window_end - timedelta(seconds=SCHEDULER_WINDOW_SECONDS / 2))
+        head = timeline.peek()
+        if head is not None:
+            wake_candidates.append(head)
+        sleep_seconds = (min(wake_candidates) - now_utc).total_seconds()
+        await timeline.wait(sleep_seconds)
+
+
+async def measure_backlog(db: AsyncSession, cutoff: datetime, partitioned: bool = True) -> Dict[str, Tuple[int, Optional[datetime]]]:
+    """kind -> (số lịch đến hạn trước cutoff, thời điểm đến hạn cũ nhất) cho các kind có catch-up handler."""
+    backlog: Dict[str, Tuple[int, Optional[datetime]]] = {}
+    for kind, id_column, due_column, condition in _window_sources(partitioned):
+        if kind not in _catchup_handlers:
+            continue
+        stmt = select(func.count(id_column), func.min(due_column)).where(condition, due_column <= cutoff)
+        count, oldest_due_at = (await db.execute(stmt)).one()
+        backlog[kind] = (count, oldest_due_at)
+    return backlog
+
+
+async def measure_clc_load_profile(
+    db: AsyncSession, start_utc: datetime, end_utc: datetime, jitter_seconds: int
+) -> Dict[datetime, Tuple[int, int]]:
+    """
+    Phút -> (số prompt CLC theo giờ danh nghĩa, số prompt sau khi dời với jitter_seconds) trên toàn hệ thống,
+    cho các prompt (danh nghĩa hoặc thực tế) rơi vào [start_utc, end_utc).
+    """
+    nominal = UserConfiguration.next_clc_prompt_at
+    profile: Dict[datetime, List[int]] = {}
+    for index, due_column in enumerate((nominal, jittered_prompt_at(nominal, UserConfiguration.user_id, jitter_seconds))):
+        minute = func.date_trunc('minute', due_column)
+        stmt = (
+            select(minute, func.count())
+            .where(_clc_prompt_condition(), due_column >= start_utc, due_column < end_utc)
+            .group_by(minute)
+        )
+        for minute_at, count in (await db.execute(stmt)).all():
+            profile.setdefault(minute_at, [0, 0])[index] = count
+    return {minute_at: (counts[0], counts[1]) for minute_at, counts in sorted(profile.items())}
+
+
+async def load_catchup_rate(db: AsyncSession) -> int:
+    """Số lịch quá hạn tối đa được xả mỗi phút trên toàn hệ thống (system setting catchup_rate_per_minute)."""
+    stmt = select(SystemSetting.setting_value).where(SystemSetting.setting_key == CATCHUP_RATE_SETTING)
+    value = (await db.execute(stmt)).scalar_one_or_none()
+    try:
+        return max(1, int(value)) if value is not None else CATCHUP_RATE_DEFAULT
+    except ValueError:
+        logger.warning(f"SCHEDULER: Invalid value '{value}' for system setting '{CATCHUP_RATE_SETTING}'. Using default {CATCHUP_RATE_DEFAULT}.")
+        return CATCHUP_RATE_DEFAULT
+
+
+async def _catchup_step() -> int:
+    """Xả một batch của kind có lịch quá hạn cũ nhất rồi ngủ theo tốc độ cho phép. Trả về số dòng đã xử lý."""
+    now_utc = datetime.now(timezone.utc)
+    cutoff = overdue_cutoff(now_utc)
+    async with AsyncSessionLocal() as db:
+        backlog = await measure_backlog(db, cutoff)
+        rate_per_minute = await load_catchup_rate(db)
+    pending = {kind: (count, oldest) for kind, (count, oldest) in backlog.items() if count}
+    if not pending:
+        return 0
+
+    # Tốc độ cấu hình là cho cả hệ thống; mỗi worker phân vùng nhận một phần
+    worker_rate = max(1.0, rate_per_minute / current_partition.count)
+    kind = min(pending, key=lambda pending_kind: pending[pending_kind][1])
+    # Mỗi batch tương đương khoảng 10 giây ngân sách gửi
+    batch_size = max(1, min(pending[kind][0], int(worker_rate / 6)))
+    processed = await _catchup_handlers[kind](batch_size, DueWindow(None, cutoff))
+
+    remaining = sum(count for count, _ in pending.values()) - processed
+    logger.info(f"SCHEDULER: Catch-up drained {processed} overdue '{kind}' item(s) (oldest due {pending[kind][1]}); ~{remaining} remaining at {worker_rate:.0f}/min.")
+    await asyncio.sleep(processed * 60 / worker_rate)
+    return processed
+
+
+async def run_catchup():
+    """
+    Luồng catch-up: xả lịch quá hạn (cũ nhất trước) với tốc độ giới hạn, song song với
+    vòng lặp chính vốn chỉ xử lý lịch đúng giờ, để phục hồi sau downtime không thành "thundering herd".
+    """
+    if not SCHEDULER_CATCHUP_ENABLED:
+        return
+    logger.info(f"Scheduler catch-up lane has started (overdue after {SCHEDULER_OVERDUE_SECONDS}s).")
+    while True:
+        try:
+            processed = await _catchup_step()
+        except Exception as e:
+            logger.error(f"SCHEDULER: Catch-up step failed: {e}", exc_info=True)
+            processed = 0
+        if not processed:
+            await asyncio.sleep(SCHEDULER_CATCHUP_POLL_SECONDS)
+
+
+def request_full_resync():
+    """Yêu cầu nạp lại toàn bộ cửa sổ ngay (vd: khi phân vùng của worker thay đổi)."""
+    scheduler_timeline.resync_requested = True
+    scheduler_timeline.wakeup.set()
+
+
+async def run_partitioned_scheduler():
+    """
+    Chạy scheduler như một thành viên của nhóm worker phân vùng theo hash(user_id):
+    đăng ký heartbeat trước để biết phân vùng, rồi chạy song song heartbeat, vòng lặp chính,
+    luồng catch-up và kết nối LISTEN nhận thay đổi lịch trình.
+    Claim trong DB vẫn dùng SKIP LOCKED nên trong lúc cân bằng lại không có tin nào bị gửi trùng.
+    """
+    try:
+        await heartbeat()
+    except Exception as e:
+        logger.error(f"SCHEDULER: Initial partition heartbeat failed, starting as a single worker: {e}", exc_info=True)
+    await asyncio.gather(
+        run_partition_heartbeat(request_full_resync),
+        run_scheduler(),
+        run_catchup(),
+        run_schedule_listener(_on_schedule_change, request_full_resync)
+    )
@@ -0,0 +1,129 @@
+# backend/app/services/scheduler_partition.py
+# NEW FILE
+# Version: 1.3.0
+# Changelog:
+# - Added user_hash() (the abs(hashtext(user_id)) expression shared by partitioning and CLC prompt jitter).
+# - Heartbeats also store this worker's dispatch lane metrics (scheduler_workers.lane_metrics).
+# - Added PartitionAssignment.owns_hash() for user hashes computed in Postgres (schedule notifications).
+
+import os
+import socket
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Callable, List
+
+from sqlalchemy import select, delete, func, cast, true, Text, BigInteger
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..db.database import AsyncSessionLocal
+from ..db.models import SchedulerWorker
+from .dispatch_lanes import lane_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Định danh của process này trong bảng scheduler_workers
+SCHEDULER_WORKER_ID = os.environ.get("SCHEDULER_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Chu kỳ gửi heartbeat và thời gian một worker im lặng trước khi bị coi là đã rời nhóm
+SCHEDULER_HEARTBEAT_SECONDS = int(os.environ.get("SCHEDULER_HEARTBEAT_SECONDS", "10"))
+SCHEDULER_WORKER_TTL_SECONDS = int(os.environ.get("SCHEDULER_WORKER_TTL_SECONDS", "30"))
+
+
+def user_hash(user_id_column):
+    """abs(hashtext(user_id::text)) trong SQL (bigint để abs() không tràn với INT_MIN)."""
+    return func.abs(cast(func.hashtext(cast(user_id_column, Text)), BigInteger))
+
+
+class PartitionAssignment:
+    """
+    Phân vùng user mà worker này sở hữu: mod(abs(hashtext(user_id)), count) == index.
+    Với count <= 1 (chạy một mình), worker sở hữu toàn bộ user.
+    """
+    def __init__(self):
+        self.index = 0
+        self.count = 1
+
+    @property
+    def is_partitioned(self) -> bool:
+        return self.count > 1
+
+    def update(self, index: int, count: int) -> bool:
+        """Trả về True nếu phân vùng thay đổi."""
+        if (index, count) == (self.index, self.count):
+            return False
+        self.index, self.count = index, count
+        return True
+
+    def owns(self, user_id_column):
+        """Điều kiện SQL: user_id_column thuộc phân vùng của worker này."""
+        if not self.is_partitioned:
+            return true()
+        return func.mod(user_hash(user_id_column), self.count) == self.index
+
+    def owns_hash(self, user_hash: int) -> bool:
+        """Như owns(), cho giá trị abs(hashtext(user_id)) đã được Postgres tính sẵn."""
+        return not self.is_partitioned or user_hash % self.count == self.index
+
+
+# Instance duy nhất cho toàn bộ process
+current_partition = PartitionAssignment()
+
+
+def owned_by_this_worker(user_id_column):
+    return current_partition.owns(user_id_column)
+
+
+async def heartbeat() -> bool:
+    """
+    Ghi heartbeat (kèm số liệu các làn gửi), loại bỏ các worker đã hết hạn rồi tính lại phân vùng
+    từ danh sách worker còn sống (sắp xếp theo worker_id). Dùng đồng hồ của Postgres để tránh lệch giờ
+    giữa các máy. Trả về True nếu phân vùng của worker này thay đổi.
+    """
+    lane_metrics = lane_scheduler.snapshot()
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            pg_insert(SchedulerWorker)
+            .values(worker_id=SCHEDULER_WORKER_ID, heartbeat_at=func.now(), lane_metrics=lane_metrics)
+            .on_conflict_do_update(
+                index_elements=[SchedulerWorker.worker_id],
+                set_={"heartbeat_at": func.now(), "lane_metrics": lane_metrics}
+            )
+        )
+        await db.execute(
+            delete(SchedulerWorker)
+            .where(SchedulerWorker.heartbeat_at < func.now() - timedelta(seconds=SCHEDULER_WORKER_TTL_SECONDS))
+        )
+        live_workers: List[str] = list(
+            (await db.execute(select(SchedulerWorker.worker_id).order_by(SchedulerWorker.worker_id))).scalars().all()
+        )
+        await db.commit()
+
+    changed = current_partition.update(live_workers.index(SCHEDULER_WORKER_ID), len(live_workers))
+    if changed:
+        logger.info(f"PARTITION: Worker '{SCHEDULER_WORKER_ID}' now owns partition {current_partition.index + 1}/{current_partition.count}.")
+    return changed
+
+
+async def leave():
+    """Rời nhóm ngay (khi tắt máy) để các worker khác nhận lại phân vùng mà không chờ TTL."""
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(SchedulerWorker).where(SchedulerWorker.worker_id == SCHEDULER_WORKER_ID))
+        await db.commit()
+    logger.info(f"PARTITION: Worker '{SCHEDULER_WORKER_ID}' left the scheduler group.")
+
+
+async def run_partition_heartbeat(on_rebalance: Callable[[], None]):
+    """Vòng lặp heartbeat; gọi on_rebalance mỗi khi phân vùng của worker này thay đổi."""
+    try:
+        while True:
+            await asyncio.sleep(SCHEDULER_HEARTBEAT_SECONDS)
+            try:
+                if await heartbeat():
+                    on_rebalance()
+            except Exception as e:
+                logger.error(f"PARTITION: Heartbeat failed: {e}", exc_info=True)
+    finally:
+        try:
+            await asyncio.shield(leave())
+        except Exception as e:
+            logger.warning(f"PARTITION: Could not leave the scheduler group cleanly: {e}")
@@ -0,0 +1,168 @@
+# backend/app/services/send_rate_limiter.py
+# NEW FILE
+# Version: 1.0.0
+
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select, update, func, literal, Float
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..db.database import AsyncSessionLocal
+from ..db.models import RateLimitBucket, SystemSetting
+
+logger = logging.getLogger(__name__)
+
+# Mỗi transport SMTP có một token bucket trong bảng rate_limit_buckets, dùng chung cho mọi worker
+# và replica. Tốc độ nạp là email_sending_rate_per_hours (0 = không giới hạn); SMTP riêng của
+# mỗi user có bucket riêng với cùng tốc độ (giới hạn của nhà cung cấp tính theo tài khoản).
+RATE_SETTING = "email_sending_rate_per_hours"
+RATE_DEFAULT = 50
+SYSTEM_SMTP_BUCKET = "smtp:system"
+
+# Dung lượng bucket tính bằng số giây nạp (cho phép gửi dồn tối đa chừng này giây của tốc độ)
+RATE_LIMIT_BURST_SECONDS = float(os.environ.get("RATE_LIMIT_BURST_SECONDS", "60"))
+# Số token tối đa lấy trước về process trong một lần UPDATE (tránh một lượt DB cho mỗi email)
+RATE_LIMIT_PREFETCH = int(os.environ.get("RATE_LIMIT_PREFETCH", "5"))
+# Chờ token lâu hơn mức này thì bỏ cuộc (SendRateLimited) để caller hẹn gửi lại
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get("RATE_LIMIT_MAX_WAIT_SECONDS", "120"))
+# Chu kỳ đọc lại system setting
+RATE_LIMIT_SETTINGS_TTL_SECONDS = float(os.environ.get("RATE_LIMIT_SETTINGS_TTL_SECONDS", "60"))
+
+
+class SendRateLimited(RuntimeError):
+    """Bucket của transport chưa có token trong RATE_LIMIT_MAX_WAIT_SECONDS; retry_after là số giây nên chờ."""
+    def __init__(self, bucket_key: str, retry_after: float):
+        super().__init__(f"Sending rate limit of '{bucket_key}' reached; retry in {retry_after:.1f}s.")
+        self.bucket_key = bucket_key
+        self.retry_after = retry_after
+
+
+def user_smtp_bucket(user_id) -> str:
+    return f"smtp:user:{user_id}"
+
+
+class _LocalBucket:
+    """Các token đã lấy trước về process. Token chưa dùng hết hạn sau RATE_LIMIT_BURST_SECONDS để không gửi dồn vượt dung lượng bucket."""
+    def __init__(self):
+        self.tokens = 0
+        self.expires_at = 0.0
+        self.waiting = 0
+        # asyncio.Lock phục vụ theo thứ tự FIFO: người chờ trước lấy token trước
+        self.lock = asyncio.Lock()
+
+
+_local_buckets: Dict[str, _LocalBucket] = {}
+_rate_per_hour: Optional[int] = None
+_rate_loaded_at = 0.0
+
+
+async def _load_rate_per_hour() -> int:
+    global _rate_per_hour, _rate_loaded_at
+    now = time.monotonic()
+    if _rate_per_hour is not None and now - _rate_loaded_at < RATE_LIMIT_SETTINGS_TTL_SECONDS:
+        return _rate_per_hour
+    async with AsyncSessionLocal() as db:
+        value = (await db.execute(
+            select(SystemSetting.setting_value).where(SystemSetting.setting_key == RATE_SETTING)
+        )).scalar_one_or_none()
+    try:
+        rate = max(0, int(value)) if value is not None else RATE_DEFAULT
+    except ValueError:
+        logger.warning(f"RATE_LIMIT: Invalid value '{value}' for system setting '{RATE_SETTING}'. Using default {RATE_DEFAULT}.")
+        rate = RATE_DEFAULT
+    if rate != _rate_per_hour:
+        logger.info(f"RATE_LIMIT: Email transports are limited to {rate or 'unlimited'} email(s) per hour.")
+    _rate_per_hour, _rate_loaded_at = rate, now
+    return rate
+
+
+def _bucket_capacity(rate_per_hour: int) -> float:
+    return max(1.0, rate_per_hour * RATE_LIMIT_BURST_SECONDS / 3600)
+
+
+async def take_tokens(bucket_key: str, wanted: int, rate_per_hour: int) -> Tuple[int, float]:
+    """
+    Nạp lại bucket theo thời gian đã trôi qua rồi lấy tối đa `wanted` token, trong một UPDATE
+    trên dòng đã khóa (an toàn khi nhiều worker cùng lấy). Bucket chưa có được tạo đầy.
+    Trả về (số token lấy được, số giây cần chờ đến token tiếp theo nếu không lấy được token nào).
+    """
+    capacity = literal(_bucket_capacity(rate_per_hour), Float)
+    per_second = rate_per_hour / 3600
+    elapsed = func.extract("epoch", func.now() - RateLimitBucket.refilled_at)
+    current = (
+        select(
+            RateLimitBucket.bucket_key,
+            func.least(capacity, RateLimitBucket.tokens + elapsed * literal(per_second, Float)).label("available")
+        )
+        .where(RateLimitBucket.bucket_key == bucket_key)
+        .with_for_update()
+        .cte("current_bucket")
+    )
+    granted = func.least(literal(wanted, Float), func.floor(current.c.available))
+    stmt = (
+        update(RateLimitBucket)
+        .where(RateLimitBucket.bucket_key == current.c.bucket_key)
+        .values(tokens=current.c.available - granted, refilled_at=func.now())
+        .returning(granted.label("granted"), current.c.available)
+        .execution_options(synchronize_session=False)
+    )
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(stmt)).first()
+        if row is None:
+            await db.execute(
+                pg_insert(RateLimitBucket)
+                .values(bucket_key=bucket_key, tokens=_bucket_capacity(rate_per_hour))
+                .on_conflict_do_nothing(index_elements=[RateLimitBucket.bucket_key])
+            )
+            row = (await db.execute(stmt)).first()
+        await db.commit()
+    granted_tokens = int(row.granted)
+    if granted_tokens:
+        return granted_tokens, 0.0
+    return 0, (1 - row.available) / per_second
+
+
+async def acquire_send_token(bucket_key: str = SYSTEM_SMTP_BUCKET):
+    """
+    Chờ đến khi bucket của transport cho phép gửi thêm một email. Token được lấy trước theo lô
+    (tối đa RATE_LIMIT_PREFETCH, không quá số lần gửi đang chờ) nên phần lớn lần gửi không cần tới DB.
+    Ném SendRateLimited nếu phải chờ quá RATE_LIMIT_MAX_WAIT_SECONDS. Lỗi DB không chặn việc gửi.
+    """
+    if AsyncSessionLocal is None:
+        return
+    try:
+        rate_per_hour = await _load_rate_per_hour()
+    except Exception as e:
+        logger.error(f"RATE_LIMIT: Could not read '{RATE_SETTING}'; sending without the rate limit. Error: {e}")
+        return
+    if rate_per_hour <= 0:
+        return
+
+    bucket = _local_buckets.setdefault(bucket_key, _LocalBucket())
+    deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT_SECONDS
+    bucket.waiting += 1
+    try:
+        async with bucket.lock:
+            while True:
+                now = time.monotonic()
+                if bucket.tokens > 0 and now < bucket.expires_at:
+                    bucket.tokens -= 1
+                    return
+                try:
+                    granted, wait_seconds = await take_tokens(bucket_key, max(1, min(RATE_LIMIT_PREFETCH, bucket.waiting)), rate_per_hour)
+                except Exception as e:
+                    logger.error(f"RATE_LIMIT: Could not take a token from '{bucket_key}'; sending without the rate limit. Error: {e}")
+                    return
+                if granted:
+                    bucket.tokens = granted - 1
+                    bucket.expires_at = now + RATE_LIMIT_BURST_SECONDS
+                    return
+                if now + wait_seconds > deadline:
+                    raise SendRateLimited(bucket_key, wait_seconds)
+                await asyncio.sleep(wait_seconds)
+    finally:
+        bucket.waiting -= 1
@@ -0,0 +1,201 @@
+# backend/app/services/smtp_async.py
+# NEW FILE
+# Version: 1.0.0
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from email.message import Message
+from typing import Deque, Dict, Optional, Tuple
+
+try:
+    import aiosmtplib
+except ImportError: # Không có aiosmtplib: email_service dùng smtplib trong threadpool
+    aiosmtplib = None
+
+from .smtp_pool import (
+    SMTPPoolExhausted, SMTP_POOL_IDLE_TIMEOUT_SECONDS, SMTP_POOL_HEALTHCHECK_AFTER_SECONDS,
+    SMTP_POOL_MAX_MESSAGES_PER_CONNECTION, SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS, SMTP_TIMEOUT_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# "async": gửi bằng aiosmtplib trên event loop; "threadpool": smtplib trong threadpool (fallback)
+SMTP_TRANSPORT = os.environ.get("SMTP_TRANSPORT", "async").lower()
+SMTP_ASYNC_ENABLED = SMTP_TRANSPORT == "async" and aiosmtplib is not None
+# Không giữ thread nên có thể mở nhiều kết nối hơn pool của threadpool
+SMTP_ASYNC_POOL_SIZE = int(os.environ.get("SMTP_ASYNC_POOL_SIZE", "50"))
+
+if SMTP_TRANSPORT == "async" and aiosmtplib is None:
+    logger.warning("SMTP_ASYNC: aiosmtplib is not installed; emails are sent with smtplib in the threadpool.")
+
+
+class _AsyncPooledConnection:
+    def __init__(self, server: "aiosmtplib.SMTP"):
+        self.server = server
+        self.released_at = time.monotonic()
+        self.sent = 0
+
+    async def close(self):
+        try:
+            await self.server.quit()
+        except Exception:
+            self.server.close()
+
+
+async def open_async_smtp_connection(
+    host: str, port: int, username: str, password: str, timeout: float = SMTP_TIMEOUT_SECONDS
+) -> "aiosmtplib.SMTP":
+    """Như smtp_pool.open_smtp_connection: TLS ngay cho port 465, STARTTLS cho các port khác (587)."""
+    if port == 465:
+        server = aiosmtplib.SMTP(hostname=host, port=port, use_tls=True, timeout=timeout)
+    else:
+        server = aiosmtplib.SMTP(hostname=host, port=port, start_tls=True, timeout=timeout)
+    await server.connect()
+    try:
+        await server.login(username, password)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+class AsyncSMTPConnectionPool:
+    """
+    Bản asyncio của smtp_pool.SMTPConnectionPool (cùng chính sách NOOP, idle timeout, gửi lại
+    một lần khi kết nối cũ bị ngắt). Lần gửi đang chờ kết nối chỉ là một coroutine, không giữ thread,
+    nên hàng nghìn lần gửi có thể cùng chạy trên một event loop. Chỉ dùng trong một event loop.
+    """
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        max_size: int = SMTP_ASYNC_POOL_SIZE,
+        idle_timeout: float = SMTP_POOL_IDLE_TIMEOUT_SECONDS
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self._password = password
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self._idle: Deque[_AsyncPooledConnection] = deque()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.opened = 0
+        self.reused = 0
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        # Tạo trong event loop đang chạy
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_size)
+        return self._slots
+
+    async def _take_idle(self) -> Optional[_AsyncPooledConnection]:
+        while self._idle:
+            pooled = self._idle.pop()
+            idle_seconds = time.monotonic() - pooled.released_at
+            if idle_seconds > self.idle_timeout or not pooled.server.is_connected:
+                await pooled.close()
+                continue
+            if idle_seconds > SMTP_POOL_HEALTHCHECK_AFTER_SECONDS:
+                try:
+                    code = (await pooled.server.noop()).code
+                except (aiosmtplib.SMTPException, OSError):
+                    code = None
+                if code != 250:
+                    await pooled.close()
+                    continue
+            return pooled
+        return None
+
+    async def _checkout(self) -> Tuple[_AsyncPooledConnection, bool]:
+        pooled = await self._take_idle()
+        if pooled is not None:
+            self.reused += 1
+            return pooled, True
+        pooled = _AsyncPooledConnection(await open_async_smtp_connection(self.host, self.port, self.username, self._password))
+        self.opened += 1
+        return pooled, False
+
+    async def _release(self, pooled: _AsyncPooledConnection):
+        if pooled.sent >= SMTP_POOL_MAX_MESSAGES_PER_CONNECTION:
+            await pooled.close()
+            return
+        pooled.released_at = time.monotonic()
+        self._idle.append(pooled)
+        while self._idle and pooled.released_at - self._idle[0].released_at > self.idle_timeout:
+            await self._idle.popleft().close()
+
+    async def send_message(self, msg: Message):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise SMTPPoolExhausted(f"No SMTP connection to {self.host}:{self.port} became available within {SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS}s.")
+        try:
+            pooled, reused = await self._checkout()
+            try:
+                await pooled.server.send_message(msg)
+            except (aiosmtplib.SMTPServerDisconnected, ConnectionError) as e:
+                await pooled.close()
+                if not reused:
+                    raise
+                logger.info(f"SMTP_ASYNC: Pooled connection to {self.host}:{self.port} was dropped ({e}); retrying on a new connection.")
+                pooled, _ = await self._checkout()
+                try:
+                    await pooled.server.send_message(msg)
+                except Exception:
+                    await pooled.close()
+                    raise
+            except aiosmtplib.SMTPRecipientsRefused:
+                await self._release(pooled)
+                raise
+            except aiosmtplib.SMTPResponseException as e:
+                if e.code == 421:
+                    await pooled.close()
+                else:
+                    await self._release(pooled)
+                raise
+            except BaseException:
+                # Gồm cả CancelledError: trạng thái phiên không rõ nên không trả lại pool
+                pooled.server.close()
+                raise
+            pooled.sent += 1
+            await self._release(pooled)
+        finally:
+            self.slots.release()
+
+    async def close(self):
+        while self._idle:
+            await self._idle.popleft().close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"idle": len(self._idle), "opened": self.opened, "reused": self.reused}
+
+
+_async_pools: Dict[Tuple[str, int, str], AsyncSMTPConnectionPool] = {}
+
+
+async def get_async_smtp_pool(host: str, port: int, username: str, password: str) -> AsyncSMTPConnectionPool:
+    """Pool dùng chung của (host, port, username); mật khẩu đổi thì pool cũ bị đóng và thay mới."""
+    key = (host, port, username)
+    pool = _async_pools.get(key)
+    if pool is not None and pool._password != password:
+        del _async_pools[key]
+        await pool.close()
+        pool = None
+    if pool is None:
+        pool = _async_pools[key] = AsyncSMTPConnectionPool(host, port, username, password)
+    return pool
+
+
+async def close_async_smtp_pools():
+    """Đóng mọi kết nối rảnh (khi process dừng)."""
+    pools = list(_async_pools.values())
+    _async_pools.clear()
+    for pool in pools:
+        await pool.close()
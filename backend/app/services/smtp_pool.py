@@ -0,0 +1,222 @@
+# backend/app/services/smtp_pool.py
+# NEW FILE
+# Version: 1.0.0
+
+import os
+import time
+import smtplib
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from email.message import Message
+from typing import Deque, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Số kết nối SMTP tối đa (đang gửi + đang rảnh) của mỗi pool
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "10"))
+# Kết nối rảnh lâu hơn mức này bị đóng (nhiều server tự ngắt kết nối rảnh sau vài phút)
+SMTP_POOL_IDLE_TIMEOUT_SECONDS = float(os.environ.get("SMTP_POOL_IDLE_TIMEOUT_SECONDS", "120"))
+# Kết nối rảnh lâu hơn mức này được kiểm tra bằng NOOP trước khi dùng lại
+SMTP_POOL_HEALTHCHECK_AFTER_SECONDS = float(os.environ.get("SMTP_POOL_HEALTHCHECK_AFTER_SECONDS", "10"))
+# Số email tối đa trên một kết nối trước khi mở kết nối mới (giới hạn của nhiều nhà cung cấp)
+SMTP_POOL_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get("SMTP_POOL_MAX_MESSAGES_PER_CONNECTION", "100"))
+# Thời gian chờ tối đa một kết nối trống khi pool đã đầy
+SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.environ.get("SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS", "60"))
+SMTP_TIMEOUT_SECONDS = 30
+
+
+class SMTPPoolExhausted(RuntimeError):
+    """Không lấy được kết nối trong SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS."""
+
+
+class _PooledConnection:
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.released_at = time.monotonic()
+        self.sent = 0
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+def open_smtp_connection(host: str, port: int, username: str, password: str, timeout: float = SMTP_TIMEOUT_SECONDS) -> smtplib.SMTP:
+    """Mở kết nối đã xác thực: SMTP_SSL cho port 465, STARTTLS cho các port khác (587)."""
+    if port == 465:
+        server = smtplib.SMTP_SSL(host, port, timeout=timeout)
+    else:
+        server = smtplib.SMTP(host, port, timeout=timeout)
+        server.starttls()
+    try:
+        server.login(username, password)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+class SMTPConnectionPool:
+    """
+    Giữ các phiên SMTP đã TLS + AUTH để dùng lại giữa các email (dùng từ nhiều thread của threadpool).
+    Kết nối rảnh được kiểm tra bằng NOOP trước khi dùng lại và bị đóng khi quá idle_timeout;
+    kết nối bị server ngắt giữa chừng được bỏ đi và email được gửi lại một lần trên kết nối mới.
+    """
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        max_size: int = SMTP_POOL_SIZE,
+        idle_timeout: float = SMTP_POOL_IDLE_TIMEOUT_SECONDS
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self._password = password
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        # LIFO: kết nối vừa dùng xong (còn "ấm" nhất) được lấy lại trước
+        self._idle: Deque[_PooledConnection] = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self.opened = 0
+        self.reused = 0
+
+    def _take_idle(self) -> Optional[_PooledConnection]:
+        """Lấy một kết nối rảnh còn dùng được (đóng các kết nối đã hết hạn hoặc không qua NOOP)."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                pooled = self._idle.pop()
+            idle_seconds = time.monotonic() - pooled.released_at
+            if idle_seconds > self.idle_timeout:
+                pooled.close()
+                continue
+            if idle_seconds > SMTP_POOL_HEALTHCHECK_AFTER_SECONDS:
+                try:
+                    code, _ = pooled.server.noop()
+                except (smtplib.SMTPException, OSError):
+                    code = None
+                if code != 250:
+                    pooled.close()
+                    continue
+            return pooled
+
+    def _release(self, pooled: _PooledConnection):
+        if pooled.sent >= SMTP_POOL_MAX_MESSAGES_PER_CONNECTION:
+            pooled.close()
+            return
+        pooled.released_at = time.monotonic()
+        expired = []
+        with self._lock:
+            self._idle.append(pooled)
+            # Kết nối cũ nhất nằm ở đầu hàng đợi: đóng dần các kết nối đã rảnh quá lâu
+            while self._idle and pooled.released_at - self._idle[0].released_at > self.idle_timeout:
+                expired.append(self._idle.popleft())
+        for stale in expired:
+            stale.close()
+
+    @contextmanager
+    def _slot(self) -> Iterator[None]:
+        if not self._slots.acquire(timeout=SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS):
+            raise SMTPPoolExhausted(f"No SMTP connection to {self.host}:{self.port} became available within {SMTP_POOL_ACQUIRE_TIMEOUT_SECONDS}s.")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _checkout(self) -> Tuple[_PooledConnection, bool]:
+        pooled = self._take_idle()
+        if pooled is not None:
+            self.reused += 1
+            return pooled, True
+        pooled = _PooledConnection(open_smtp_connection(self.host, self.port, self.username, self._password))
+        self.opened += 1
+        return pooled, False
+
+    def send_message(self, msg: Message):
+        with self._slot():
+            pooled, reused = self._checkout()
+            try:
+                pooled.server.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                pooled.close()
+                if not reused:
+                    raise
+                # Kết nối cũ bị ngắt (vd: server đóng kết nối rảnh): gửi lại một lần trên kết nối mới
+                logger.info(f"SMTP_POOL: Pooled connection to {self.host}:{self.port} was dropped ({e}); retrying on a new connection.")
+                pooled, _ = self._checkout()
+                try:
+                    pooled.server.send_message(msg)
+                except Exception:
+                    pooled.close()
+                    raise
+            except smtplib.SMTPResponseException as e:
+                # Lỗi theo từng email (người nhận bị từ chối...): smtplib đã RSET nên kết nối vẫn dùng được, trừ 421
+                if e.smtp_code == 421:
+                    pooled.close()
+                else:
+                    self._release(pooled)
+                raise
+            except smtplib.SMTPRecipientsRefused:
+                self._release(pooled)
+                raise
+            except Exception:
+                pooled.close()
+                raise
+            pooled.sent += 1
+            self._release(pooled)
+
+    def close_idle(self, max_idle_seconds: Optional[float] = None) -> int:
+        """Đóng các kết nối rảnh lâu hơn max_idle_seconds (mặc định idle_timeout). Trả về số kết nối đã đóng."""
+        max_idle_seconds = self.idle_timeout if max_idle_seconds is None else max_idle_seconds
+        now = time.monotonic()
+        with self._lock:
+            expired = [pooled for pooled in self._idle if now - pooled.released_at > max_idle_seconds]
+            self._idle = deque(pooled for pooled in self._idle if pooled not in expired)
+        for pooled in expired:
+            pooled.close()
+        return len(expired)
+
+    def close(self):
+        self.close_idle(max_idle_seconds=-1)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            idle = len(self._idle)
+        return {"idle": idle, "opened": self.opened, "reused": self.reused}
+
+
+_pools: Dict[Tuple[str, int, str], SMTPConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_smtp_pool(host: str, port: int, username: str, password: str) -> SMTPConnectionPool:
+    """Pool dùng chung của (host, port, username); mật khẩu đổi thì pool cũ bị đóng và thay mới."""
+    key = (host, port, username)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is not None and pool._password != password:
+            stale, pool = pool, None
+            stale.close()
+        if pool is None:
+            pool = _pools[key] = SMTPConnectionPool(host, port, username, password)
+    return pool
+
+
+def close_smtp_pools():
+    """Đóng mọi kết nối rảnh (khi process dừng)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
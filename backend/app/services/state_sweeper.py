@@ -0,0 +1,323 @@
+# backend/app/services/state_sweeper.py
+# Version: 1.9.0
+# Changelog:
+# - IMs released on FNS are no longer sent inside the freeze transaction (which holds FOR UPDATE locks on the
+#   frozen users): their ledger keys are queued and the IMs set to 'processing' in that transaction, and they
+#   are sent after the commit, as CLC prompts are. An IM is resolved to sent/failed only once all of its
+#   ledger keys are settled (settle_initial_messages); an IM without email receivers ends as failed.
+#   FMs that follow the IM are scheduled from the release time.
+# - WCT -> FNS freezes and the release of the frozen users' messages commit in one transaction: a crash
+#   or error mid-release leaves the users in ANS_WCT and the next pass redoes both steps (the delivery
+#   ledger stops IMs from being sent twice).
+# - CLC prompts are delivery jobs (SOURCE_CLC_PROMPT): their ledger keys are queued in the promotion's
+#   transaction, and failed or interrupted prompts are retried by the ledger while the WCT window is open.
+# - IM retries are scheduled by the delivery ledger (execute_jobs with the retry policy).
+# - An IM receiver already sent by an earlier, interrupted release (no-op ledger result) still counts as
+#   the IM send time for days_after_im FMs.
+# - CLC prompts are claimed at their jittered prompt time (clc_jitter); the WCT window still starts at the nominal time.
+# - Reminder buckets of newly promoted users are scheduled right away (wct_reminders); format_local moved there.
+# - Check-in prompts are sent through the WCT reminder lane (dispatch_lanes), ahead of FM/SCM traffic.
+# - CLC prompts are claimed through a DueWindow; overdue prompts are drained by the scheduler's catch-up lane.
+# - Sweeps are restricted to users in this worker's hash partition.
+# - Failed IM receivers are retried through the delivery retry queue.
+# - Initial Messages released on FNS are delivered through delivery_service.
+
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import select, update, case, func, literal_column, Interval
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db.database import AsyncSessionLocal
+from ..db.models import (
+    User, UserConfiguration, Message, FmSchedule,
+    UserAccountStatusEnum, WTCDurationUnitEnum, MessageOverallStatusEnum, ReceiverChannelEnum, SendingMethodEnum
+)
+from .email_service import get_email_template
+from .dispatch_lanes import LANE_WCT_REMINDER
+from .delivery_service import (
+    expand_receiver_jobs, execute_jobs, record_delivery_results, settle_initial_messages, load_retry_policy,
+    queue_delivery_keys, register_retry_builder, ReceiverJob, SOURCE_CLC_PROMPT, DELIVERY_LEDGER_LEASE_SECONDS
+)
+from .wct_reminders import format_local, schedule_reminders_for
+from .schedule_service import FmScheduleRow, calculate_next_fm_sends_batch
+from .scheduler_partition import owned_by_this_worker
+from .clc_jitter import jittered_prompt_at
+from .scheduler_core import (
+    scheduler_timeline, register_handler, register_catchup_handler, fresh_window, DueWindow,
+    KIND_CLC, KIND_WCT, KIND_FM
+)
+
+logger = logging.getLogger(__name__)
+
+# Số user tối đa được chuyển trạng thái trong một câu UPDATE
+SWEEPER_BATCH_SIZE = int(os.environ.get("SWEEPER_BATCH_SIZE", "1000"))
+# Số email (prompt/IM) được gửi song song
+SWEEPER_EMAIL_CONCURRENCY = int(os.environ.get("SWEEPER_EMAIL_CONCURRENCY", "20"))
+FRONTEND_BASE_URL = os.environ.get("FRONTEND_BASE_URL", "http://localhost")
+
+
+async def promote_clc_to_wct(db: AsyncSession, now_utc: datetime, batch_size: int, window: Optional[DueWindow] = None) -> Sequence:
+    """
+    ANS_CLC -> ANS_WCT cho các user có giờ check-in trong window (mặc định: mọi user đã tới giờ), bằng một câu lệnh duy nhất:
+    UPDATE users (CTE) rồi UPDATE user_configurations.wct_active_ends_at ... RETURNING.
+    Cửa sổ WCT tính từ max(next_clc_prompt_at, now) để user không bị mất cửa sổ khi hệ thống chạy trễ
+    (hoặc khi prompt bị jitter dời muộn hơn; prompt dời sớm hơn thì cửa sổ vẫn tính từ giờ danh nghĩa).
+    """
+    prompt_at = jittered_prompt_at(UserConfiguration.next_clc_prompt_at, UserConfiguration.user_id)
+    due_users = (
+        select(UserConfiguration.user_id)
+        .join(User, User.id == UserConfiguration.user_id)
+        .where(
+            User.account_status == UserAccountStatusEnum.ANS_CLC,
+            UserConfiguration.is_clc_enabled.is_(True),
+            (window or DueWindow(None, now_utc)).contains(prompt_at),
+            owned_by_this_worker(UserConfiguration.user_id)
+        )
+        .order_by(prompt_at)
+        .limit(batch_size)
+        .with_for_update(of=User, skip_locked=True)
+    )
+    promoted = (
+        update(User)
+        .where(User.id.in_(due_users), User.account_status == UserAccountStatusEnum.ANS_CLC)
+        .values(account_status=UserAccountStatusEnum.ANS_WCT, updated_at=now_utc)
+        .returning(User.id, User.email, User.user_name, User.timezone)
+        .cte("promoted")
+    )
+    wct_minutes = case(
+        (UserConfiguration.wct_duration_unit == WTCDurationUnitEnum.minutes, UserConfiguration.wct_duration_value),
+        else_=UserConfiguration.wct_duration_value * 60
+    )
+    stmt = (
+        update(UserConfiguration)
+        .where(UserConfiguration.user_id == promoted.c.id)
+        .values(
+            wct_active_ends_at=func.greatest(UserConfiguration.next_clc_prompt_at, now_utc)
+            + literal_column("interval '1 minute'", Interval) * wct_minutes,
+            updated_at=now_utc
+        )
+        .returning(
+            promoted.c.id, promoted.c.email, promoted.c.user_name, promoted.c.timezone,
+            UserConfiguration.wct_active_ends_at, UserConfiguration.next_clc_prompt_at
+        )
+    )
+    return (await db.execute(stmt)).all()
+
+
+async def freeze_wct_to_fns(db: AsyncSession, now_utc: datetime, batch_size: int) -> Sequence:
+    """ANS_WCT -> FNS cho mọi user có cửa sổ check-in đã hết hạn. Trả về (id, timezone)."""
+    due_users = (
+        select(UserConfiguration.user_id)
+        .join(User, User.id == UserConfiguration.user_id)
+        .where(
+            User.account_status == UserAccountStatusEnum.ANS_WCT,
+            UserConfiguration.wct_active_ends_at <= now_utc,
+            owned_by_this_worker(UserConfiguration.user_id)
+        )
+        .order_by(UserConfiguration.wct_active_ends_at)
+        .limit(batch_size)
+        .with_for_update(of=User, skip_locked=True)
+    )
+    stmt = (
+        update(User)
+        .where(User.id.in_(due_users), User.account_status == UserAccountStatusEnum.ANS_WCT)
+        .values(account_status=UserAccountStatusEnum.FNS, updated_at=now_utc)
+        .returning(User.id, User.timezone)
+    )
+    return (await db.execute(stmt)).all()
+
+
+def clc_prompt_job(row, due_at: Optional[datetime] = None) -> ReceiverJob:
+    """
+    Email nhắc check-in của một user vừa chuyển sang ANS_WCT (row: id, email, user_name, timezone,
+    wct_active_ends_at, next_clc_prompt_at). Khóa idempotency là (user, -, next_clc_prompt_at): giờ prompt
+    danh nghĩa không đổi khi lần chuyển trạng thái bị làm lại, nên mỗi chu kỳ check-in chỉ có một prompt.
+    """
+    html_content = get_email_template("clc_prompt.html").render(
+        user_name=row.user_name or row.email.split('@')[0],
+        checkin_link=f"{FRONTEND_BASE_URL}/dashboard",
+        wct_ends_at=format_local(row.wct_active_ends_at, row.timezone)
+    )
+    return ReceiverJob(
+        message_id=row.id,
+        receiver_id=None,
+        channel=ReceiverChannelEnum.email,
+        address=row.email,
+        subject="CronPost check-in reminder",
+        html_content=html_content,
+        sending_method=SendingMethodEnum.cronpost_email,
+        lane=LANE_WCT_REMINDER,
+        due_at=due_at,
+        user_id=row.id,
+        source=SOURCE_CLC_PROMPT,
+        repetition_at=row.next_clc_prompt_at
+    )
+
+
+async def _clc_prompt_retry_jobs(db: AsyncSession, entries: List) -> List[ReceiverJob]:
+    """Retry builder: prompt của chu kỳ check-in hiện tại, khi user vẫn ở ANS_WCT và cửa sổ WCT còn mở."""
+    stmt = (
+        select(
+            User.id, User.email, User.user_name, User.timezone,
+            UserConfiguration.wct_active_ends_at, UserConfiguration.next_clc_prompt_at
+        )
+        .join(UserConfiguration, UserConfiguration.user_id == User.id)
+        .where(
+            User.id.in_([entry.message_id for entry in entries]),
+            User.account_status == UserAccountStatusEnum.ANS_WCT,
+            UserConfiguration.wct_active_ends_at > datetime.now(timezone.utc)
+        )
+    )
+    users = {row.id: row for row in (await db.execute(stmt)).all()}
+    return [
+        clc_prompt_job(users[entry.message_id], due_at=entry.next_retry_at)
+        for entry in entries
+        if entry.message_id in users and users[entry.message_id].next_clc_prompt_at == entry.repetition_at
+    ]
+
+
+class ReleasedMessages(NamedTuple):
+    # message_id -> next_send_at của các FM
+    next_sends: Dict
+    # IM đã chuyển sang 'processing' và job của người nhận email của chúng (khóa đã ghi vào ledger)
+    initial_message_ids: List
+    im_jobs: List[ReceiverJob]
+
+
+async def release_fns_messages(db: AsyncSession, frozen_users: Dict, now_utc: datetime) -> ReleasedMessages:
+    """
+    Phát hành tin nhắn của các user vừa vào FNS: ghi trước khóa ledger của người nhận IM (queued) và chuyển IM
+    sang 'processing', rồi tính next_send_at cho toàn bộ FM của họ (IM tính là gửi lúc now_utc) bằng batch API
+    và cập nhật bằng một câu bulk UPDATE. Không gửi gì và không commit (cùng transaction với freeze_wct_to_fns);
+    caller gửi im_jobs sau khi commit. Process chết trước đó thì dispatcher gửi lại nhận các khóa đã ghi.
+    """
+    im_stmt = (
+        select(Message)
+        .where(
+            Message.user_id.in_(list(frozen_users)),
+            Message.is_initial_message.is_(True),
+            Message.overall_send_status == MessageOverallStatusEnum.pending
+        )
+        .options(selectinload(Message.receivers))
+    )
+    initial_messages = (await db.execute(im_stmt)).scalars().all()
+    im_jobs = expand_receiver_jobs(initial_messages)
+    await queue_delivery_keys(db, im_jobs, now_utc + timedelta(seconds=DELIVERY_LEDGER_LEASE_SECONDS))
+    initial_message_ids = [message.id for message in initial_messages]
+    if initial_message_ids:
+        await db.execute(
+            update(Message)
+            .where(Message.id.in_(initial_message_ids))
+            .values(overall_send_status=MessageOverallStatusEnum.processing, updated_at=now_utc)
+            .execution_options(synchronize_session=False)
+        )
+    # FM theo IM được tính từ thời điểm phát hành (IM được gửi ngay sau commit)
+    im_sent_at: Dict = {message.user_id: now_utc for message in initial_messages}
+
+    fm_stmt = (
+        select(FmSchedule, Message.user_id)
+        .join(Message, Message.id == FmSchedule.message_id)
+        .where(Message.user_id.in_(list(frozen_users)), FmSchedule.repeat_number > 0)
+    )
+    fm_rows = [
+        FmScheduleRow(
+            key=schedule.message_id, timezone=frozen_users[user_id], trigger_type=schedule.trigger_type,
+            sending_time_of_day=schedule.sending_time_of_day, days_after_im_value=schedule.days_after_im_value,
+            day_of_week_value=schedule.day_of_week_value, date_of_month_value=schedule.date_of_month_value,
+            date_of_year_value=schedule.date_of_year_value, specific_date_value=schedule.specific_date_value,
+            im_sent_at_utc=im_sent_at.get(user_id), repeat_number=schedule.repeat_number
+        )
+        for schedule, user_id in (await db.execute(fm_stmt)).all()
+    ]
+    next_sends = calculate_next_fm_sends_batch(fm_rows, now_utc)
+    if next_sends:
+        await db.execute(
+            update(FmSchedule),
+            [{"message_id": message_id, "next_send_at": next_send_at} for message_id, next_send_at in next_sends.items()]
+        )
+    logger.info(f"SWEEPER: Released {len(initial_messages)} IM(s) and rescheduled {len(next_sends)} FM(s) for {len(frozen_users)} FNS user(s).")
+    return ReleasedMessages(next_sends, initial_message_ids, im_jobs)
+
+
+async def send_released_ims(released: ReleasedMessages, retry_policy):
+    """
+    Gửi IM đã phát hành (sau khi freeze đã commit, không giữ khóa của user trong lúc gửi), ghi kết quả và chốt
+    trạng thái các IM đã xong. IM còn người nhận chờ gửi lại giữ 'processing' tới khi dispatcher gửi lại xong.
+    """
+    results = await execute_jobs(released.im_jobs, concurrency=SWEEPER_EMAIL_CONCURRENCY, retry_policy=retry_policy)
+    async with AsyncSessionLocal() as db:
+        await record_delivery_results(db, results, {})
+        await settle_initial_messages(db, released.initial_message_ids)
+        await db.commit()
+
+
+async def promote_and_prompt(now_utc: datetime, batch_size: int, window: DueWindow) -> int:
+    """
+    ANS_CLC -> ANS_WCT cho một batch rồi gửi email nhắc check-in. Khóa của các prompt được ghi vào delivery
+    ledger trong cùng transaction với việc chuyển trạng thái: process chết sau commit thì dispatcher gửi lại
+    vẫn gửi prompt; prompt gửi lỗi được gửi lại theo retry policy. Trả về số user đã chuyển.
+    """
+    async with AsyncSessionLocal() as db:
+        promoted_rows = await promote_clc_to_wct(db, now_utc, batch_size, window)
+        if not promoted_rows:
+            await db.rollback()
+            return 0
+        prompt_jobs = [clc_prompt_job(row) for row in promoted_rows]
+        await queue_delivery_keys(db, prompt_jobs, now_utc + timedelta(seconds=DELIVERY_LEDGER_LEASE_SECONDS))
+        await db.commit()
+        retry_policy = await load_retry_policy(db)
+
+    logger.info(f"SWEEPER: {len(promoted_rows)} user(s) moved ANS_CLC -> ANS_WCT.")
+    for row in promoted_rows:
+        scheduler_timeline.upsert(KIND_WCT, row.id, row.wct_active_ends_at)
+    async with AsyncSessionLocal() as db:
+        await schedule_reminders_for(db, [row.id for row in promoted_rows])
+    await execute_jobs(prompt_jobs, concurrency=SWEEPER_EMAIL_CONCURRENCY, retry_policy=retry_policy)
+    return len(promoted_rows)
+
+
+async def run_state_sweep(batch_size: int = SWEEPER_BATCH_SIZE) -> int:
+    """
+    Một lượt quét: ANS_CLC -> ANS_WCT (chỉ prompt đúng giờ) rồi ANS_WCT -> FNS, mỗi bước tối đa batch_size user.
+    Trả về số user lớn nhất đã chuyển ở một bước (bằng batch_size nghĩa là có thể vẫn còn backlog).
+    """
+    now_utc = datetime.now(timezone.utc)
+    promoted_count = await promote_and_prompt(now_utc, batch_size, fresh_window(now_utc))
+
+    async with AsyncSessionLocal() as db:
+        frozen_rows = await freeze_wct_to_fns(db, now_utc, batch_size)
+        released = None
+        if frozen_rows:
+            logger.info(f"SWEEPER: {len(frozen_rows)} user(s) moved ANS_WCT -> FNS.")
+            released = await release_fns_messages(db, {row.id: row.timezone for row in frozen_rows}, now_utc)
+            retry_policy = await load_retry_policy(db)
+        await db.commit()
+
+    if released is not None:
+        for message_id, next_send_at in released.next_sends.items():
+            scheduler_timeline.upsert(KIND_FM, message_id, next_send_at)
+        await send_released_ims(released, retry_policy)
+    return max(promoted_count, len(frozen_rows))
+
+
+async def sweep_account_states(entity_ids: List[str]):
+    """Handler của scheduler cho KIND_CLC/KIND_WCT: quét cho tới khi hết backlog."""
+    while True:
+        transitioned = await run_state_sweep()
+        if transitioned < SWEEPER_BATCH_SIZE:
+            break
+
+
+async def catch_up_clc_prompts(batch_size: int, window: DueWindow) -> int:
+    """Catch-up handler: một batch prompt CLC quá hạn (cửa sổ WCT vẫn đủ dài, xem promote_clc_to_wct)."""
+    return await promote_and_prompt(datetime.now(timezone.utc), batch_size, window)
+
+
+register_handler(KIND_CLC, sweep_account_states)
+register_handler(KIND_WCT, sweep_account_states)
+register_catchup_handler(KIND_CLC, catch_up_clc_prompts)
+register_retry_builder(SOURCE_CLC_PROMPT, _clc_prompt_retry_jobs)
@@ -0,0 +1,173 @@
+# backend/app/services/user_smtp_transport.py
+# NEW FILE
+# Version: 1.0.1
+# Changelog:
+# - A retired transport is closed only once its last in-flight send finishes.
+# - Transports are replaced when their TTL expires even if the settings did not change, so the
+#   decrypted password is never kept past USER_SMTP_CACHE_TTL_SECONDS.
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from email.message import Message
+from typing import Optional, Tuple, Union
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+
+from ..db.database import AsyncSessionLocal
+from ..db.models import UserSmtpSettings
+from .smtp_pool import SMTPConnectionPool
+from .smtp_async import AsyncSMTPConnectionPool, SMTP_ASYNC_ENABLED
+from .scheduler_core import register_change_listener, KIND_SMTP_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Số user giữ thông tin SMTP (đã giải mã) và pool kết nối trong mỗi process
+USER_SMTP_CACHE_SIZE = int(os.environ.get("USER_SMTP_CACHE_SIZE", "1000"))
+# Thông tin SMTP được đọc lại từ DB sau chừng này giây (giới hạn thời gian giữ mật khẩu đã giải mã)
+USER_SMTP_CACHE_TTL_SECONDS = float(os.environ.get("USER_SMTP_CACHE_TTL_SECONDS", "600"))
+# Số kết nối tối đa tới SMTP riêng của mỗi user
+USER_SMTP_POOL_SIZE = int(os.environ.get("USER_SMTP_POOL_SIZE", "2"))
+# Pool của user không gửi gì trong chừng này giây thì bị đóng
+USER_SMTP_POOL_IDLE_SECONDS = float(os.environ.get("USER_SMTP_POOL_IDLE_SECONDS", "120"))
+
+
+class UserSmtpTransport:
+    """
+    SMTP riêng của một user (UserSmtpSettings đang bật). Mật khẩu chỉ được giải mã (Fernet) khi
+    cần mở kết nối đầu tiên; các email sau dùng lại phiên đã đăng nhập trong pool của user.
+    """
+    def __init__(self, user_id, server: str, port: int, sender_email: str, password_encrypted: str):
+        self.user_id = user_id
+        self.server = server
+        self.port = port
+        self.sender_email = sender_email
+        self._password_encrypted = password_encrypted
+        self._pool: Optional[Union[AsyncSMTPConnectionPool, SMTPConnectionPool]] = None
+        self.loaded_at = time.monotonic()
+        self.last_used = self.loaded_at
+        self.in_flight = 0
+        # Settings đã đổi/bị xóa: đóng pool ngay khi lần gửi đang dở cuối cùng xong
+        self.retired = False
+
+    def settings_key(self) -> Tuple:
+        # Fernet sinh ciphertext mới ở mỗi lần mã hóa, nên mỗi lần lưu settings đều đổi khóa này
+        return (self.server, self.port, self.sender_email, self._password_encrypted)
+
+    def _get_pool(self) -> Union[AsyncSMTPConnectionPool, SMTPConnectionPool]:
+        if self._pool is None:
+            # Import muộn: core.security import auth_router, vốn import email_service (module này)
+            from ..core.security import decrypt_data
+            password = decrypt_data(self._password_encrypted)
+            pool_class = AsyncSMTPConnectionPool if SMTP_ASYNC_ENABLED else SMTPConnectionPool
+            self._pool = pool_class(self.server, self.port, self.sender_email, password, max_size=USER_SMTP_POOL_SIZE)
+        return self._pool
+
+    async def send_message(self, msg: Message):
+        self.in_flight += 1
+        try:
+            pool = self._get_pool()
+            if isinstance(pool, AsyncSMTPConnectionPool):
+                await pool.send_message(msg)
+            else:
+                await run_in_threadpool(pool.send_message, msg)
+        finally:
+            self.in_flight -= 1
+            self.last_used = time.monotonic()
+            if self.retired and self.in_flight == 0:
+                await self.close()
+
+    async def close(self):
+        pool, self._pool = self._pool, None
+        if isinstance(pool, AsyncSMTPConnectionPool):
+            await pool.close()
+        elif pool is not None:
+            await run_in_threadpool(pool.close)
+
+
+# user_id -> (thời điểm đọc từ DB, transport hoặc None nếu user không có SMTP riêng đang bật); LRU
+_transports: "OrderedDict[str, Tuple[float, Optional[UserSmtpTransport]]]" = OrderedDict()
+_last_idle_sweep = 0.0
+
+
+def _retire(transport: Optional[UserSmtpTransport]):
+    """Đánh dấu transport bị thay; pool được đóng ngay nếu không có lần gửi nào đang dở, nếu không thì ở send_message."""
+    if transport is not None:
+        transport.retired = True
+        if transport.in_flight == 0:
+            asyncio.get_running_loop().create_task(transport.close())
+
+
+async def _load_transport(user_id) -> Optional[UserSmtpTransport]:
+    async with AsyncSessionLocal() as db:
+        settings = (await db.execute(
+            select(UserSmtpSettings).where(UserSmtpSettings.user_id == user_id, UserSmtpSettings.is_active.is_(True))
+        )).scalars().first()
+    if settings is None:
+        return None
+    return UserSmtpTransport(
+        user_id, settings.smtp_server, settings.smtp_port, settings.smtp_sender_email, settings.smtp_password_encrypted
+    )
+
+
+def _sweep_idle_pools(now: float):
+    """Đóng pool của các user đã không gửi gì quá USER_SMTP_POOL_IDLE_SECONDS (thông tin SMTP vẫn được giữ tới hết TTL)."""
+    global _last_idle_sweep
+    if now - _last_idle_sweep < USER_SMTP_POOL_IDLE_SECONDS / 2:
+        return
+    _last_idle_sweep = now
+    for _, transport in _transports.values():
+        if transport is not None and transport._pool is not None and transport.in_flight == 0 \
+                and now - transport.last_used > USER_SMTP_POOL_IDLE_SECONDS:
+            asyncio.get_running_loop().create_task(transport.close())
+
+
+async def get_user_smtp_transport(user_id) -> Optional[UserSmtpTransport]:
+    """
+    Transport SMTP riêng của user, hoặc None nếu user không có UserSmtpSettings đang bật
+    (kết quả None cũng được cache). Đọc DB tối đa một lần mỗi USER_SMTP_CACHE_TTL_SECONDS cho mỗi user;
+    hết TTL thì transport (kèm pool và mật khẩu đã giải mã) luôn được thay, kể cả khi settings không đổi.
+    """
+    key = str(user_id)
+    now = time.monotonic()
+    _sweep_idle_pools(now)
+    cached = _transports.get(key)
+    if cached is not None and now - cached[0] < USER_SMTP_CACHE_TTL_SECONDS:
+        _transports.move_to_end(key)
+        return cached[1]
+
+    loaded = await _load_transport(user_id)
+    # Có thể đã có lần gửi khác nạp xong trong lúc chờ DB: dùng luôn bản đó nếu còn hạn và cùng settings
+    current_loaded_at, current = _transports.get(key, (now, None))
+    if loaded is not None and current is not None and loaded.settings_key() == current.settings_key() \
+            and time.monotonic() - current_loaded_at < USER_SMTP_CACHE_TTL_SECONDS and not current.retired:
+        _transports.move_to_end(key)
+        return current
+    _retire(current)
+    _transports[key] = (time.monotonic(), loaded)
+    _transports.move_to_end(key)
+    while len(_transports) > USER_SMTP_CACHE_SIZE:
+        _, (_, evicted) = _transports.popitem(last=False)
+        _retire(evicted)
+    return loaded
+
+
+def invalidate_user_smtp(user_id):
+    """Bỏ transport đã cache của user (settings vừa được lưu hoặc xóa); lần gửi sau đọc lại từ DB."""
+    _, transport = _transports.pop(str(user_id), (None, None))
+    _retire(transport)
+
+
+async def close_user_smtp_transports():
+    """Đóng mọi kết nối tới SMTP riêng của user (khi process dừng)."""
+    transports = [transport for _, transport in _transports.values() if transport is not None]
+    _transports.clear()
+    for transport in transports:
+        await transport.close()
+
+
+# Scheduler worker sở hữu user nhận thông báo khi router lưu/xóa settings
+register_change_listener(KIND_SMTP_SETTINGS, invalidate_user_smtp)
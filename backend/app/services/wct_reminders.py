@@ -0,0 +1,311 @@
+# backend/app/services/wct_reminders.py
+# NEW FILE
+# Version: 1.3.1
+# Changelog:
+# - send_reminder_batch() returns the delivery results again (dispatch counted them and failed after the first batch).
+# - Dispatch sends reminders due up to now (not up to the end of the current minute); a bucket entry is
+#   due at the latest reminder of its minute. The watermark only moves past reminders that reached the
+#   delivery ledger; a batch that fails before that is picked up again a minute later.
+# - Failed reminders are retried through the delivery ledger while the WCT window is still open
+#   (retry builder for SOURCE_WCT_REMINDER).
+# - Renders the reminder from the precompiled email template registry (get_email_template).
+
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import pytz
+from sqlalchemy import select, update, union_all, case, func, literal_column, Interval
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core.timezones import timezone_registry
+from ..db.database import AsyncSessionLocal
+from ..db.models import (
+    User, UserConfiguration, EmailCheckinSettings, SystemSetting,
+    UserAccountStatusEnum, ReceiverChannelEnum, SendingMethodEnum
+)
+from .email_service import get_email_template
+from .dispatch_lanes import LANE_WCT_REMINDER
+from .delivery_service import (
+    ReceiverJob, DeliveryResult, execute_jobs, load_retry_policy, register_retry_builder, SOURCE_WCT_REMINDER
+)
+from .scheduler_partition import owned_by_this_worker
+from .scheduler_core import (
+    scheduler_timeline, register_handler, register_window_loader, KIND_WCT_REMINDER
+)
+
+logger = logging.getLogger(__name__)
+
+FINAL_REMINDER_SETTING = "wct_final_reminder_minutes"
+FINAL_REMINDER_DEFAULT = 3
+# Số email nhắc được dựng (token + render) và gửi trong một batch
+WCT_REMINDER_BATCH_SIZE = int(os.environ.get("WCT_REMINDER_BATCH_SIZE", "500"))
+WCT_REMINDER_CONCURRENCY = int(os.environ.get("WCT_REMINDER_CONCURRENCY", "20"))
+# Khi khởi động, nhắc nhở đến hạn trong khoảng này trước đó vẫn được gửi (delivery ledger chặn gửi trùng)
+WCT_REMINDER_GRACE_SECONDS = int(os.environ.get("WCT_REMINDER_GRACE_SECONDS", "600"))
+FRONTEND_BASE_URL = os.environ.get("FRONTEND_BASE_URL", "http://localhost")
+
+_MINUTE = literal_column("interval '1 minute'", Interval)
+
+
+def _floor_minute(moment: datetime) -> datetime:
+    return moment.replace(second=0, microsecond=0)
+
+
+# Các nhắc nhở đến hạn tới mốc này đã được gửi, hoặc đã vào delivery ledger (được gửi lại nếu lỗi)
+_fired_until: datetime = _floor_minute(datetime.now(timezone.utc) - timedelta(seconds=WCT_REMINDER_GRACE_SECONDS))
+
+
+async def load_final_reminder_minutes(db: AsyncSession) -> int:
+    """Số phút trước khi WCT kết thúc để gửi nhắc nhở cuối cùng (system setting wct_final_reminder_minutes, 0 = tắt)."""
+    stmt = select(SystemSetting.setting_value).where(SystemSetting.setting_key == FINAL_REMINDER_SETTING)
+    value = (await db.execute(stmt)).scalar_one_or_none()
+    try:
+        return max(0, int(value)) if value is not None else FINAL_REMINDER_DEFAULT
+    except ValueError:
+        logger.warning(f"WCT_REMINDER: Invalid value '{value}' for system setting '{FINAL_REMINDER_SETTING}'. Using default {FINAL_REMINDER_DEFAULT}.")
+        return FINAL_REMINDER_DEFAULT
+
+
+def _reminders(final_minutes: int, now_utc: datetime, user_ids: Optional[Iterable] = None):
+    """
+    Subquery (user_id, reminder_at, wct_ends_at) của các user đang ở ANS_WCT thuộc phân vùng của worker:
+    nhắc nhở cuối cùng (system setting) và nhắc nhở bổ sung (email_checkin_settings) trước wct_active_ends_at.
+    """
+    wct_ends_at = UserConfiguration.wct_active_ends_at
+
+    def _base(reminder_at):
+        stmt = (
+            select(UserConfiguration.user_id, reminder_at.label("reminder_at"), wct_ends_at.label("wct_ends_at"))
+            .join(User, User.id == UserConfiguration.user_id)
+            .where(
+                User.account_status == UserAccountStatusEnum.ANS_WCT,
+                wct_ends_at > now_utc,
+                owned_by_this_worker(UserConfiguration.user_id)
+            )
+        )
+        if user_ids is not None:
+            stmt = stmt.where(UserConfiguration.user_id.in_(list(user_ids)))
+        return stmt
+
+    sources = [
+        _base(wct_ends_at - _MINUTE * EmailCheckinSettings.additional_reminder_minutes)
+        .join(EmailCheckinSettings, EmailCheckinSettings.user_id == UserConfiguration.user_id)
+        .where(
+            EmailCheckinSettings.send_additional_reminder.is_(True),
+            EmailCheckinSettings.additional_reminder_minutes > 0
+        )
+    ]
+    if final_minutes > 0:
+        sources.append(_base(wct_ends_at - _MINUTE * final_minutes))
+    return union_all(*sources).subquery("reminders")
+
+
+async def load_reminder_buckets(
+    db: AsyncSession,
+    lower_bound: Optional[datetime],
+    window_end: datetime,
+    user_ids: Optional[Iterable] = None
+) -> List[Tuple[str, datetime]]:
+    """
+    Window loader của scheduler: mỗi phút có ít nhất một nhắc nhở chưa gửi là một entry (bucket),
+    đến hạn lúc nhắc nhở muộn nhất của phút đó (khi mọi nhắc nhở của bucket đều đã đến hạn).
+    Hàng nghìn nhắc nhở cùng phút (vd: prompt 09:00 mặc định) chỉ là một entry.
+    """
+    reminders = _reminders(await load_final_reminder_minutes(db), datetime.now(timezone.utc), user_ids)
+    bucket = func.date_trunc('minute', reminders.c.reminder_at)
+    after = _fired_until if lower_bound is None else max(lower_bound, _fired_until)
+    stmt = (
+        select(bucket, func.max(reminders.c.reminder_at))
+        .where(reminders.c.reminder_at > after, reminders.c.reminder_at <= window_end)
+        .group_by(bucket)
+        .order_by(bucket)
+    )
+    return [(bucket_at.isoformat(), due_at) for bucket_at, due_at in (await db.execute(stmt)).all()]
+
+
+async def schedule_reminders_for(db: AsyncSession, user_ids: Iterable):
+    """Đưa các bucket nhắc nhở của những user vừa vào ANS_WCT vào timeline (không chờ lần refill kế tiếp)."""
+    window_end = scheduler_timeline.window_end
+    if window_end is None:
+        return
+    for bucket_id, bucket_at in await load_reminder_buckets(db, None, window_end, user_ids):
+        scheduler_timeline.upsert(KIND_WCT_REMINDER, bucket_id, bucket_at)
+
+
+async def issue_checkin_tokens(db: AsyncSession, user_ids: List, now_utc: datetime) -> Dict:
+    """
+    Cấp checkin_token cho cả batch bằng một câu UPDATE (token sinh trong Postgres bằng pgcrypto),
+    chỉ cho user bật use_checkin_token_email. Token hết hạn cùng cửa sổ WCT; token còn hiệu lực
+    của cùng cửa sổ được giữ nguyên để link trong email nhắc trước đó vẫn dùng được.
+    Trả về user_id -> token. Không commit.
+    """
+    if not user_ids:
+        return {}
+    same_window = (
+        EmailCheckinSettings.checkin_token.is_not(None)
+        & (EmailCheckinSettings.checkin_token_expires_at == UserConfiguration.wct_active_ends_at)
+    )
+    stmt = (
+        update(EmailCheckinSettings)
+        .where(
+            EmailCheckinSettings.user_id.in_(user_ids),
+            EmailCheckinSettings.use_checkin_token_email.is_(True),
+            UserConfiguration.user_id == EmailCheckinSettings.user_id
+        )
+        .values(
+            checkin_token=case(
+                (same_window, EmailCheckinSettings.checkin_token),
+                else_=func.encode(func.gen_random_bytes(24), 'hex')
+            ),
+            checkin_token_expires_at=UserConfiguration.wct_active_ends_at,
+            updated_at=now_utc
+        )
+        .returning(EmailCheckinSettings.user_id, EmailCheckinSettings.checkin_token)
+        .execution_options(synchronize_session=False)
+    )
+    return dict((await db.execute(stmt)).all())
+
+
+def format_local(moment_utc: datetime, timezone_str: str) -> str:
+    """Thời điểm theo múi giờ của user, dùng trong các email nhắc check-in."""
+    try:
+        user_tz = timezone_registry.get(timezone_str)
+    except pytz.exceptions.UnknownTimeZoneError:
+        user_tz = pytz.utc
+    return moment_utc.astimezone(user_tz).strftime('%Y-%m-%d %H:%M %Z')
+
+
+class _ReminderRow(NamedTuple):
+    user_id: object
+    reminder_at: datetime
+    wct_ends_at: datetime
+    email: str
+    user_name: Optional[str]
+    timezone: str
+    use_checkin_token_email: bool
+
+
+def _reminder_job(row, token: Optional[str], due_at: Optional[datetime] = None) -> ReceiverJob:
+    if token:
+        checkin_link = f"{FRONTEND_BASE_URL}/api/auth/email-check-in?token={token}"
+    else:
+        checkin_link = f"{FRONTEND_BASE_URL}/dashboard"
+    html_content = get_email_template("wct_reminder.html").render(
+        user_name=row.user_name or row.email.split('@')[0],
+        checkin_link=checkin_link,
+        wct_ends_at=format_local(row.wct_ends_at, row.timezone),
+        minutes_left=max(1, round((row.wct_ends_at - row.reminder_at).total_seconds() / 60))
+    )
+    return ReceiverJob(
+        # Khóa idempotency: (user, -, thời điểm nhắc) nên mỗi nhắc nhở của một cửa sổ WCT chỉ được gửi một lần
+        message_id=row.user_id,
+        receiver_id=None,
+        channel=ReceiverChannelEnum.email,
+        address=row.email,
+        subject="CronPost check-in reminder: your check-in window is closing",
+        html_content=html_content,
+        sending_method=SendingMethodEnum.cronpost_email,
+        lane=LANE_WCT_REMINDER,
+        due_at=due_at or row.reminder_at,
+        user_id=row.user_id,
+        source=SOURCE_WCT_REMINDER,
+        repetition_at=row.reminder_at
+    )
+
+
+async def send_reminder_batch(rows: List, now_utc: datetime) -> List[DeliveryResult]:
+    """Cấp token cho cả batch (một câu lệnh, một commit) rồi gửi các email nhắc. Lần gửi lỗi được ledger gửi lại."""
+    async with AsyncSessionLocal() as db:
+        tokens = await issue_checkin_tokens(db, [row.user_id for row in rows if row.use_checkin_token_email], now_utc)
+        await db.commit()
+        retry_policy = await load_retry_policy(db)
+    results = await execute_jobs(
+        [_reminder_job(row, tokens.get(row.user_id)) for row in rows],
+        concurrency=WCT_REMINDER_CONCURRENCY,
+        retry_policy=retry_policy
+    )
+    return results
+
+
+async def _reminder_retry_jobs(db: AsyncSession, entries: List) -> List[ReceiverJob]:
+    """Retry builder: nhắc nhở của user vẫn đang ở ANS_WCT, thuộc cửa sổ WCT còn mở. Token được cấp lại như lần gửi đầu."""
+    now_utc = datetime.now(timezone.utc)
+    stmt = (
+        select(
+            User.id, UserConfiguration.wct_active_ends_at, User.email, User.user_name, User.timezone,
+            func.coalesce(EmailCheckinSettings.use_checkin_token_email, False)
+        )
+        .join(UserConfiguration, UserConfiguration.user_id == User.id)
+        .outerjoin(EmailCheckinSettings, EmailCheckinSettings.user_id == User.id)
+        .where(
+            User.id.in_([entry.message_id for entry in entries]),
+            User.account_status == UserAccountStatusEnum.ANS_WCT,
+            UserConfiguration.wct_active_ends_at > now_utc
+        )
+    )
+    users = {row[0]: row for row in (await db.execute(stmt)).all()}
+    reminders = []
+    for entry in entries:
+        user = users.get(entry.message_id)
+        # Nhắc nhở phải nằm trước giờ kết thúc của cửa sổ hiện tại (không gửi lại nhắc nhở của cửa sổ cũ)
+        if user is None or entry.repetition_at is None or entry.repetition_at >= user[1]:
+            continue
+        reminders.append((entry, _ReminderRow(entry.message_id, entry.repetition_at, *user[1:])))
+    tokens = await issue_checkin_tokens(db, [row.user_id for _, row in reminders if row.use_checkin_token_email], now_utc)
+    return [_reminder_job(row, tokens.get(row.user_id), due_at=entry.next_retry_at) for entry, row in reminders]
+
+
+async def dispatch_wct_reminders(entity_ids: List[str]):
+    """
+    Handler của scheduler cho KIND_WCT_REMINDER: gửi mọi nhắc nhở đã đến hạn (tới now) mà chưa được gửi.
+    Mỗi user nhận tối đa một email mỗi lượt (nhắc nhở gần giờ kết thúc nhất nếu nhiều nhắc nhở trùng lượt).
+    _fired_until chỉ tiến qua các nhắc nhở đã vào delivery ledger (đã gửi, hoặc được hẹn gửi lại);
+    batch lỗi trước đó (cấp token, claim ledger) được lấy lại ở lượt sau.
+    """
+    global _fired_until
+    now_utc = datetime.now(timezone.utc)
+    until = now_utc
+    async with AsyncSessionLocal() as db:
+        reminders = _reminders(await load_final_reminder_minutes(db), now_utc)
+        stmt = (
+            select(
+                reminders.c.user_id, reminders.c.reminder_at, reminders.c.wct_ends_at,
+                User.email, User.user_name, User.timezone,
+                func.coalesce(EmailCheckinSettings.use_checkin_token_email, False).label("use_checkin_token_email")
+            )
+            .join(User, User.id == reminders.c.user_id)
+            .outerjoin(EmailCheckinSettings, EmailCheckinSettings.user_id == reminders.c.user_id)
+            .where(reminders.c.reminder_at > _fired_until, reminders.c.reminder_at <= until)
+            .order_by(reminders.c.reminder_at)
+        )
+        rows_by_user = {row.user_id: row for row in (await db.execute(stmt)).all()}
+    rows = list(rows_by_user.values())
+
+    sent, unsettled_at = 0, []
+    for start in range(0, len(rows), WCT_REMINDER_BATCH_SIZE):
+        batch = rows[start:start + WCT_REMINDER_BATCH_SIZE]
+        try:
+            results = await send_reminder_batch(batch, now_utc)
+        except Exception as e:
+            logger.error(f"WCT_REMINDER: Failed to send a batch of {len(batch)} reminder(s); retrying on the next run: {e}", exc_info=True)
+            unsettled_at.extend(row.reminder_at for row in batch)
+            continue
+        sent += sum(result.ok for result in results)
+
+    if unsettled_at:
+        # Dừng ngay trước nhắc nhở sớm nhất chưa vào ledger, và hẹn một lượt nữa sau một phút
+        _fired_until = max(_fired_until, min(unsettled_at) - timedelta(microseconds=1))
+        retry_at = _floor_minute(now_utc) + timedelta(minutes=1)
+        # Id riêng: không đè lên bucket thật của phút đó (bucket đến hạn muộn hơn, lúc nhắc nhở cuối của phút)
+        scheduler_timeline.upsert(KIND_WCT_REMINDER, f"retry:{retry_at.isoformat()}", retry_at)
+    else:
+        _fired_until = until
+    if rows:
+        logger.info(f"WCT_REMINDER: Sent {sent}/{len(rows)} check-in reminder(s) due up to {until}.")
+
+
+register_handler(KIND_WCT_REMINDER, dispatch_wct_reminders)
+register_window_loader(KIND_WCT_REMINDER, load_reminder_buckets)
+register_retry_builder(SOURCE_WCT_REMINDER, _reminder_retry_jobs)
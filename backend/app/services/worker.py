@@ -1,77 +1,309 @@
+# backend/app/services/worker.py
+# Version: 2.12.0
+# Changelog:
+# - An overdue FM advances to its first repetition after now (missed repetitions collapse into one send,
+#   as for SCMs) instead of catching up one repetition per pass.
+# - IMs released by the state sweeper are settled (sent/failed) once their last retried receiver is settled.
+# - Retries come from the delivery ledger (one pending retry per idempotency key): FM repetitions no
+#   longer overwrite each other's retries, and failed SCM sends are retried like message receivers.
+# - The SCM run log counts only real send failures: in-app SCMs that are skipped, deferred and no-op
+#   sends are not failures.
+# - Sends go through the delivery ledger (at most one email per idempotency key), so a batch re-claimed
+#   after a crash skips receivers that were already sent. SCM runs use execute_jobs(); FM claims no longer
+#   skip messages left in 'processing' by an interrupted run.
+# - FM receiver jobs carry their scheduled send time so the FM lane can report dispatch lag.
+# - Claims take a DueWindow: scheduler handlers only take on-time work, overdue FM/SCM
+#   are drained by the scheduler's rate-limited catch-up lane.
+# - Claims are restricted to users in this worker's hash partition.
+# - Failed receivers are retried with backoff instead of failing the whole message; added the retry dispatcher.
+# - FM delivery goes through delivery_service: one job per receiver, bulk SendingHistory/status writes.
+# - Added the Simple Cron Message (SCM) dispatcher: batch claim + one bulk UPDATE per batch.
+# - The dispatcher is now driven by the scheduler timeline (scheduler_core) instead of polling.
+# - Replaced the "load every due FM" loop with bounded batch claiming (FOR UPDATE SKIP LOCKED).
+# - Messages in a batch are sent concurrently and the batch is committed once.
+# - Added run_message_dispatcher(), a long-running loop launched from main.py.
+
+import os
 import logging
 from datetime import datetime, timezone
-from sqlalchemy import select, update
+from typing import List, Optional
+from sqlalchemy import select, update, case, func, or_, literal_column, Interval
+from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..db.models import Message, FmSchedule, MessageOverallStatusEnum
-from .schedule_service import calculate_next_fm_send_at # Giả sử hàm này cũng được cập nhật để xử lý lặp lại
+from ..db.database import AsyncSessionLocal
+from ..db.models import (
+    Message, FmSchedule, SimpleCronMessage, MessageOverallStatusEnum,
+    SCMStatusEnum, SCMScheduleTypeEnum, SendingMethodEnum
+)
+from .schedule_service import calculate_next_fm_repeat_at
+from .delivery_service import (
+    expand_receiver_jobs, execute_jobs, failed_message_ids, record_delivery_results,
+    load_retry_policy, claim_due_retries, mark_exhausted_messages_failed, settle_initial_messages, scm_job,
+    SOURCE_MESSAGE
+)
+from .scheduler_partition import owned_by_this_worker
+from .scheduler_core import (
+    scheduler_timeline, register_handler, register_catchup_handler, fresh_window, DueWindow,
+    KIND_FM, KIND_SCM, KIND_RETRY
+)
 
 logger = logging.getLogger(__name__)
 
-async def process_scheduled_messages(db: AsyncSession):
+# Số FM tối đa được "claim" trong một transaction
+DISPATCH_BATCH_SIZE = int(os.environ.get("DISPATCH_BATCH_SIZE", "100"))
+# Số tin nhắn được gửi song song trong một batch
+DISPATCH_CONCURRENCY = int(os.environ.get("DISPATCH_CONCURRENCY", "20"))
+
+
+async def _claim_due_fm_schedules(db: AsyncSession, window: DueWindow, batch_size: int) -> List[FmSchedule]:
     """
-    Hàm này sẽ được gọi định kỳ (ví dụ: mỗi phút) bởi một trình lập lịch như cron hoặc Celery.
+    Khóa tối đa batch_size FM đến hạn trong window (cũ nhất trước). SKIP LOCKED giúp nhiều replica cùng
+    xử lý một backlog mà không gửi trùng: dòng đã bị replica khác khóa sẽ bị bỏ qua.
+    Tin nhắn 'processing' vẫn được claim: lần chạy bị gián đoạn được làm lại, delivery ledger chặn gửi trùng.
     """
-    logger.info("Worker: Starting scheduled message processing run.")
-    
-    now_utc = datetime.now(timezone.utc)
-    
-    # 1. Lấy tất cả các FM có next_send_at <= thời gian hiện tại VÀ repeat_number > 0
     stmt = (
         select(FmSchedule)
-        .join(Message)
+        .join(Message, Message.id == FmSchedule.message_id)
         .where(
-            FmSchedule.next_send_at <= now_utc,
+            window.contains(FmSchedule.next_send_at),
             FmSchedule.repeat_number > 0,
-            Message.overall_send_status != MessageOverallStatusEnum.processing # Tránh xử lý tin nhắn đang được gửi
+            Message.overall_send_status != MessageOverallStatusEnum.failed,
+            owned_by_this_worker(Message.user_id)
+        )
+        .order_by(FmSchedule.next_send_at)
+        .limit(batch_size)
+        .with_for_update(of=FmSchedule, skip_locked=True)
+        .options(
+            selectinload(FmSchedule.message).options(
+                selectinload(Message.receivers),
+                selectinload(Message.user)
+            )
         )
     )
-    
     result = await db.execute(stmt)
-    schedules_to_process = result.scalars().all()
+    return list(result.scalars().all())
+
+
+def _next_fm_repeat_after(schedule: FmSchedule, user_timezone: str, now_utc: datetime) -> Optional[datetime]:
+    """
+    Lần lặp kế tiếp của FM sau max(slot vừa gửi, now): FM quá hạn nhảy tới lần lặp đầu tiên sau now
+    (các lần lặp đã lỡ gộp vào lần gửi này, như SCM). Tiến từng slot từ slot vừa gửi để giữ đúng
+    thứ trong tuần/ngày trong tháng của lịch.
+    """
+    next_send = schedule.next_send_at
+    while next_send is not None and next_send <= max(schedule.next_send_at, now_utc):
+        next_send = calculate_next_fm_repeat_at(schedule, user_timezone, next_send)
+    return next_send
+
+
+async def process_scheduled_messages(
+    db: AsyncSession,
+    batch_size: int = DISPATCH_BATCH_SIZE,
+    window: Optional[DueWindow] = None
+) -> int:
+    """
+    Claim và xử lý một batch FM đến hạn trong window (mặc định: mọi FM đã đến hạn),
+    sau đó commit một lần cho cả batch.
+    Trả về số FM đã claim (bằng batch_size nghĩa là có thể vẫn còn backlog).
+    """
+    window = window or DueWindow(None, datetime.now(timezone.utc))
+    schedules_to_process = await _claim_due_fm_schedules(db, window, batch_size)
 
     if not schedules_to_process:
-        logger.info("Worker: No scheduled messages to process at this time.")
-        return
+        await db.rollback()
+        return 0
+
+    logger.info(f"Worker: Claimed {len(schedules_to_process)} message(s) to process.")
 
-    logger.info(f"Worker: Found {len(schedules_to_process)} message(s) to process.")
+    # 1. Gửi song song tới từng người nhận; chưa chạm vào session trong lúc gửi
+    results = await execute_jobs(
+        expand_receiver_jobs(
+            (schedule.message for schedule in schedules_to_process),
+            {schedule.message_id: schedule.next_send_at for schedule in schedules_to_process}
+        ),
+        concurrency=DISPATCH_CONCURRENCY,
+        retry_policy=await load_retry_policy(db)
+    )
+    failed_ids = failed_message_ids(results)
 
+    # 2. Cập nhật lịch trình trong bộ nhớ; trạng thái tin nhắn được ghi cùng kết quả gửi
+    now_utc = datetime.now(timezone.utc)
+    message_statuses = {}
     for schedule in schedules_to_process:
         message = schedule.message
-        
-        # Đánh dấu là đang xử lý để tránh race condition
-        message.overall_send_status = MessageOverallStatusEnum.processing
-        await db.commit()
-
-        try:
-            # --- Logic gửi tin nhắn thực tế ở đây ---
-            # (Ví dụ: gọi API của N8N hoặc dịch vụ email)
-            logger.info(f"Worker: Sending message_id {message.id}, repeat number remaining: {schedule.repeat_number}")
-            # send_email(message.content, ...)
-            
-            # --- Cập nhật sau khi gửi thành công ---
-            new_repeat_number = schedule.repeat_number - 1
-            
-            # Cập nhật lại lịch trình
-            schedule.repeat_number = new_repeat_number
-            
-            if new_repeat_number > 0:
-                # Nếu vẫn còn lượt gửi, tính toán next_send_at tiếp theo
-                # Lưu ý: cần có logic để lấy im_sent_at_utc
-                im_sent_at = ... # Cần có logic để lấy thời gian gửi IM
-                next_send = await calculate_next_fm_send_at(schedule, message.user.timezone, im_sent_at, db)
-                schedule.next_send_at = next_send
-                message.overall_send_status = MessageOverallStatusEnum.partially_sent # Hoặc một trạng thái phù hợp
-                logger.info(f"Worker: Message {message.id} sent. Next send at {next_send}. Repeats remaining: {new_repeat_number}")
-            else:
-                # Nếu đã hết lượt gửi
-                schedule.next_send_at = None
-                message.overall_send_status = MessageOverallStatusEnum.sent # Đánh dấu là đã gửi xong hoàn toàn
-                logger.info(f"Worker: Message {message.id} sent. All repetitions complete.")
-
-        except Exception as e:
-            logger.error(f"Worker: Failed to send message_id {message.id}. Error: {e}")
-            message.overall_send_status = MessageOverallStatusEnum.failed
-        
-        finally:
-            await db.commit()
\ No newline at end of file
+        if message.id in failed_ids:
+            message_statuses[message.id] = MessageOverallStatusEnum.failed
+            continue
+
+        new_repeat_number = schedule.repeat_number - 1
+        schedule.repeat_number = new_repeat_number
+        if new_repeat_number > 0:
+            next_send = _next_fm_repeat_after(schedule, message.user.timezone, now_utc)
+            schedule.next_send_at = next_send
+            message_statuses[message.id] = MessageOverallStatusEnum.partially_sent if next_send else MessageOverallStatusEnum.sent
+            logger.info(f"Worker: Message {message.id} sent. Next send at {next_send}. Repeats remaining: {new_repeat_number}")
+        else:
+            schedule.next_send_at = None
+            message_statuses[message.id] = MessageOverallStatusEnum.sent
+            logger.info(f"Worker: Message {message.id} sent. All repetitions complete.")
+
+    await record_delivery_results(db, results, message_statuses)
+    await db.commit()
+
+    # Đưa lần lặp kế tiếp vào heap để scheduler thức dậy đúng lúc (lần gửi lại đã được execute_jobs đưa vào)
+    for schedule in schedules_to_process:
+        scheduler_timeline.upsert(KIND_FM, schedule.message_id, schedule.next_send_at)
+    return len(schedules_to_process)
+
+
+async def dispatch_due_fm_schedules(entity_ids: List[str]):
+    """
+    Handler của scheduler cho các FM đến hạn: xử lý liên tục từng batch
+    cho tới khi hết backlog đúng giờ (không chỉ riêng các id trong entity_ids).
+    """
+    while True:
+        async with AsyncSessionLocal() as db:
+            claimed = await process_scheduled_messages(db, window=fresh_window(datetime.now(timezone.utc)))
+        if claimed < DISPATCH_BATCH_SIZE:
+            break
+
+
+async def catch_up_fm_schedules(batch_size: int, window: DueWindow) -> int:
+    """Catch-up handler: một batch FM quá hạn."""
+    async with AsyncSessionLocal() as db:
+        return await process_scheduled_messages(db, batch_size, window)
+
+
+async def _claim_due_scms(db: AsyncSession, window: DueWindow, batch_size: int) -> List[SimpleCronMessage]:
+    """Khóa tối đa batch_size SCM active đến hạn trong window (dùng partial index idx_scm_next_send_at)."""
+    stmt = (
+        select(SimpleCronMessage)
+        .where(
+            SimpleCronMessage.status == SCMStatusEnum.active,
+            window.contains(SimpleCronMessage.next_send_at),
+            owned_by_this_worker(SimpleCronMessage.user_id)
+        )
+        .order_by(SimpleCronMessage.next_send_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    result = await db.execute(stmt)
+    return list(result.scalars().all())
+
+
+def _advance_scms_statement(scm_ids: List, now_utc: datetime):
+    """
+    Một câu UPDATE cho cả batch: tăng current_repetition, ghi last_sent_at và
+    dời next_send_at tới slot đầu tiên sau now (không gửi dồn các slot đã lỡ).
+    SCM unloop hoặc đã đủ repeat_number chuyển sang inactive.
+    """
+    finished = or_(
+        SimpleCronMessage.schedule_type == SCMScheduleTypeEnum.unloop,
+        SimpleCronMessage.current_repetition + 1 >= SimpleCronMessage.repeat_number,
+        func.coalesce(SimpleCronMessage.loop_interval_minutes, 0) <= 0
+    )
+    interval_seconds = SimpleCronMessage.loop_interval_minutes * 60
+    missed_slots = func.floor(func.extract('epoch', now_utc - SimpleCronMessage.next_send_at) / interval_seconds)
+    next_slot = SimpleCronMessage.next_send_at + literal_column("interval '1 minute'", Interval) * (SimpleCronMessage.loop_interval_minutes * (missed_slots + 1))
+    return (
+        update(SimpleCronMessage)
+        .where(SimpleCronMessage.id.in_(scm_ids))
+        .values(
+            current_repetition=SimpleCronMessage.current_repetition + 1,
+            last_sent_at=now_utc,
+            next_send_at=case((finished, None), else_=next_slot),
+            status=case((finished, SCMStatusEnum.inactive), else_=SimpleCronMessage.status)
+        )
+        .returning(SimpleCronMessage.id, SimpleCronMessage.next_send_at)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def process_scheduled_scms(
+    db: AsyncSession,
+    batch_size: int = DISPATCH_BATCH_SIZE,
+    window: Optional[DueWindow] = None
+) -> int:
+    """
+    Claim và gửi một batch SCM đến hạn trong window. Lịch SCM luôn tiến tới lượt lặp kế tiếp;
+    lần gửi lỗi được gửi lại riêng qua delivery ledger (có backoff, giới hạn số lần thử).
+    """
+    now_utc = datetime.now(timezone.utc)
+    scms = await _claim_due_scms(db, window or DueWindow(None, now_utc), batch_size)
+    if not scms:
+        await db.rollback()
+        return 0
+
+    jobs = []
+    for scm in scms:
+        if scm.sending_method == SendingMethodEnum.in_app_messaging:
+            logger.warning(f"Worker: Sending method {scm.sending_method} not supported yet for SCM {scm.id}. Skipping this run.")
+            continue
+        jobs.append(scm_job(scm))
+    results = await execute_jobs(jobs, concurrency=DISPATCH_CONCURRENCY, retry_policy=await load_retry_policy(db))
+    failed_count = sum(result.failed for result in results)
+
+    advanced = (await db.execute(_advance_scms_statement([scm.id for scm in scms], now_utc))).all()
+    await db.commit()
+
+    for scm_id, next_send_at in advanced:
+        scheduler_timeline.upsert(KIND_SCM, scm_id, next_send_at)
+    logger.info(f"Worker: Processed {len(scms)} SCM(s), {failed_count} failed.")
+    return len(scms)
+
+
+async def dispatch_due_scms(entity_ids: List[str]):
+    """Handler của scheduler cho các SCM đến hạn."""
+    while True:
+        async with AsyncSessionLocal() as db:
+            claimed = await process_scheduled_scms(db, window=fresh_window(datetime.now(timezone.utc)))
+        if claimed < DISPATCH_BATCH_SIZE:
+            break
+
+
+async def catch_up_scms(batch_size: int, window: DueWindow) -> int:
+    """Catch-up handler: một batch SCM quá hạn (mỗi SCM chỉ gửi một lần rồi nhảy tới slot kế tiếp)."""
+    async with AsyncSessionLocal() as db:
+        return await process_scheduled_scms(db, batch_size, window)
+
+
+async def process_due_retries(db: AsyncSession, batch_size: int = DISPATCH_BATCH_SIZE) -> int:
+    """
+    Gửi lại một batch khóa idempotency đã đến hạn trong delivery ledger (người nhận của FM/IM, SCM,
+    nhắc nhở WCT...). Chỉ lần gửi lỗi được gửi lại; lịch FM/SCM không bị ảnh hưởng.
+    Trả về số khóa đã nhận (bằng batch_size nghĩa là có thể vẫn còn backlog).
+    """
+    now_utc = datetime.now(timezone.utc)
+    claimed, jobs = await claim_due_retries(db, now_utc, batch_size)
+    if not jobs:
+        return claimed
+
+    results = await execute_jobs(jobs, concurrency=DISPATCH_CONCURRENCY, retry_policy=await load_retry_policy(db))
+    # Chỉ tin nhắn có dòng message_receivers/sending_history
+    message_results = [result for result in results if result.job.source == SOURCE_MESSAGE]
+    await record_delivery_results(db, message_results, {})
+    await mark_exhausted_messages_failed(db, {result.job.message_id for result in message_results if result.failed and result.retry_at is None})
+    # IM do sweeper phát hành giữ 'processing' tới khi mọi khóa của nó trong ledger đã xong
+    await settle_initial_messages(db, {result.job.message_id for result in message_results})
+    await db.commit()
+
+    rescheduled = sum(result.retry_at is not None for result in results)
+    logger.info(f"Worker: Retried {len(jobs)} send(s); {rescheduled} rescheduled, {sum(r.ok for r in results)} delivered.")
+    return claimed
+
+
+async def dispatch_due_retries(entity_ids: List[str]):
+    """Handler của scheduler cho các lần gửi lại đến hạn."""
+    while True:
+        async with AsyncSessionLocal() as db:
+            claimed = await process_due_retries(db)
+        if claimed < DISPATCH_BATCH_SIZE:
+            break
+
+
+register_handler(KIND_FM, dispatch_due_fm_schedules)
+register_handler(KIND_SCM, dispatch_due_scms)
+register_handler(KIND_RETRY, dispatch_due_retries)
+register_catchup_handler(KIND_FM, catch_up_fm_schedules)
+register_catchup_handler(KIND_SCM, catch_up_scms)
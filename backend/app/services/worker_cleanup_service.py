@@ -1,18 +1,22 @@
 # /backend/app/services/worker_cleanup_service.py
-# NEW FILE
-# Version: 1.0.0
+# Version: 1.3.0
+# Changelog:
+# - The daily cleanup also prunes old delivery ledger entries.
+# - The daily cleanup is registered as a singleton job: only the elected leader runs it.
+# - VIETNAM_TZ is resolved through the shared timezone registry.
 
 import asyncio
 import logging
 from datetime import datetime, time, timedelta
-import pytz
 
-from .cleanup_service import cleanup_old_in_app_messages
+from ..core.timezones import timezone_registry
+from .cleanup_service import cleanup_old_in_app_messages, cleanup_delivery_ledger
+from .leader_election import register_singleton_job
 
 logger = logging.getLogger(__name__)
 
 # Múi giờ Việt Nam theo yêu cầu thiết kế
-VIETNAM_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+VIETNAM_TZ = timezone_registry.get('Asia/Ho_Chi_Minh')
 
 async def run_daily_cleanup_scheduler():
     """
@@ -24,8 +28,8 @@ async def run_daily_cleanup_scheduler():
         now_vn = datetime.now(VIETNAM_TZ)
         run_time = time(3, 0, 0) # 03:00 AM
         
-        next_run_datetime = VIETNAM_TZ.localize(
-            datetime.combine(now_vn.date(), run_time)
+        next_run_datetime = timezone_registry.localize(
+            VIETNAM_TZ, datetime.combine(now_vn.date(), run_time)
         )
         
         if now_vn.time() >= run_time:
@@ -41,10 +45,14 @@ async def run_daily_cleanup_scheduler():
         try:
             logger.info("WORKER: Woke up for scheduled cleanup. Running jobs...")
             await cleanup_old_in_app_messages()
+            await cleanup_delivery_ledger()
             # Có thể thêm các job dọn dẹp khác ở đây trong tương lai (ví dụ: dọn dẹp file)
             logger.info("WORKER: Scheduled cleanup jobs finished.")
         except Exception as e:
             logger.error(f"WORKER: An error occurred in the scheduled cleanup task: {e}", exc_info=True)
             
         # Chờ 1 phút để tránh vòng lặp tức thì nếu có lỗi trong lúc tính toán thời gian
-        await asyncio.sleep(60)
\ No newline at end of file
+        await asyncio.sleep(60)
+
+
+register_singleton_job("daily_cleanup", run_daily_cleanup_scheduler)
@@ -0,0 +1,10 @@
+# backend/tests/conftest.py
+# NEW FILE
+# Version: 1.0.0
+
+import os
+import sys
+
+# app.core.security đọc JWT_SECRET_KEY khi import; test không cần DB (AsyncSessionLocal được giả lập khi cần)
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
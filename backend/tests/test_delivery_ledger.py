@@ -0,0 +1,132 @@
+# backend/tests/test_delivery_ledger.py
+# NEW FILE
+# Version: 1.0.0
+
+import asyncio
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.dml import Insert, Update
+
+from app.db.models import SendingMethodEnum, ReceiverChannelEnum
+from app.services import delivery_service
+from app.services.delivery_service import ReceiverJob, claim_delivery_keys, execute_jobs
+
+SENT_AT = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _job(address: str, repetition_at=None) -> ReceiverJob:
+    return ReceiverJob(
+        uuid.uuid4(), uuid.uuid4(), ReceiverChannelEnum.email, address,
+        "Subject", "<p>Body</p>", SendingMethodEnum.cronpost_email, repetition_at=repetition_at
+    )
+
+
+class _FakeLedger:
+    """
+    delivery_ledger giả: claimable là các khóa mà INSERT ... ON CONFLICT trả về (kèm số lần claim),
+    sent là các khóa đã gửi xong (khóa -> completed_at). Mọi câu lệnh được ghi lại.
+    """
+    def __init__(self, claimable=None, sent=None):
+        self.claimable = claimable or {}
+        self.sent = sent or {}
+        self.statements = []
+        self.commits = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        self.statements.append(stmt)
+        if isinstance(stmt, Insert):
+            params = stmt.compile(dialect=postgresql.dialect()).params
+            keys = [value for name, value in params.items() if name.startswith("idempotency_key")]
+            rows = [(key, self.claimable[key]) for key in keys if key in self.claimable]
+        elif isinstance(stmt, Update):
+            rows = []
+        else:
+            rows = list(self.sent.items())
+        return SimpleNamespace(all=lambda: rows)
+
+    async def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def fake_ledger(monkeypatch):
+    ledger = _FakeLedger()
+    monkeypatch.setattr(delivery_service, "AsyncSessionLocal", ledger)
+    monkeypatch.setattr(delivery_service.scheduler_timeline, "upsert", lambda *args: None)
+    return ledger
+
+
+def test_idempotency_key_names_message_receiver_and_repetition():
+    job = _job("a@x")
+    assert job.idempotency_key == f"{job.message_id}:{job.receiver_id}:initial"
+    repeated = job._replace(repetition_at=SENT_AT)
+    assert repeated.idempotency_key == f"{job.message_id}:{job.receiver_id}:{SENT_AT.isoformat()}"
+    assert job._replace(receiver_id=None).idempotency_key == f"{job.message_id}:-:initial"
+
+
+def test_claim_reclaims_only_sendable_or_expired_keys(fake_ledger):
+    job = _job("a@x")
+    fake_ledger.claimable = {job.idempotency_key: 1}
+    claimed, settled = asyncio.run(claim_delivery_keys([job]))
+    assert claimed == {job.idempotency_key: 1} and settled == {}
+    assert fake_ledger.commits == 1
+    sql = str(fake_ledger.statements[0].compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (idempotency_key) DO UPDATE" in sql
+    assert "delivery_ledger.status IN" in sql and "delivery_ledger.claimed_at <" in sql
+
+
+def test_skipped_keys_are_noop_in_progress_or_already_sent(fake_ledger):
+    claimed_job, in_progress, already_sent = _job("new@x"), _job("busy@x"), _job("done@x")
+    fake_ledger.claimable = {claimed_job.idempotency_key: 2}
+    fake_ledger.sent = {already_sent.idempotency_key: SENT_AT}
+
+    claimed, settled = asyncio.run(claim_delivery_keys([claimed_job, in_progress, already_sent]))
+
+    assert claimed == {claimed_job.idempotency_key: 2}
+    busy, done = settled[in_progress.idempotency_key], settled[already_sent.idempotency_key]
+    assert busy.noop and not busy.delivered and not busy.failed and not busy.ok
+    assert done.noop and done.delivered and not done.ok and done.attempted_at == SENT_AT
+
+
+def test_execute_jobs_sends_only_claimed_keys_and_records_their_outcomes(fake_ledger):
+    claimed_job, already_sent = _job("new@x"), _job("done@x")
+    fake_ledger.claimable = {claimed_job.idempotency_key: 1}
+    fake_ledger.sent = {already_sent.idempotency_key: SENT_AT}
+    sent_to = []
+
+    async def sender(job):
+        sent_to.append(job.address)
+
+    results = asyncio.run(execute_jobs([already_sent, claimed_job], sender=sender))
+
+    assert sent_to == ["new@x"]
+    assert [result.job for result in results] == [already_sent, claimed_job]
+    assert results[0].noop and results[1].ok
+    completion = fake_ledger.statements[-1]
+    assert isinstance(completion, Update)
+    assert claimed_job.idempotency_key in completion.compile().params.values()
+    assert already_sent.idempotency_key not in completion.compile().params.values()
+
+
+def test_nothing_claimed_sends_nothing(fake_ledger):
+    job = _job("busy@x")
+
+    async def sender(job):
+        raise AssertionError("must not send")
+
+    [result] = asyncio.run(execute_jobs([job], sender=sender))
+    assert result.noop
+    assert not any(isinstance(stmt, Update) for stmt in fake_ledger.statements)
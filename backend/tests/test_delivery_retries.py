@@ -0,0 +1,174 @@
+# backend/tests/test_delivery_retries.py
+# NEW FILE
+# Version: 1.1.0
+# Changelog:
+# - settle_initial_messages only resolves IMs whose ledger keys are all settled.
+
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from app.db.models import SendingAttemptStatusEnum, IndividualSendStatusEnum, SendingMethodEnum, ReceiverChannelEnum
+from app.services import delivery_service
+from app.services.delivery_service import (
+    ReceiverJob, DeliveryResult, RetryPolicy, NO_RETRY,
+    execute_jobs, failed_message_ids, load_retry_policy, record_delivery_results, settle_initial_messages
+)
+from app.services.send_rate_limiter import SendRateLimited
+
+FAILED_AT = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _job(address: str, message_id=None) -> ReceiverJob:
+    return ReceiverJob(
+        message_id or uuid.uuid4(), uuid.uuid4(), ReceiverChannelEnum.email, address,
+        "Subject", "<p>Body</p>", SendingMethodEnum.cronpost_email
+    )
+
+
+@pytest.mark.parametrize("failed_attempts, delay", [(1, 60), (2, 120), (3, 240), (4, 480)])
+def test_backoff_doubles_with_equal_jitter(failed_attempts, delay):
+    policy = RetryPolicy(max_attempts=5, base_delay_seconds=60, max_delay_seconds=3600)
+    for _ in range(50):
+        wait = (policy.next_retry_at(failed_attempts, FAILED_AT) - FAILED_AT).total_seconds()
+        assert delay / 2 <= wait <= delay
+
+
+def test_backoff_is_capped_and_stops_at_max_attempts():
+    policy = RetryPolicy(max_attempts=5, base_delay_seconds=60, max_delay_seconds=300)
+    wait = (policy.next_retry_at(4, FAILED_AT) - FAILED_AT).total_seconds()
+    assert 150 <= wait <= 300
+    assert policy.next_retry_at(5, FAILED_AT) is None
+    assert NO_RETRY.next_retry_at(1, FAILED_AT) is None
+
+
+def test_load_retry_policy_reads_settings_with_defaults():
+    class _Db:
+        async def execute(self, stmt):
+            return SimpleNamespace(all=lambda: [
+                ("send_retry_max_attempts", "3"),
+                ("send_retry_base_delay_seconds", "not-a-number"),
+                ("send_retry_max_delay_seconds", "0"),
+            ])
+
+    assert asyncio.run(load_retry_policy(_Db())) == RetryPolicy(max_attempts=3, base_delay_seconds=60, max_delay_seconds=1)
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    """Ledger giả: claimed là số lần claim của từng khóa; ghi lại kết quả đã lưu và các lần gửi lại vào timeline."""
+    state = SimpleNamespace(claimed={}, completed=[], timeline=[], complete_error=None)
+
+    async def fake_claim(jobs):
+        return {job.idempotency_key: state.claimed[job.idempotency_key] for job in jobs}, {}
+
+    async def fake_complete(results):
+        if state.complete_error:
+            raise state.complete_error
+        state.completed.extend(results)
+
+    monkeypatch.setattr(delivery_service, "claim_delivery_keys", fake_claim)
+    monkeypatch.setattr(delivery_service, "complete_delivery_keys", fake_complete)
+    monkeypatch.setattr(delivery_service.scheduler_timeline, "upsert", lambda kind, key, at: state.timeline.append((key, at)))
+    return state
+
+
+def _sender(failing=(), rate_limited=()):
+    async def send(job):
+        if job.address in rate_limited:
+            raise SendRateLimited("smtp:system", 30)
+        if job.address in failing:
+            raise RuntimeError("smtp down")
+    return send
+
+
+def test_failed_send_is_rescheduled_until_attempts_run_out(ledger):
+    policy = RetryPolicy(max_attempts=3, base_delay_seconds=60, max_delay_seconds=3600)
+    retrying, exhausted, ok = _job("retry@x"), _job("last@x"), _job("ok@x")
+    ledger.claimed = {retrying.idempotency_key: 2, exhausted.idempotency_key: 3, ok.idempotency_key: 1}
+
+    results = asyncio.run(execute_jobs(
+        [retrying, exhausted, ok], sender=_sender(failing={"retry@x", "last@x"}), retry_policy=policy
+    ))
+
+    assert [result.job for result in results] == [retrying, exhausted, ok]
+    retry_result, exhausted_result, ok_result = results
+    assert 60 <= (retry_result.retry_at - retry_result.attempted_at).total_seconds() <= 120
+    assert exhausted_result.failed and exhausted_result.retry_at is None
+    assert ok_result.ok and ok_result.retry_at is None
+    assert ledger.completed == results
+    assert ledger.timeline == [(retrying.idempotency_key, retry_result.retry_at)]
+    assert failed_message_ids(results) == {exhausted.message_id}
+
+
+def test_deferred_send_is_rescheduled_without_counting_as_a_failure(ledger):
+    job = _job("busy@x")
+    ledger.claimed = {job.idempotency_key: 7}
+
+    [result] = asyncio.run(execute_jobs([job], sender=_sender(rate_limited={"busy@x"}), retry_policy=NO_RETRY))
+
+    assert not result.failed and not result.ok
+    assert result.retry_at == result.deferred_until == result.attempted_at + timedelta(seconds=30)
+    assert ledger.timeline == [(job.idempotency_key, result.retry_at)]
+    assert failed_message_ids([result]) == set()
+
+
+def test_retries_are_dropped_when_the_ledger_write_fails(ledger):
+    job = _job("retry@x")
+    ledger.claimed = {job.idempotency_key: 1}
+    ledger.complete_error = RuntimeError("db down")
+    policy = RetryPolicy(max_attempts=3, base_delay_seconds=60, max_delay_seconds=3600)
+
+    [result] = asyncio.run(execute_jobs([job], sender=_sender(failing={"retry@x"}), retry_policy=policy))
+
+    # Khóa vẫn claimed trong ledger: lease hết hạn thì được gửi lại, không lên lịch hai lần
+    assert result.failed and result.retry_at is None
+    assert ledger.timeline == []
+
+
+def test_record_delivery_results_skips_deferred_and_noop_results():
+    class _Db:
+        def __init__(self):
+            self.calls = []
+
+        async def execute(self, stmt, params=None):
+            self.calls.append((stmt, params))
+
+    retrying = DeliveryResult(_job("retry@x"), FAILED_AT, "smtp down", retry_at=FAILED_AT + timedelta(minutes=1))
+    final = DeliveryResult(_job("final@x"), FAILED_AT, "smtp down")
+    deferred = DeliveryResult(_job("busy@x"), FAILED_AT, "rate limited", deferred_until=FAILED_AT, retry_at=FAILED_AT)
+    noop = DeliveryResult(_job("dup@x"), FAILED_AT, noop=True)
+    db = _Db()
+
+    asyncio.run(record_delivery_results(db, [retrying, final, deferred, noop], {}))
+
+    history_rows = db.calls[0][1]
+    assert [row["receiver_address_snapshot"] for row in history_rows] == ["retry@x", "final@x"]
+    assert [row["status"] for row in history_rows] == [SendingAttemptStatusEnum.retrying, SendingAttemptStatusEnum.failed]
+    receiver_statuses = db.calls[1][0].compile().params
+    assert IndividualSendStatusEnum.pending.value in receiver_statuses.values()
+    assert IndividualSendStatusEnum.failed.value in receiver_statuses.values()
+    assert len(db.calls) == 2
+
+
+def test_settle_initial_messages_waits_for_every_ledger_key():
+    statements = []
+
+    class _Db:
+        async def execute(self, stmt):
+            statements.append(stmt)
+
+    asyncio.run(settle_initial_messages(_Db(), []))
+    assert statements == []
+
+    asyncio.run(settle_initial_messages(_Db(), [uuid.uuid4()]))
+    [stmt] = statements
+    sql = " ".join(str(stmt).split())
+    # Chỉ IM đang 'processing' không còn khóa queued/claimed/chờ gửi lại (next_retry_at IS NOT NULL)
+    assert "NOT (EXISTS (SELECT" in sql and "delivery_ledger.next_retry_at IS NOT NULL" in sql
+    assert "messages.overall_send_status = " in sql and "messages.is_initial_message IS true" in sql
+    # sent nếu có người nhận đã nhận được, ngược lại failed (kể cả IM không có người nhận email)
+    assert "CASE WHEN (EXISTS (SELECT" in sql and "delivery_ledger.status = " in sql
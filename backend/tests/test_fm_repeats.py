@@ -0,0 +1,95 @@
+# backend/tests/test_fm_repeats.py
+# NEW FILE
+# Version: 1.0.0
+
+import asyncio
+import uuid
+from datetime import datetime, time, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from app.db.models import FMScheduleTriggerTypeEnum, MessageOverallStatusEnum
+from app.services import worker
+from app.services.delivery_service import NO_RETRY
+
+
+def _overdue_schedule(trigger_type, missed_days: int, **values):
+    now = datetime.now(timezone.utc)
+    slot = datetime.combine(now.date() - timedelta(days=missed_days), time(9, 0), tzinfo=timezone.utc)
+    message = SimpleNamespace(id=uuid.uuid4(), user=SimpleNamespace(timezone="UTC"), receivers=[])
+    fields = dict(
+        days_after_im_value=None, day_of_week_value=None, date_of_month_value=None,
+        date_of_year_value=None, specific_date_value=None
+    )
+    fields.update(values)
+    return SimpleNamespace(
+        message_id=message.id, message=message, trigger_type=trigger_type, sending_time_of_day=time(9, 0),
+        repeat_number=5, next_send_at=slot, **fields
+    )
+
+
+class _Session:
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+@pytest.fixture
+def dispatch(monkeypatch):
+    state = SimpleNamespace(schedules=[], statuses={}, timeline=[])
+
+    async def claim(db, window, batch_size):
+        return state.schedules
+
+    async def execute(jobs, concurrency, retry_policy):
+        return []
+
+    async def retry_policy(db):
+        return NO_RETRY
+
+    async def record(db, results, message_statuses):
+        state.statuses.update(message_statuses)
+
+    monkeypatch.setattr(worker, "_claim_due_fm_schedules", claim)
+    monkeypatch.setattr(worker, "execute_jobs", execute)
+    monkeypatch.setattr(worker, "load_retry_policy", retry_policy)
+    monkeypatch.setattr(worker, "record_delivery_results", record)
+    monkeypatch.setattr(worker.scheduler_timeline, "upsert", lambda kind, key, at: state.timeline.append((key, at)))
+    return state
+
+
+def test_overdue_fm_collapses_missed_repetitions_into_one_send(dispatch):
+    schedule = _overdue_schedule(FMScheduleTriggerTypeEnum.days_after_im_sent, missed_days=10, days_after_im_value=1)
+    dispatch.schedules = [schedule]
+
+    assert asyncio.run(worker.process_scheduled_messages(_Session())) == 1
+    now = datetime.now(timezone.utc)
+    # Một lần gửi cho cả 10 lần lặp đã lỡ; lần kế tiếp là slot 09:00 đầu tiên sau now
+    assert schedule.repeat_number == 4
+    assert now < schedule.next_send_at <= now + timedelta(days=1)
+    assert schedule.next_send_at.astimezone(timezone.utc).time() == time(9, 0)
+    assert dispatch.statuses == {schedule.message_id: MessageOverallStatusEnum.partially_sent}
+    assert dispatch.timeline == [(schedule.message_id, schedule.next_send_at)]
+
+
+def test_overdue_weekly_fm_keeps_its_weekday(dispatch):
+    schedule = _overdue_schedule(FMScheduleTriggerTypeEnum.day_of_week, missed_days=23)
+    weekday = schedule.next_send_at.weekday()
+    dispatch.schedules = [schedule]
+
+    asyncio.run(worker.process_scheduled_messages(_Session()))
+    now = datetime.now(timezone.utc)
+    assert now < schedule.next_send_at <= now + timedelta(days=7)
+    assert schedule.next_send_at.weekday() == weekday
+
+
+def test_on_time_fm_advances_one_repetition(dispatch):
+    schedule = _overdue_schedule(FMScheduleTriggerTypeEnum.days_after_im_sent, missed_days=0, days_after_im_value=3)
+    sent_slot = schedule.next_send_at
+    dispatch.schedules = [schedule]
+
+    asyncio.run(worker.process_scheduled_messages(_Session()))
+    assert schedule.next_send_at == sent_slot + timedelta(days=3)
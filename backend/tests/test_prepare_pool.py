@@ -0,0 +1,84 @@
+# backend/tests/test_prepare_pool.py
+# NEW FILE
+# Version: 1.0.0
+
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from app.services import prepare_pool
+from app.services.mime_parts import build_html_part
+from app.services.render_cache import RenderCache
+
+BIG_BODY = "<p>" + "Xin chào, đây là một tin nhắn dài. " * 400 + "</p>"
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = RenderCache(64 * 1024 * 1024)
+    monkeypatch.setattr(prepare_pool, "render_cache", cache)
+    monkeypatch.setattr(prepare_pool, "DELIVERY_PREPARE_MIN_CHARS", 1000)
+    monkeypatch.setattr(prepare_pool, "DELIVERY_PREPARE_CHUNK_SIZE", 2)
+    yield cache
+    prepare_pool.shutdown_prepare_pool()
+
+
+def test_large_bodies_are_prepared_in_the_pool(cache):
+    bodies = [(("message", index), BIG_BODY + str(index)) for index in range(3)] + [(("message", "small"), "<p>hi</p>")]
+
+    async def main():
+        await prepare_pool.start_prepare_pool(processes=1)
+        assert prepare_pool._pool is not None
+        await prepare_pool.prepare_bodies(bodies)
+
+    asyncio.run(main())
+    for key, source in bodies[:3]:
+        assert cache.contains(key, source)
+        assert cache.lookup(key, source).as_string() == build_html_part(source).as_string()
+    # Body nhỏ được để lại cho lúc gửi
+    assert not cache.contains(("message", "small"), "<p>hi</p>")
+
+
+def test_without_a_started_pool_bodies_are_left_for_send_time(cache):
+    asyncio.run(prepare_pool.prepare_bodies([(("message", 1), BIG_BODY)]))
+    assert not cache.contains(("message", 1), BIG_BODY)
+
+
+def test_cached_bodies_are_not_sent_to_the_pool(cache, monkeypatch):
+    class _Pool:
+        def submit(self, *args):
+            raise AssertionError("must not submit")
+
+        def shutdown(self, **kwargs):
+            pass
+
+    cache.store(("message", 1), BIG_BODY, build_html_part(BIG_BODY))
+    monkeypatch.setattr(prepare_pool, "_pool", _Pool())
+    asyncio.run(prepare_pool.prepare_bodies([(("message", 1), BIG_BODY)]))
+
+
+def test_a_broken_pool_is_restarted_and_the_batch_falls_back(cache, monkeypatch):
+    restarted = []
+
+    class _BrokenPool:
+        def submit(self, *args):
+            raise BrokenProcessPool("worker died")
+
+        def shutdown(self, **kwargs):
+            pass
+
+    async def fake_start(processes=None):
+        restarted.append(True)
+
+    monkeypatch.setattr(prepare_pool, "_pool", _BrokenPool())
+    monkeypatch.setattr(prepare_pool, "start_prepare_pool", fake_start)
+
+    async def main():
+        await prepare_pool.prepare_bodies([(("message", 1), BIG_BODY)])
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert prepare_pool._pool is None
+    assert restarted == [True]
+    assert not cache.contains(("message", 1), BIG_BODY)
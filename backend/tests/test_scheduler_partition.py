@@ -0,0 +1,38 @@
+# backend/tests/test_scheduler_partition.py
+# NEW FILE
+# Version: 1.0.0
+
+from sqlalchemy.dialects import postgresql
+
+from app.db.models import Message
+from app.services.scheduler_partition import PartitionAssignment
+
+
+def test_single_worker_owns_every_user():
+    partition = PartitionAssignment()
+    assert not partition.is_partitioned
+    assert all(partition.owns_hash(user_hash) for user_hash in range(100))
+    assert str(partition.owns(Message.user_id).compile(dialect=postgresql.dialect())) == "true"
+
+
+def test_every_user_hash_has_exactly_one_owner():
+    workers = [PartitionAssignment() for _ in range(3)]
+    for index, worker in enumerate(workers):
+        assert worker.update(index, len(workers))
+    for user_hash in range(1000):
+        assert sum(worker.owns_hash(user_hash) for worker in workers) == 1
+
+
+def test_update_reports_only_real_changes():
+    partition = PartitionAssignment()
+    assert not partition.update(0, 1)
+    assert partition.update(1, 4)
+    assert not partition.update(1, 4)
+    assert partition.update(0, 4)
+
+
+def test_owns_filters_by_the_hash_in_sql():
+    partition = PartitionAssignment()
+    partition.update(2, 5)
+    compiled = partition.owns(Message.user_id).compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    assert str(compiled) == "mod(abs(CAST(hashtext(CAST(messages.user_id AS TEXT)) AS BIGINT)), 5) = 2"
@@ -0,0 +1,168 @@
+# backend/tests/test_send_rate_limiter.py
+# NEW FILE
+# Version: 1.0.0
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.services import send_rate_limiter
+from app.services.send_rate_limiter import SendRateLimited, acquire_send_token, take_tokens, _bucket_capacity
+
+
+class _FakeSession:
+    """Session giả: trả lần lượt các dòng cho trước và ghi lại câu lệnh đã chạy."""
+    def __init__(self, rows, statements):
+        self.rows = rows
+        self.statements = statements
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        return SimpleNamespace(first=lambda: self.rows.pop(0) if self.rows else None)
+
+    async def commit(self):
+        pass
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    """acquire_send_token với tốc độ 3600/giờ và take_tokens giả (ghi lại mỗi lần lấy token)."""
+    calls = []
+    grants = []
+
+    async def fake_take_tokens(bucket_key, wanted, rate_per_hour):
+        calls.append((bucket_key, wanted))
+        # Như lượt DB thật: nhường event loop để các lần gửi khác xếp hàng
+        await asyncio.sleep(0)
+        return grants.pop(0)
+
+    async def fake_rate():
+        return 3600
+
+    monkeypatch.setattr(send_rate_limiter, "AsyncSessionLocal", object())
+    monkeypatch.setattr(send_rate_limiter, "_load_rate_per_hour", fake_rate)
+    monkeypatch.setattr(send_rate_limiter, "take_tokens", fake_take_tokens)
+    monkeypatch.setattr(send_rate_limiter, "_local_buckets", {})
+    return SimpleNamespace(calls=calls, grants=grants)
+
+
+def test_capacity_is_burst_seconds_of_the_rate(monkeypatch):
+    monkeypatch.setattr(send_rate_limiter, "RATE_LIMIT_BURST_SECONDS", 60.0)
+    assert _bucket_capacity(3600) == 60.0
+    assert _bucket_capacity(120) == 2.0
+    # Tốc độ rất thấp vẫn cho phép gửi ít nhất một email
+    assert _bucket_capacity(1) == 1.0
+
+
+def test_take_tokens_grants_up_to_wanted_from_the_refilled_bucket(monkeypatch):
+    statements = []
+    rows = [SimpleNamespace(granted=3.0, available=7.5)]
+    monkeypatch.setattr(send_rate_limiter, "AsyncSessionLocal", lambda: _FakeSession(rows, statements))
+    assert asyncio.run(take_tokens("smtp:system", 3, 3600)) == (3, 0.0)
+    sql = str(statements[0].compile(dialect=postgresql.dialect()))
+    # Nạp lại theo thời gian trôi qua, chặn trên bởi dung lượng, trong cùng câu UPDATE trên dòng đã khóa
+    assert "least" in sql and "EXTRACT(epoch" in sql and "FOR UPDATE" in sql
+
+
+def test_take_tokens_reports_the_wait_until_the_next_token(monkeypatch):
+    statements = []
+    rows = [SimpleNamespace(granted=0.0, available=0.25)]
+    monkeypatch.setattr(send_rate_limiter, "AsyncSessionLocal", lambda: _FakeSession(rows, statements))
+    granted, wait_seconds = asyncio.run(take_tokens("smtp:system", 1, 1800))
+    assert granted == 0
+    # 1800/giờ = 0.5 token/giây: còn thiếu 0.75 token -> 1.5 giây
+    assert wait_seconds == pytest.approx(1.5)
+
+
+def test_take_tokens_creates_a_full_bucket_on_first_use(monkeypatch):
+    statements = []
+    rows = [None, SimpleNamespace(granted=1.0, available=60.0)]
+    monkeypatch.setattr(send_rate_limiter, "AsyncSessionLocal", lambda: _FakeSession(rows, statements))
+    assert asyncio.run(take_tokens("smtp:user:1", 1, 3600)) == (1, 0.0)
+    assert len(statements) == 3
+    assert "ON CONFLICT" in str(statements[1].compile(dialect=postgresql.dialect()))
+
+
+def test_prefetched_tokens_serve_later_sends_without_the_db(limiter):
+    limiter.grants.append((3, 0.0))
+
+    async def main():
+        for _ in range(3):
+            await acquire_send_token("smtp:system")
+
+    asyncio.run(main())
+    assert limiter.calls == [("smtp:system", 1)]
+
+
+def test_concurrent_waiters_prefetch_a_batch(limiter, monkeypatch):
+    monkeypatch.setattr(send_rate_limiter, "RATE_LIMIT_PREFETCH", 3)
+    limiter.grants.extend([(1, 0.0), (3, 0.0), (2, 0.0)])
+
+    async def main():
+        await asyncio.gather(*(acquire_send_token("smtp:system") for _ in range(6)))
+
+    asyncio.run(main())
+    # Lần gửi đầu lấy một token; năm lần đang chờ sau đó lấy theo lô, không quá RATE_LIMIT_PREFETCH
+    assert limiter.calls == [("smtp:system", 1), ("smtp:system", 3), ("smtp:system", 2)]
+
+
+def test_waits_for_refill_then_sends(limiter):
+    limiter.grants.extend([(0, 0.01), (1, 0.0)])
+    asyncio.run(acquire_send_token("smtp:system"))
+    assert len(limiter.calls) == 2
+
+
+def test_raises_send_rate_limited_past_the_max_wait(limiter, monkeypatch):
+    monkeypatch.setattr(send_rate_limiter, "RATE_LIMIT_MAX_WAIT_SECONDS", 1.0)
+    limiter.grants.append((0, 30.0))
+    with pytest.raises(SendRateLimited) as excinfo:
+        asyncio.run(acquire_send_token("smtp:user:42"))
+    assert excinfo.value.bucket_key == "smtp:user:42"
+    assert excinfo.value.retry_after == 30.0
+
+
+def test_unlimited_rate_and_db_errors_do_not_block_sending(limiter, monkeypatch):
+    async def unlimited():
+        return 0
+
+    monkeypatch.setattr(send_rate_limiter, "_load_rate_per_hour", unlimited)
+    asyncio.run(acquire_send_token("smtp:system"))
+    assert limiter.calls == []
+
+    async def limited():
+        return 60
+
+    async def broken_take_tokens(*args):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(send_rate_limiter, "_load_rate_per_hour", limited)
+    monkeypatch.setattr(send_rate_limiter, "take_tokens", broken_take_tokens)
+    asyncio.run(acquire_send_token("smtp:system"))
+
+
+def test_transactional_mail_takes_no_token(monkeypatch):
+    from app.services import email_service
+
+    acquired, sent = [], []
+
+    async def fake_acquire(bucket_key):
+        acquired.append(bucket_key)
+
+    async def fake_run_in_threadpool(func, **kwargs):
+        sent.append(kwargs["email_to"])
+
+    monkeypatch.setattr(email_service, "acquire_send_token", fake_acquire)
+    monkeypatch.setattr(email_service, "SMTP_ASYNC_ENABLED", False)
+    monkeypatch.setattr(email_service, "run_in_threadpool", fake_run_in_threadpool)
+    asyncio.run(email_service.send_html_email_async("PIN", "a@example.com", "<p>1234</p>"))
+    asyncio.run(email_service.send_html_email_async("Hi", "b@example.com", "<p>hi</p>", rate_limited=True))
+    assert sent == ["a@example.com", "b@example.com"]
+    assert acquired == [send_rate_limiter.SYSTEM_SMTP_BUCKET]
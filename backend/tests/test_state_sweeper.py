@@ -0,0 +1,179 @@
+# backend/tests/test_state_sweeper.py
+# NEW FILE
+# Version: 1.1.0
+# Changelog:
+# - Released IMs are sent after the freeze commits and settled from the ledger.
+
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import state_sweeper
+from app.services.delivery_service import SOURCE_CLC_PROMPT, NO_RETRY
+
+NOW = datetime(2026, 3, 1, 8, 0, tzinfo=timezone.utc)
+
+
+def _promoted_row():
+    return SimpleNamespace(
+        id=uuid.uuid4(), email="user@example.com", user_name=None, timezone="Asia/Ho_Chi_Minh",
+        wct_active_ends_at=NOW + timedelta(days=1), next_clc_prompt_at=NOW
+    )
+
+
+class _Session:
+    """Session giả: ghi commit/rollback vào nhật ký sự kiện chung."""
+    def __init__(self, events, fail_commit=False):
+        self.events = events
+        self.fail_commit = fail_commit
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def commit(self):
+        if self.fail_commit:
+            raise RuntimeError("commit failed")
+        self.events.append("commit")
+
+    async def rollback(self):
+        self.events.append("rollback")
+
+
+@pytest.fixture
+def sweeper(monkeypatch):
+    state = SimpleNamespace(events=[], rows=[_promoted_row()], queued=[], sent=[], fail_commit=False)
+
+    async def promote(db, now_utc, batch_size, window=None):
+        state.events.append("promote")
+        return state.rows
+
+    async def queue(db, jobs, send_after):
+        state.events.append("queue")
+        state.queued.extend((job.idempotency_key, send_after) for job in jobs)
+
+    async def retry_policy(db):
+        return NO_RETRY
+
+    async def reminders(db, user_ids):
+        state.events.append("reminders")
+
+    async def execute(jobs, concurrency, retry_policy):
+        state.events.append("send")
+        state.sent.extend(job.idempotency_key for job in jobs)
+        return []
+
+    monkeypatch.setattr(state_sweeper, "AsyncSessionLocal", lambda: _Session(state.events, state.fail_commit))
+    monkeypatch.setattr(state_sweeper, "promote_clc_to_wct", promote)
+    monkeypatch.setattr(state_sweeper, "queue_delivery_keys", queue)
+    monkeypatch.setattr(state_sweeper, "load_retry_policy", retry_policy)
+    monkeypatch.setattr(state_sweeper, "schedule_reminders_for", reminders)
+    monkeypatch.setattr(state_sweeper, "execute_jobs", execute)
+    monkeypatch.setattr(state_sweeper, "get_email_template", lambda name: SimpleNamespace(render=lambda **kw: "<p>prompt</p>"))
+    monkeypatch.setattr(state_sweeper.scheduler_timeline, "upsert", lambda kind, key, at: state.events.append("timeline"))
+    return state
+
+
+def test_prompts_are_queued_with_the_promotion_and_sent_after_commit(sweeper):
+    assert asyncio.run(state_sweeper.promote_and_prompt(NOW, 10, window=None)) == 1
+    assert sweeper.events == ["promote", "queue", "commit", "timeline", "reminders", "send"]
+    # Khóa ghi trước trong ledger chính là khóa được gửi; dispatcher gửi lại nhận khóa sau một lease
+    [(queued_key, send_after)] = sweeper.queued
+    assert sweeper.sent == [queued_key]
+    assert send_after == NOW + timedelta(seconds=state_sweeper.DELIVERY_LEDGER_LEASE_SECONDS)
+
+
+def test_nothing_is_sent_when_the_promotion_does_not_commit(sweeper):
+    sweeper.fail_commit = True
+    with pytest.raises(RuntimeError):
+        asyncio.run(state_sweeper.promote_and_prompt(NOW, 10, window=None))
+    assert "send" not in sweeper.events and "timeline" not in sweeper.events
+
+
+def test_no_promotion_rolls_back_without_sending(sweeper):
+    sweeper.rows = []
+    assert asyncio.run(state_sweeper.promote_and_prompt(NOW, 10, window=None)) == 0
+    assert sweeper.events == ["promote", "rollback"]
+
+
+def test_prompt_key_is_stable_across_redone_promotions(sweeper):
+    row = sweeper.rows[0]
+    first, again = state_sweeper.clc_prompt_job(row), state_sweeper.clc_prompt_job(row, due_at=NOW)
+    assert first.idempotency_key == again.idempotency_key == f"{row.id}:-:{NOW.isoformat()}"
+    assert first.source == SOURCE_CLC_PROMPT and first.user_id == row.id
+
+
+def test_freeze_and_release_commit_together_before_the_timeline(sweeper, monkeypatch):
+    frozen = [SimpleNamespace(id=uuid.uuid4(), timezone="UTC")]
+    sweeper.rows = []
+
+    async def freeze(db, now_utc, batch_size):
+        sweeper.events.append("freeze")
+        return frozen
+
+    im_job = SimpleNamespace(idempotency_key="im:receiver:initial")
+    im_id = uuid.uuid4()
+    settled = []
+
+    async def release(db, frozen_users, now_utc):
+        sweeper.events.append("release")
+        return state_sweeper.ReleasedMessages({uuid.uuid4(): NOW + timedelta(days=1)}, [im_id], [im_job])
+
+    async def record(db, results, message_statuses):
+        # Trạng thái IM không được chốt từ kết quả của lần gửi này
+        assert message_statuses == {}
+        sweeper.events.append("record")
+
+    async def settle(db, message_ids):
+        sweeper.events.append("settle")
+        settled.extend(message_ids)
+
+    monkeypatch.setattr(state_sweeper, "freeze_wct_to_fns", freeze)
+    monkeypatch.setattr(state_sweeper, "release_fns_messages", release)
+    monkeypatch.setattr(state_sweeper, "record_delivery_results", record)
+    monkeypatch.setattr(state_sweeper, "settle_initial_messages", settle)
+    assert asyncio.run(state_sweeper.run_state_sweep(batch_size=10)) == 1
+    # IM chỉ được gửi sau khi freeze đã commit (không giữ khóa FOR UPDATE của user trong lúc gửi)
+    assert sweeper.events == [
+        "promote", "rollback", "freeze", "release", "commit", "timeline", "send", "record", "settle", "commit"
+    ]
+    assert sweeper.sent == [im_job.idempotency_key] and settled == [im_id]
+
+
+class _ReleaseSession:
+    """Session giả cho release_fns_messages: trả kết quả theo thứ tự các câu SELECT, ghi lại mọi câu lệnh."""
+    def __init__(self, initial_messages, fm_rows):
+        self.selects = [initial_messages, fm_rows]
+        self.statements = []
+
+    async def execute(self, stmt, params=None):
+        self.statements.append(stmt)
+        if stmt.is_select:
+            rows = self.selects.pop(0)
+            return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: rows), all=lambda: rows)
+        return None
+
+
+def test_release_queues_im_keys_and_leaves_the_ims_processing(sweeper):
+    user_id = uuid.uuid4()
+    receiver = SimpleNamespace(id=uuid.uuid4(), receiver_channel=state_sweeper.ReceiverChannelEnum.email, receiver_address="a@example.com")
+    fields = dict(user_id=user_id, message_title="t", message_content="c", sending_method=None, is_initial_message=True)
+    with_receiver = SimpleNamespace(id=uuid.uuid4(), receivers=[receiver], **fields)
+    without_receiver = SimpleNamespace(id=uuid.uuid4(), receivers=[], **fields)
+    db = _ReleaseSession([with_receiver, without_receiver], [])
+
+    released = asyncio.run(state_sweeper.release_fns_messages(db, {user_id: "UTC"}, NOW))
+
+    assert "send" not in sweeper.events
+    assert [job.idempotency_key for job in released.im_jobs] == [key for key, _ in sweeper.queued]
+    assert [job.message_id for job in released.im_jobs] == [with_receiver.id]
+    # Cả hai IM (kể cả IM không có người nhận email) chuyển sang 'processing' để settle chốt trạng thái
+    assert released.initial_message_ids == [with_receiver.id, without_receiver.id]
+    [mark_processing] = [stmt for stmt in db.statements if not stmt.is_select]
+    params = mark_processing.compile().params
+    assert params["overall_send_status"] == state_sweeper.MessageOverallStatusEnum.processing
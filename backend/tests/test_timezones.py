@@ -0,0 +1,78 @@
+# backend/tests/test_timezones.py
+# NEW FILE
+# Version: 1.0.0
+
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from app.core.timezones import TimezoneRegistry
+
+ZONES = ["Asia/Ho_Chi_Minh", "Europe/London", "America/New_York", "Australia/Lord_Howe", "America/Santiago", "UTC"]
+
+
+def _pytz_to_utc(tz, local_naive):
+    try:
+        return tz.localize(local_naive, is_dst=None).astimezone(pytz.utc)
+    except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e:
+        return type(e)
+
+
+def _registry_to_utc(registry, tz, local_naive):
+    try:
+        return registry.to_utc(tz, local_naive)
+    except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e:
+        return type(e)
+
+
+@pytest.mark.parametrize("zone", ZONES)
+def test_to_utc_matches_pytz_every_half_hour(zone):
+    registry = TimezoneRegistry(horizon_years=2)
+    tz = registry.get(zone)
+    year = datetime.now().year
+    moment, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    while moment < end:
+        assert _registry_to_utc(registry, tz, moment) == _pytz_to_utc(tz, moment), moment
+        moment += timedelta(minutes=30)
+
+
+def test_dst_gap_and_overlap_raise_like_pytz():
+    registry = TimezoneRegistry(horizon_years=2)
+    tz = registry.get("America/New_York")
+    year = datetime.now().year
+    # Chủ nhật thứ hai của tháng 3 (02:00 -> 03:00) và chủ nhật đầu tiên của tháng 11 (02:00 -> 01:00)
+    march = datetime(year, 3, 1)
+    gap_day = march + timedelta(days=(6 - march.weekday()) % 7 + 7)
+    november = datetime(year, 11, 1)
+    overlap_day = november + timedelta(days=(6 - november.weekday()) % 7)
+    with pytest.raises(pytz.exceptions.NonExistentTimeError):
+        registry.to_utc(tz, gap_day.replace(hour=2, minute=30))
+    with pytest.raises(pytz.exceptions.AmbiguousTimeError):
+        registry.localize(tz, overlap_day.replace(hour=1, minute=30))
+
+
+def test_localize_keeps_the_pytz_tzinfo():
+    registry = TimezoneRegistry(horizon_years=2)
+    tz = registry.get("Europe/London")
+    moment = datetime(datetime.now().year, 7, 1, 9, 0)
+    localized = registry.localize(tz, moment)
+    assert localized == tz.localize(moment, is_dst=None)
+    assert localized.tzname() == tz.localize(moment, is_dst=None).tzname()
+
+
+def test_outside_horizon_falls_back_to_pytz():
+    registry = TimezoneRegistry(horizon_years=1)
+    tz = registry.get("Europe/London")
+    far = datetime(datetime.now().year + 10, 7, 1, 12, 0)
+    assert registry.to_utc(tz, far) == tz.localize(far, is_dst=None).astimezone(pytz.utc)
+
+
+def test_fixed_zone_and_unknown_zone_cache():
+    registry = TimezoneRegistry()
+    assert registry.is_fixed(registry.get("Asia/Ho_Chi_Minh"))
+    assert not registry.is_fixed(registry.get("Europe/London"))
+    for _ in range(2):
+        with pytest.raises(pytz.exceptions.UnknownTimeZoneError):
+            registry.get("Mars/Olympus_Mons")
+    assert "Mars/Olympus_Mons" in registry._unknown_zones
@@ -0,0 +1,96 @@
+# backend/tests/test_wct_reminders.py
+# NEW FILE
+# Version: 1.0.0
+
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import wct_reminders
+from app.services.delivery_service import DeliveryResult, NO_RETRY
+
+
+class _Session:
+    """Session giả: mọi SELECT trả về các dòng nhắc nhở cho trước."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        return SimpleNamespace(all=lambda: self.rows)
+
+    async def commit(self):
+        pass
+
+
+def _reminder_rows(count, now_utc):
+    return [
+        SimpleNamespace(
+            user_id=uuid.uuid4(), reminder_at=now_utc - timedelta(seconds=count - index),
+            wct_ends_at=now_utc + timedelta(minutes=3), email=f"user{index}@example.com",
+            user_name=None, timezone="UTC", use_checkin_token_email=index % 2 == 0
+        )
+        for index in range(count)
+    ]
+
+
+@pytest.fixture
+def dispatch(monkeypatch):
+    state = SimpleNamespace(rows=[], batches=[], failing_batches=set(), timeline=[])
+    now_utc = datetime.now(timezone.utc)
+    state.rows = _reminder_rows(5, now_utc)
+
+    async def final_minutes(db):
+        return 3
+
+    async def tokens(db, user_ids, now_utc):
+        return {user_id: f"token-{user_id}" for user_id in user_ids}
+
+    async def retry_policy(db):
+        return NO_RETRY
+
+    async def execute(jobs, concurrency, retry_policy):
+        state.batches.append([job.address for job in jobs])
+        if len(state.batches) in state.failing_batches:
+            raise RuntimeError("ledger down")
+        return [DeliveryResult(job, datetime.now(timezone.utc)) for job in jobs]
+
+    monkeypatch.setattr(wct_reminders, "AsyncSessionLocal", lambda: _Session(state.rows))
+    monkeypatch.setattr(wct_reminders, "load_final_reminder_minutes", final_minutes)
+    monkeypatch.setattr(wct_reminders, "issue_checkin_tokens", tokens)
+    monkeypatch.setattr(wct_reminders, "load_retry_policy", retry_policy)
+    monkeypatch.setattr(wct_reminders, "execute_jobs", execute)
+    monkeypatch.setattr(wct_reminders, "get_email_template", lambda name: SimpleNamespace(render=lambda **kw: "<p>reminder</p>"))
+    monkeypatch.setattr(wct_reminders, "WCT_REMINDER_BATCH_SIZE", 2)
+    monkeypatch.setattr(wct_reminders, "_fired_until", now_utc - timedelta(minutes=10))
+    monkeypatch.setattr(
+        wct_reminders.scheduler_timeline, "upsert", lambda kind, key, at: state.timeline.append((key, at))
+    )
+    return state
+
+
+def test_every_batch_is_sent_and_the_watermark_advances(dispatch):
+    before = datetime.now(timezone.utc)
+    asyncio.run(wct_reminders.dispatch_wct_reminders([]))
+    assert [len(batch) for batch in dispatch.batches] == [2, 2, 1]
+    assert wct_reminders._fired_until >= before
+    assert dispatch.timeline == []
+
+
+def test_a_failed_batch_holds_the_watermark_and_schedules_a_retry(dispatch):
+    dispatch.failing_batches = {2}
+    asyncio.run(wct_reminders.dispatch_wct_reminders([]))
+    # Các batch sau batch lỗi vẫn được gửi
+    assert [len(batch) for batch in dispatch.batches] == [2, 2, 1]
+    assert wct_reminders._fired_until == dispatch.rows[2].reminder_at - timedelta(microseconds=1)
+    [(retry_id, retry_at)] = dispatch.timeline
+    assert retry_id == f"retry:{retry_at.isoformat()}"
+    assert retry_at > datetime.now(timezone.utc)
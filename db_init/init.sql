@@ -1,6 +1,6 @@
 -- SQL KHỞI TẠO POSTGRES DATABASE DUY NHẤT
--- VERSION: 2.10.1
--- Mô tả: Sửa lỗi cú pháp trong câu lệnh INSERT...ON CONFLICT. Thêm bảng email_checkin_settings và pin_attempts.
+-- VERSION: 2.20.0
+-- Mô tả: Thêm index delivery_ledger(message_id) (trạng thái IM được chốt từ các khóa của nó trong ledger).
 
 -- KÍCH HOẠT EXTENSION CẦN THIẾT
 CREATE EXTENSION IF NOT EXISTS moddatetime; 
@@ -23,6 +23,7 @@ CREATE TYPE public.ott_opt_in_status_enum AS ENUM ('pending_verification','activ
 CREATE TYPE public.rating_points_enum AS ENUM ('_1','_2','_3','_4','_5');
 CREATE TYPE public.scm_schedule_type_enum AS ENUM ('loop', 'unloop');
 CREATE TYPE public.scm_status_enum AS ENUM ('active', 'inactive', 'paused');
+CREATE TYPE public.delivery_ledger_status_enum AS ENUM ('queued', 'claimed', 'sent', 'failed');
 
 
 -- TẠO CÁC BẢNG
@@ -336,6 +337,34 @@ CREATE TABLE public.message_attachments (
     PRIMARY KEY (message_id, file_id)
 );
 
+CREATE TABLE public.scheduler_workers (
+    worker_id TEXT PRIMARY KEY, -- hostname-pid hoặc SCHEDULER_WORKER_ID
+    started_at TIMESTAMPTZ DEFAULT NOW() NOT NULL,
+    heartbeat_at TIMESTAMPTZ DEFAULT NOW() NOT NULL,
+    lane_metrics JSONB -- Số liệu theo làn gửi (fns/wct_reminder/fm/scm): hàng đợi, độ trễ p50/p99, số lần gửi
+);
+
+CREATE TABLE public.delivery_ledger (
+    idempotency_key TEXT PRIMARY KEY, -- '<message_id>:<receiver_id|->:<thời điểm đến hạn của lần gửi|initial>'
+    message_id UUID NOT NULL, -- messages.id, simple_cron_messages.id hoặc users.id (email nhắc WCT)
+    receiver_id UUID,
+    user_id UUID, -- Chủ của lịch gửi (phân vùng worker xử lý lần gửi lại)
+    source TEXT DEFAULT 'message' NOT NULL, -- 'message', 'scm', 'wct_reminder'...: cách dựng lại job khi gửi lại
+    repetition_at TIMESTAMPTZ, -- Lần gửi theo lịch của khóa (NULL với IM)
+    status public.delivery_ledger_status_enum DEFAULT 'claimed' NOT NULL,
+    attempts INT DEFAULT 1 NOT NULL, -- Số lần claim (số lần thử gửi) của khóa
+    claimed_at TIMESTAMPTZ DEFAULT NOW() NOT NULL,
+    completed_at TIMESTAMPTZ,
+    last_error TEXT,
+    next_retry_at TIMESTAMPTZ -- Lần gửi lại kế tiếp (hoặc hết lease khi đang claimed); NULL khi không còn
+);
+
+CREATE TABLE public.rate_limit_buckets (
+    bucket_key TEXT PRIMARY KEY, -- 'smtp:system' hoặc 'smtp:user:<user_id>'
+    tokens DOUBLE PRECISION NOT NULL, -- Số token còn lại tại refilled_at (được nạp lại theo thời gian khi lấy token)
+    refilled_at TIMESTAMPTZ DEFAULT NOW() NOT NULL
+);
+
 -- TẠO CÁC TRIGGERS CHO `updated_at`
 CREATE OR REPLACE FUNCTION public.check_fm_message_not_initial()
 RETURNS TRIGGER AS $$
@@ -406,6 +435,9 @@ CREATE INDEX IF NOT EXISTS idx_in_app_messages_receiver_id ON public.in_app_mess
 CREATE INDEX IF NOT EXISTS idx_user_blocks_blocked_id ON public.user_blocks(blocked_user_id);
 CREATE INDEX IF NOT EXISTS idx_scm_user_id ON public.simple_cron_messages(user_id);
 CREATE INDEX IF NOT EXISTS idx_scm_next_send_at ON public.simple_cron_messages(next_send_at) WHERE status = 'active';
+CREATE INDEX IF NOT EXISTS idx_delivery_ledger_next_retry_at ON public.delivery_ledger(next_retry_at) WHERE next_retry_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_delivery_ledger_claimed_at ON public.delivery_ledger(claimed_at);
+CREATE INDEX IF NOT EXISTS idx_delivery_ledger_message_id ON public.delivery_ledger(message_id);
 CREATE INDEX IF NOT EXISTS idx_message_attachments_message_id ON public.message_attachments(message_id);
 CREATE INDEX IF NOT EXISTS idx_message_attachments_file_id ON public.message_attachments(file_id);
 
@@ -443,7 +475,7 @@ INSERT INTO public.system_settings (setting_key, setting_value, description, val
     ('max_stored_messages_free', '100', 'Maximum messages stored in free account', 'integer', true),
     ('max_stored_messages_premium', '10000', 'Maximum messages stored in premium account', 'integer', true),
     ('premium_lifetime_price_usd', '10', 'The lifetime price in USD for the Premium plan', 'float', true),
-    ('email_sending_rate_per_hours', '50', 'System-wide email sending frequency to ensure compliance with SMTP server regulations', 'integer', true),
+    ('email_sending_rate_per_hours', '50', 'Max emails per hour per SMTP transport (the system SMTP and each user SMTP), enforced across all workers to ensure compliance with SMTP server regulations (0 = unlimited)', 'integer', true),
     ('wct_final_reminder_minutes', '3', 'Final WCT reminder time before it ends (minutes)', 'integer', true),
     ('receivers_limit_cronpost_email', '5', 'Limit the number of recipients in the cronpost-email sending method', 'integer', true),
     ('receivers_limit_in_app_messaging', '10', 'Limit the number of recipients in the In-App-Messaging sending method', 'integer', true),
@@ -451,7 +483,12 @@ INSERT INTO public.system_settings (setting_key, setting_value, description, val
     ('max_pin_attempts_log_per_user', '50', 'Maximum number of PIN attempt logs to store per user', 'integer', true),
     ('time_storage_message_free', '60', 'Retention period in days for In-App Messages in conversations involving only Free users.', 'integer', true),
     ('time_storage_message_premium', '360', 'Retention period in days for In-App Messages in conversations involving at least one Premium user.', 'integer', true),
-    ('char_limit_buffer_multiplier', '2.0', 'The multiplier for the plain text character limit buffer (e.g., 2.0 means 100% buffer).', 'float', true)
+    ('char_limit_buffer_multiplier', '2.0', 'The multiplier for the plain text character limit buffer (e.g., 2.0 means 100% buffer).', 'float', true),
+    ('send_retry_max_attempts', '5', 'Maximum send attempts per delivery (receiver and repetition) before it is marked failed', 'integer', true),
+    ('send_retry_base_delay_seconds', '60', 'Delay (seconds) before the first retry of a failed send; doubles on each further retry', 'integer', true),
+    ('send_retry_max_delay_seconds', '3600', 'Upper bound (seconds) for the delay between two retries of a send', 'integer', true),
+    ('catchup_rate_per_minute', '60', 'System-wide number of overdue schedules (FM, SCM, CLC prompts) drained per minute after scheduler downtime', 'integer', true),
+    ('clc_prompt_jitter_seconds', '0', 'Max seconds a CLC prompt may be sent before or after its nominal time, fixed per user, to spread load peaks (0 = off)', 'integer', true)
     
 ON CONFLICT (setting_key) DO UPDATE SET 
     setting_value = EXCLUDED.setting_value,